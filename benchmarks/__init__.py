@@ -0,0 +1 @@
+"""PAKET util benchmarks."""
@@ -0,0 +1,130 @@
+"""
+Benchmarks for db module, against the database configured by the same environment as the tests.
+Run with `python -m benchmarks.db_benchmark [benchmark ...]`, results are printed as JSON.
+"""
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import util.db
+
+DB_HOST = os.environ.get('PAKET_DB_HOST', '127.0.0.1')
+DB_PORT = int(os.environ.get('PAKET_DB_PORT', 3306))
+DB_USER = os.environ.get('PAKET_DB_USER', 'root')
+DB_PASSWORD = os.environ.get('PAKET_DB_PASSWORD')
+DB_NAME = os.environ.get('PAKET_DB_NAME', 'paket_test')
+QUERIES = int(os.environ.get('PAKET_BENCHMARK_QUERIES', 1000))
+ROWS = int(os.environ.get('PAKET_BENCHMARK_ROWS', 100000))
+
+
+def queries_benchmark(active_sql_connection, queries=QUERIES):
+    """Measure queries per second, each in its own connection context."""
+    start = time.perf_counter()
+    for _ in range(queries):
+        with active_sql_connection() as sql:
+            sql.execute('SELECT 1')
+            sql.fetchall()
+    return {'queries_per_second': round(queries / (time.perf_counter() - start))}
+
+
+def benchmark_database():
+    """Create the benchmark database if it doesn't exist, returning an sql_connection to it."""
+    with util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD)() as sql:
+        sql.execute('CREATE DATABASE IF NOT EXISTS {}'.format(DB_NAME))
+    return util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+
+
+def benchmark_table(active_sql_connection):
+    """Create an empty benchmark table."""
+    with active_sql_connection() as sql:
+        sql.execute('DROP TABLE IF EXISTS benchmark')
+        sql.execute('CREATE TABLE benchmark(id INTEGER PRIMARY KEY, number INTEGER, name VARCHAR(64))')
+
+
+def insert_benchmark(bulk, rows=ROWS):
+    """Measure rows per second inserted one execute at a time or with bulk_insert."""
+    active_sql_connection = benchmark_database()
+    benchmark_table(active_sql_connection)
+    data = [{'id': index, 'number': index * 7, 'name': 'row {}'.format(index)} for index in range(rows)]
+    if bulk:
+        stats = util.db.bulk_insert(active_sql_connection, 'benchmark', data)
+        return {'rows_per_second': round(stats['rows_per_second']), 'statements': stats['statements']}
+    start = time.perf_counter()
+    with active_sql_connection() as sql:
+        for row in data:
+            sql.execute('INSERT INTO benchmark (id, number, name) VALUES (%s, %s, %s)',
+                        (row['id'], row['number'], row['name']))
+    return {'rows_per_second': round(rows / (time.perf_counter() - start)), 'statements': rows}
+
+
+def repeated_benchmark(prepared, queries=QUERIES * 10):
+    """
+    Measure queries per second of a repeated parameterized statement, sent as text or as a prepared statement.
+    Both use the pure Python connector, which prepared statements need, so only the protocol differs.
+    """
+    active_sql_connection = benchmark_database()
+    benchmark_table(active_sql_connection)
+    util.db.bulk_insert(active_sql_connection, 'benchmark', (
+        {'id': index, 'number': index * 7, 'name': 'row {}'.format(index)} for index in range(queries)))
+    active_sql_connection = util.db.custom_sql_connection(
+        DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, prepared=prepared, use_pure=True)
+    start = time.perf_counter()
+    with active_sql_connection() as sql:
+        for index in range(queries):
+            sql.execute('SELECT number, name FROM benchmark WHERE id = %s', (index,))
+            sql.fetchall()
+    return {'queries_per_second': round(queries / (time.perf_counter() - start))}
+
+
+def read_benchmark(stream, rows=ROWS):
+    """Measure peak traced memory and rows per second reading a large table with fetchall or stream_query."""
+    active_sql_connection = benchmark_database()
+    benchmark_table(active_sql_connection)
+    util.db.bulk_insert(active_sql_connection, 'benchmark', (
+        {'id': index, 'number': index * 7, 'name': 'row {}'.format(index)} for index in range(rows)))
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        total = 0
+        if stream:
+            for row in util.db.stream_query(active_sql_connection, 'SELECT * FROM benchmark'):
+                total += row['number']
+        else:
+            with active_sql_connection() as sql:
+                sql.execute('SELECT * FROM benchmark')
+                for row in sql.fetchall():
+                    total += row['number']
+        elapsed = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'rows_per_second': round(rows / elapsed), 'peak_bytes': peak_bytes}
+
+
+BENCHMARKS = {
+    'connect_per_query': lambda: queries_benchmark(
+        util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD)),
+    'pooled': lambda: queries_benchmark(
+        util.db.custom_pooled_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD)),
+    'insert_per_row': lambda: insert_benchmark(False),
+    'bulk_insert': lambda: insert_benchmark(True),
+    'repeated_text': lambda: repeated_benchmark(False),
+    'repeated_prepared': lambda: repeated_benchmark(True),
+    'read_fetchall': lambda: read_benchmark(False),
+    'read_streamed': lambda: read_benchmark(True),
+}
+
+
+def main(names=None):
+    """Run benchmarks by name (all by default) and print the results as JSON."""
+    results = {'python': platform.python_version(), 'queries': QUERIES, 'rows': ROWS, 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
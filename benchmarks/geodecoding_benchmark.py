@@ -0,0 +1,109 @@
+"""
+Benchmarks of offline country lookups, with made up countries of many vertices.
+Run with `python -m benchmarks.geodecoding_benchmark [benchmark ...]`, results are printed as JSON.
+"""
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import util.geodecoding
+
+LOOKUPS = int(os.environ.get('PAKET_BENCHMARK_LOOKUPS', 100000))
+# Made up countries are laid out in a grid of COUNTRIES by COUNTRIES, each with a border of VERTICES points.
+COUNTRIES = int(os.environ.get('PAKET_BENCHMARK_COUNTRIES', 10))
+VERTICES = int(os.environ.get('PAKET_BENCHMARK_VERTICES', 2000))
+COUNTRY_WIDTH = 10
+
+
+def made_up_boundaries(countries=COUNTRIES, vertices=VERTICES, seed=0):
+    """Get boundaries of countries with jagged borders, each in its own square of the grid, by made up code."""
+    randomizer = random.Random(seed)
+    boundaries = {}
+    for row in range(countries):
+        for column in range(countries):
+            center = ((row + 0.5) * COUNTRY_WIDTH - 45, (column + 0.5) * COUNTRY_WIDTH - 45)
+            ring = []
+            for vertex in range(vertices):
+                angle = 2 * math.pi * vertex / vertices
+                radius = COUNTRY_WIDTH * (0.35 + 0.08 * math.sin(7 * angle) + randomizer.uniform(0, 0.03))
+                ring.append((center[0] + radius * math.sin(angle), center[1] + radius * math.cos(angle)))
+            ring.append(ring[0])
+            boundaries['{}{}'.format(chr(ord('A') + row), chr(ord('A') + column))] = [[ring]]
+    return boundaries
+
+
+def ray_casting_country_code(boundaries, latitude, longitude):
+    """Find the country of coordinates by ray casting over all edges of all countries."""
+    for country_code, polygons in boundaries.items():
+        inside = False
+        for ring in (ring for polygon in polygons for ring in polygon):
+            for (start_latitude, start_longitude), (end_latitude, end_longitude) in zip(ring, ring[1:]):
+                if (start_latitude > latitude) != (end_latitude > latitude) and longitude < start_longitude + (
+                        (latitude - start_latitude) * (end_longitude - start_longitude)
+                        / (end_latitude - start_latitude)):
+                    inside = not inside
+        if inside:
+            return country_code
+    return ''
+
+
+def random_coordinates(count, seed=1):
+    """Get random coordinates over the made up countries."""
+    randomizer = random.Random(seed)
+    extent = COUNTRIES * COUNTRY_WIDTH / 2
+    return [(randomizer.uniform(-extent, extent), randomizer.uniform(-extent, extent)) for _ in range(count)]
+
+
+def lookup_benchmark(lookups=LOOKUPS):
+    """Measure index build time, lookups per second and the share of lookups left to the API."""
+    boundaries = made_up_boundaries()
+    start = time.perf_counter()
+    index = util.geodecoding.CountryIndex(boundaries)
+    build_seconds = time.perf_counter() - start
+    coordinates = random_coordinates(lookups)
+    start = time.perf_counter()
+    ambiguous = sum(index.lookup(*point) is None for point in coordinates)
+    elapsed = time.perf_counter() - start
+    return {
+        'build_seconds': round(build_seconds, 3), 'lookups_per_second': round(lookups / elapsed),
+        'mean_lookup_us': round(elapsed / lookups * 1e6, 3), 'fallback_ratio': round(ambiguous / lookups, 5)}
+
+
+def accuracy_benchmark(lookups=LOOKUPS // 100):
+    """Compare lookups with ray casting over all edges, and measure ray casting lookups per second."""
+    boundaries = made_up_boundaries()
+    index = util.geodecoding.CountryIndex(boundaries)
+    coordinates = random_coordinates(lookups, seed=2)
+    start = time.perf_counter()
+    expected = [ray_casting_country_code(boundaries, *point) for point in coordinates]
+    elapsed = time.perf_counter() - start
+    resolved = [(index.lookup(*point), country_code) for point, country_code in zip(coordinates, expected)]
+    resolved = [(found, country_code) for found, country_code in resolved if found is not None]
+    return {
+        'lookups': lookups, 'resolved': len(resolved),
+        'mismatches': sum(found != country_code for found, country_code in resolved),
+        'ray_casting_lookups_per_second': round(lookups / elapsed)}
+
+
+BENCHMARKS = {
+    'lookup': lookup_benchmark,
+    'accuracy': accuracy_benchmark,
+}
+
+
+def main(names=None):
+    """Run benchmarks by name (all by default) and print the results as JSON."""
+    results = {
+        'python': platform.python_version(), 'lookups': LOOKUPS, 'countries': COUNTRIES ** 2, 'vertices': VERTICES,
+        'grid': util.geodecoding.INDEX_GRID, 'margin': util.geodecoding.BORDER_MARGIN, 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,229 @@
+"""
+Benchmarks for logger module.
+Run with `python -m benchmarks.logger_benchmark [benchmark ...]`, results are printed as JSON.
+"""
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import util.logger
+
+RECORDS = int(os.environ.get('PAKET_BENCHMARK_RECORDS', 100000))
+# Number of calls individually timed and traced for latency and allocation measurements.
+SAMPLES = int(os.environ.get('PAKET_BENCHMARK_SAMPLES', 10000))
+THREADS = int(os.environ.get('PAKET_BENCHMARK_THREADS', 4))
+
+
+class CountingFileIO(io.FileIO):
+    """Raw file counting its writes, each of which is a write syscall."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+class DiscardHandler(logging.Handler):
+    """Handler that filters records and discards them."""
+
+    def emit(self, record):
+        pass
+
+
+def benchmark_logger(handler):
+    """Get an isolated logger writing to handler only."""
+    logger = logging.getLogger('pkt.benchmark')
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+@contextlib.contextmanager
+def configured_logger(level=logging.DEBUG, **setup_kwargs):
+    """Get a logger using the handlers of util.logger.setup, writing to a temporary directory and to devnull."""
+    original_log_dir = util.logger.LOG_DIR_NAME
+    with tempfile.TemporaryDirectory() as log_dir, open(os.devnull, 'w') as devnull:
+        util.logger.LOG_DIR_NAME = log_dir
+        try:
+            util.logger.setup(**setup_kwargs)
+            listener = util.logger.SETUP['listener']
+            handlers = listener.handlers if listener else logging.getLogger().handlers
+            for handler in handlers:
+                if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+                    handler.setStream(devnull)
+            logger = logging.getLogger('pkt.benchmark.configured')
+            logger.setLevel(level)
+            yield logger
+        finally:
+            util.logger.shutdown()
+            for handler in logging.getLogger().handlers:
+                handler.close()
+            logging.getLogger().handlers = []
+            util.logger.LOG_DIR_NAME = original_log_dir
+
+
+def percentile(sorted_values, fraction):
+    """Get a percentile of sorted values."""
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def measure(log_call, records=RECORDS, samples=SAMPLES):
+    """
+    Measure a logging call, given the record index.
+    Throughput is measured over records calls, latency and allocations over samples separately timed calls.
+    Allocations are the peak of memory traced during a call and the blocks still allocated after all calls.
+    """
+    start = time.perf_counter()
+    for index in range(records):
+        log_call(index)
+    records_per_second = records / (time.perf_counter() - start)
+
+    latencies = []
+    for index in range(samples):
+        call_start = time.perf_counter_ns()
+        log_call(index)
+        latencies.append(time.perf_counter_ns() - call_start)
+    latencies.sort()
+
+    peak_bytes = 0
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        for index in range(samples):
+            tracemalloc.reset_peak()
+            current_bytes = tracemalloc.get_traced_memory()[0]
+            log_call(index)
+            peak_bytes += tracemalloc.get_traced_memory()[1] - current_bytes
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks
+
+    return {
+        'records_per_second': round(records_per_second),
+        'p50_latency_us': round(percentile(latencies, 0.5) / 1000, 3),
+        'p99_latency_us': round(percentile(latencies, 0.99) / 1000, 3),
+        'peak_bytes_per_record': round(peak_bytes / samples, 1),
+        'retained_blocks_per_record': round(retained_blocks / samples, 3)}
+
+
+def configured_benchmark(message_args=True, level=logging.DEBUG, **setup_kwargs):
+    """Measure logging through the handlers of util.logger.setup, with %-args or a pre-formatted message."""
+    with configured_logger(level, **setup_kwargs) as logger:
+        if message_args:
+            return measure(lambda index: logger.debug('benchmark record %s of %s', index, 'configured'))
+        return measure(lambda index: logger.debug('benchmark record {} of {}'.format(index, 'configured')))
+
+
+def threads_benchmark(threads=THREADS, records=RECORDS, **setup_kwargs):
+    """Measure total records per second of several threads logging through the handlers of util.logger.setup."""
+    with configured_logger(**setup_kwargs) as logger:
+        def produce():
+            for index in range(records // threads):
+                logger.debug('benchmark record %s of %s', index, threading.get_ident())
+
+        producers = [threading.Thread(target=produce) for _ in range(threads)]
+        start = time.perf_counter()
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        util.logger.shutdown()
+        elapsed = time.perf_counter() - start
+    return {'threads': threads, 'records_per_second': round(records // threads * threads / elapsed)}
+
+
+def context_benchmark(context_filter=True, **fields):
+    """Measure the overhead of the context filter, with and without bound fields."""
+    handler = DiscardHandler()
+    if context_filter:
+        handler.addFilter(util.logger.add_context)
+    logger = benchmark_logger(handler)
+    with util.logger.bind(**fields) if fields else contextlib.suppress():
+        return measure(lambda index: logger.debug('benchmark record %s', index))
+
+
+def file_handler_benchmark(handler_class, records=RECORDS, **kwargs):
+    """Measure records per second and write syscalls per record of a file handler class."""
+    with tempfile.TemporaryDirectory() as log_dir:
+        handler = handler_class(os.path.join(log_dir, 'benchmark.log'), **kwargs)
+        handler.setFormatter(logging.Formatter(util.logger.FORMAT, util.logger.DATE_FORMAT))
+        handler.addFilter(util.logger.add_context)
+        handler.stream.close()
+        raw_file = CountingFileIO(handler.baseFilename, 'a')
+        handler.stream = io.TextIOWrapper(io.BufferedWriter(raw_file), encoding='utf-8')
+        logger = benchmark_logger(handler)
+
+        start = time.perf_counter()
+        for index in range(records):
+            logger.debug('benchmark record %s', index)
+        handler.flush()
+        elapsed = time.perf_counter() - start
+
+        handler.close()
+    return {'records_per_second': round(records / elapsed), 'syscalls_per_record': raw_file.writes / records}
+
+
+def naive_json_format(record):
+    """Format a record as JSON the straightforward way, by building a dict per record."""
+    return json.dumps({
+        'timestamp': logging.Formatter.formatTime(logging.Formatter(), record, util.logger.DATE_FORMAT),
+        'level': record.levelname, 'name': record.name, 'lineno': record.lineno, 'message': record.getMessage()})
+
+
+def formatter_benchmark(format_function, records=RECORDS):
+    """Measure records per second formatted by a format function."""
+    logger = logging.getLogger('pkt.benchmark')
+    log_records = [
+        logger.makeRecord(logger.name, logging.INFO, __file__, index % 10, 'benchmark record %s', (index,), None)
+        for index in range(records)]
+    for record in log_records:
+        util.logger.add_context(record)
+    start = time.perf_counter()
+    for record in log_records:
+        format_function(record)
+    return {'records_per_second': round(records / (time.perf_counter() - start))}
+
+
+BENCHMARKS = {
+    'configured': lambda: configured_benchmark(log_to_stream=True, async_mode=False),
+    'configured_preformatted': lambda: configured_benchmark(False, log_to_stream=True, async_mode=False),
+    'configured_file_only': lambda: configured_benchmark(log_to_stream=False, async_mode=False),
+    'configured_async': lambda: configured_benchmark(log_to_stream=True, async_mode=True),
+    'disabled_level': lambda: configured_benchmark(level=logging.INFO, log_to_stream=True, async_mode=False),
+    'threads': lambda: threads_benchmark(log_to_stream=True, async_mode=False),
+    'threads_async': lambda: threads_benchmark(log_to_stream=True, async_mode=True),
+    'no_context_filter': lambda: context_benchmark(False),
+    'context_unbound': context_benchmark,
+    'context_bound': lambda: context_benchmark(request_id='0123456789abcdef', user='benchmark'),
+    'file_handler': lambda: file_handler_benchmark(logging.FileHandler),
+    'buffered_file_handler': lambda: file_handler_benchmark(util.logger.BufferedFileHandler),
+    'colored_formatter': lambda: formatter_benchmark(util.logger.colored_formatter().format),
+    'text_formatter': lambda: formatter_benchmark(
+        logging.Formatter(util.logger.FORMAT, util.logger.DATE_FORMAT).format),
+    'json_formatter': lambda: formatter_benchmark(util.logger.JsonFormatter(util.logger.DATE_FORMAT).format),
+    'naive_json_formatter': lambda: formatter_benchmark(naive_json_format),
+}
+
+
+def main(names=None):
+    """Run benchmarks by name (all by default) and print the results as JSON."""
+    results = {'python': platform.python_version(), 'records': RECORDS, 'samples': SAMPLES, 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
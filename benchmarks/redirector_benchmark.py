@@ -0,0 +1,197 @@
+"""
+Load test of the redirector, with a deliberately slow fake countly server.
+Run with `python -m benchmarks.redirector_benchmark [benchmark ...]`, results are printed as JSON.
+"""
+import asyncio
+import http.server
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import util.countly
+import util.logger
+import util.redirector
+
+REQUESTS = int(os.environ.get('PAKET_BENCHMARK_REQUESTS', 2000))
+THREADS = int(os.environ.get('PAKET_BENCHMARK_THREADS', 8))
+# Seconds the fake countly server takes to respond.
+COUNTLY_DELAY = float(os.environ.get('PAKET_BENCHMARK_COUNTLY_DELAY', 0.2))
+QUERY_STRING = 'target=https%3A%2F%2Fpaket.global&source=benchmark'
+LINK_QUERY_STRING = 'link=https%3A%2F%2Fpaket.global&source=benchmark'
+
+
+class SlowCountlyHandler(http.server.BaseHTTPRequestHandler):
+    """Respond to countly requests after COUNTLY_DELAY seconds."""
+
+    def respond(self):
+        """Read the request and respond slowly."""
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(COUNTLY_DELAY)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"result":"Success"}')
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *_):
+        """Don't log requests to stderr."""
+
+
+class SlowCountly:
+    """Context manager running a slow fake countly server, and pointing util.countly at it."""
+
+    def __init__(self):
+        self.server = None
+        self.original_url = self.original_dispatcher = None
+
+    def __enter__(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowCountlyHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/i'.format(self.server.server_address[1])
+        self.original_url, self.original_dispatcher = util.countly.COUNTLY_URL, util.countly.SHARED['dispatcher']
+        util.countly.COUNTLY_URL = url
+        util.countly.SHARED['dispatcher'] = util.countly.EventDispatcher(url)
+        return self
+
+    def __exit__(self, *exc_info):
+        util.countly.SHARED['dispatcher'].close(0)
+        util.countly.COUNTLY_URL, util.countly.SHARED['dispatcher'] = self.original_url, self.original_dispatcher
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def percentile(sorted_values, fraction):
+    """Get a percentile of sorted values."""
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def latency_stats(latencies, elapsed):
+    """Summarize request latencies, in nanoseconds, throughput and events the dispatcher merged or dropped."""
+    latencies.sort()
+    counts = util.countly.SHARED['dispatcher'].counts
+    return {
+        'requests_per_second': round(len(latencies) / elapsed),
+        'p50_latency_us': round(percentile(latencies, 0.5) / 1000, 3),
+        'p99_latency_us': round(percentile(latencies, 0.99) / 1000, 3),
+        'max_latency_us': round(latencies[-1] / 1000, 3),
+        'merged_events': counts['merged'], 'dropped_events': counts['dropped'] + counts['timed_out']}
+
+
+def blocking_application(env, start_response):
+    """The redirector as it was, sending each event to countly before responding."""
+    kwargs = urllib.parse.parse_qs(env['QUERY_STRING'])
+    util.countly.send_countly_event('redirect', 1, **kwargs)
+    start_response('302 Found', [('Location', kwargs['target'][0])])
+    return b''
+
+
+def previous_application(env, start_response):
+    """The redirector before pages were precomputed and queries parsed lean."""
+    with util.logger.bind(request_id=env.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex):
+        kwargs = urllib.parse.parse_qs(env['QUERY_STRING'])
+        if 'target' in kwargs:
+            target = kwargs['target'][0]
+            util.redirector.track_redirect(kwargs)
+            start_response('302 Found', [('Location', target)])
+            return b''
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        if not {'link', 'source'} - set(kwargs.keys()):
+            query_string = urllib.parse.urlencode({'target': kwargs['link'][0], 'source': kwargs['source'][0]})
+            return "{head}<a href='/linker?{query}'>https://c.paket.global/linker?{query}</a>{tail}".format(
+                head=util.redirector.HTML_HEAD, query=query_string, tail=util.redirector.HTML_TAIL).encode()
+        return "{}{}{}".format(
+            util.redirector.HTML_HEAD, util.redirector.HTML_FORM, util.redirector.HTML_TAIL).encode()
+
+
+def worker_benchmark(application, query_string, requests=REQUESTS * 10):
+    """Measure requests per second of a WSGI application in a single worker."""
+    env = {'QUERY_STRING': query_string, 'HTTP_X_REQUEST_ID': 'benchmark'}
+    with SlowCountly():
+        start = time.perf_counter()
+        for _ in range(requests):
+            application(env, lambda status, headers: None)
+        return {'requests_per_second': round(requests / (time.perf_counter() - start))}
+
+
+def wsgi_benchmark(application, requests=REQUESTS, threads=THREADS):
+    """
+    Measure redirect latency of a WSGI application called by several threads, like uwsgi workers.
+    Threads compete for the GIL, unlike uwsgi worker processes, which inflates tail latencies.
+    """
+    latencies = []
+
+    def worker():
+        for _ in range(requests // threads):
+            start = time.perf_counter_ns()
+            application({'QUERY_STRING': QUERY_STRING}, lambda status, headers: None)
+            latencies.append(time.perf_counter_ns() - start)
+
+    with SlowCountly():
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return latency_stats(latencies, time.perf_counter() - start)
+
+
+def asgi_benchmark(requests=REQUESTS, concurrency=THREADS * 8):
+    """Measure redirect latency of the ASGI application, with concurrent requests on one event loop."""
+    latencies = []
+    scope = {'type': 'http', 'query_string': QUERY_STRING.encode(), 'headers': []}
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(_message):
+        pass
+
+    async def client():
+        for _ in range(requests // concurrency):
+            start = time.perf_counter_ns()
+            await util.redirector.asgi_application(scope, receive, send)
+            latencies.append(time.perf_counter_ns() - start)
+            await asyncio.sleep(0)
+
+    async def run_clients():
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    with SlowCountly():
+        start = time.perf_counter()
+        asyncio.run(run_clients())
+        return latency_stats(latencies, time.perf_counter() - start)
+
+
+BENCHMARKS = {
+    # Few requests, since each waits for the slow countly server.
+    'wsgi_blocking': lambda: wsgi_benchmark(blocking_application, requests=THREADS * 10),
+    'wsgi': lambda: wsgi_benchmark(util.redirector.application),
+    'asgi': asgi_benchmark,
+    'worker_form_previous': lambda: worker_benchmark(previous_application, ''),
+    'worker_form': lambda: worker_benchmark(util.redirector.application, ''),
+    'worker_link_previous': lambda: worker_benchmark(previous_application, LINK_QUERY_STRING),
+    'worker_link': lambda: worker_benchmark(util.redirector.application, LINK_QUERY_STRING),
+    'worker_redirect_previous': lambda: worker_benchmark(previous_application, QUERY_STRING),
+    'worker_redirect': lambda: worker_benchmark(util.redirector.application, QUERY_STRING),
+}
+
+
+def main(names=None):
+    """Run benchmarks by name (all by default) and print the results as JSON."""
+    results = {
+        'python': platform.python_version(), 'requests': REQUESTS, 'threads': THREADS,
+        'countly_delay': COUNTLY_DELAY, 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        results['benchmarks'][name] = BENCHMARKS[name]()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+"""Tests for async_db module."""
+import asyncio
+import time
+from unittest import mock
+
+import mysql.connector
+
+import util.async_db
+import util.db
+from tests.db_test import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, FakeConnectorTest
+
+
+class TestAsyncDB(FakeConnectorTest):
+    """Tests for async db, against fake connections that take a while to execute statements."""
+
+    def setUp(self):
+        super().setUp()
+        self.sql = util.async_db.custom_async_sql_connection(
+            DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, size=5, wait_timeout=1)
+        self.pool = self.sql.args[0]
+        self.addCleanup(asyncio.run, self.pool.close())
+
+    async def query(self, statement='SELECT 1'):
+        """Execute a statement and fetch its rows."""
+        async with self.sql() as sql:
+            await sql.execute(statement)
+            return await sql.fetchall()
+
+    def test_concurrency(self):
+        """Queries run concurrently up to pool size, without blocking the event loop."""
+        self.connection_delay = 0.1
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def run_queries():
+            ticker = asyncio.ensure_future(tick())
+            start = time.monotonic()
+            await asyncio.gather(*(self.query() for _ in range(20)))
+            ticker.cancel()
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(run_queries())
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(len(self.connections), 5)
+        self.assertEqual(sum(connection.calls['commit'] for connection in self.connections), 20)
+        self.assertGreater(len(ticks), 20)
+        self.assertLess(max(later - earlier for earlier, later in zip(ticks, ticks[1:])), 0.1)
+
+    def test_event_loops(self):
+        """Pools can be used by successive event loops."""
+        self.connection_delay = 0.01
+
+        async def run_queries():
+            return await asyncio.wait_for(asyncio.gather(*(self.query() for _ in range(10))), 1)
+
+        for _ in range(2):
+            asyncio.run(run_queries())
+        self.assertEqual(sum(connection.calls['commit'] for connection in self.connections), 20)
+
+    def test_exceptions(self):
+        """Data errors are translated, and connections are rolled back and reused on exceptions."""
+        async def run_failures():
+            with self.assertRaises(ValueError):
+                async with self.sql():
+                    raise ValueError('failure')
+            self.connections[0].preset.error = mysql.connector.DataError(
+                "1406 (22001): Data too long for column 'name' at row 1")
+            with self.assertRaisesRegex(util.db.DataTooBig, 'name'):
+                await self.query('INSERT INTO test (name) VALUES ("long")')
+
+        asyncio.run(run_failures())
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].calls['rollback'], 2)
+        self.assertEqual(self.connections[0].calls['commit'], 0)
+
+    def test_commit_data_error(self):
+        """Data errors of commits are translated too."""
+        async def run_commit():
+            await self.query()
+            with mock.patch.object(self.connections[0], 'commit', side_effect=mysql.connector.DataError(
+                    "1264 (22003): Out of range value for column 'amount' at row 1")):
+                with self.assertRaisesRegex(util.db.DataTooBig, 'amount'):
+                    await self.query()
+
+        asyncio.run(run_commit())
+        self.assertEqual(self.connections[0].calls['rollback'], 1)
+
+    def test_cancel(self):
+        """Cancelled queries, running or waiting for a connection, give back their connections."""
+        self.connection_delay = 0.1
+
+        async def run_cancelled():
+            tasks = [asyncio.ensure_future(self.query()) for _ in range(10)]
+            await asyncio.sleep(0.05)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.sleep(0.2)
+            self.connection_delay = 0
+            for connection in self.connections:
+                connection.preset.delay = 0
+            return await asyncio.wait_for(asyncio.gather(*(self.query() for _ in range(5))), 1)
+
+        self.assertEqual(len(asyncio.run(run_cancelled())), 5)
+        self.assertEqual(len(self.pool.pool.idle), 5)
+        self.assertEqual(len(self.connections), 5)
+
+    def test_helpers(self):
+        """Tables are cleared and dropped like in util.db, and columns share its schema cache."""
+        async def run_helpers():
+            await util.async_db.clear_tables(self.sql, 'paket', truncate=True)
+            await util.async_db.drop_tables(self.sql, 'paket')
+            self.connections[0].preset.rows = [{
+                'COLUMN_NAME': 'id', 'DATA_TYPE': 'int', 'COLUMN_TYPE': 'int(11)', 'CHARACTER_MAXIMUM_LENGTH': None}]
+            return await util.async_db.get_table_columns(self.sql, 'paket', 'test')
+
+        self.connection_rows = [{'TABLE_NAME': 'test'}]
+        util.db.SCHEMA_CACHE.invalidate()
+        self.addCleanup(util.db.SCHEMA_CACHE.invalidate)
+        self.assertEqual(asyncio.run(run_helpers()), ['id'])
+        self.assertEqual([statement for statement, _ in self.connections[0].statements[1:4]], [
+            'SET FOREIGN_KEY_CHECKS = 0', 'TRUNCATE TABLE `paket`.`test`', 'SET FOREIGN_KEY_CHECKS = 1'])
+        self.assertEqual(self.connections[0].statements[-3][0], 'DROP TABLE `paket`.`test`')
+        self.assertEqual(util.db.get_table_columns(None, 'paket', 'test'), ['id'])
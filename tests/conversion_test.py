@@ -1,7 +1,9 @@
 """Tests for conversion module."""
 import unittest
+from unittest import mock
 
 import util.conversion
+import util.logger
 
 
 class TestBaseConversion(unittest.TestCase):
@@ -194,3 +196,26 @@ class EuroToBulStellarConversion(unittest.TestCase):
         ]
         self.euro_to_stellar(data_set, util.conversion.euro_cents_to_xlm_stroops,
                              "{} XLM stroops expected, {} got instead")
+
+
+class PrecisionLossWarnings(unittest.TestCase):
+    """Test rate limiting of precision loss warnings."""
+
+    def test_rate_limit(self):
+        """Bulk conversions emit a limited number of warnings."""
+        rate_limit = util.logger.RateLimitFilter(rate=3, period=60)
+        with mock.patch.object(util.conversion, 'PRECISION_LOSS', rate_limit), \
+                mock.patch.object(util.conversion.LOGGER, 'filters', [rate_limit]), \
+                self.assertLogs(util.conversion.LOGGER.name) as log_capture:
+            for amount in range(100):
+                util.conversion.xlm_to_euro_cents(amount, '0.2345')
+                util.conversion.euro_cents_to_xlm_stroops(amount, '0.2345')
+        self.assertEqual(len(log_capture.output), 6)
+
+    def test_disabled(self):
+        """The rate limit is not checked when warnings are disabled."""
+        self.addCleanup(util.conversion.LOGGER.setLevel, util.conversion.LOGGER.level)
+        util.conversion.LOGGER.setLevel(util.logger.logging.ERROR)
+        with mock.patch.object(util.conversion.PRECISION_LOSS, 'allows') as allows:
+            util.conversion.xlm_to_euro_cents(1, '0.2345')
+        allows.assert_not_called()
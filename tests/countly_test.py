@@ -1,5 +1,11 @@
 """Tests for countly module."""
+import http.server
+import json
+import multiprocessing
+import threading
+import time
 import unittest
+import urllib.parse
 
 import util.countly
 import util.logger
@@ -17,3 +23,156 @@ class TestCountly(unittest.TestCase):
             # we have 3 logger outputs on success request
             self.assertEqual(len(log_capture.output), 3)
             self.assertIn('{"result":"Success"}', log_capture.output[2])
+
+
+class FakeCountlyHandler(http.server.BaseHTTPRequestHandler):
+    """Record posted events, failing the first requests as configured on the server."""
+
+    def record(self):
+        """Record a batch of events."""
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.requests.append(form)
+        self.server.release.wait(5)
+        if len(self.server.requests) <= self.server.failures:
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.server.events.extend(json.loads(form['events'][0]))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"result":"Success"}')
+
+    do_POST = record
+
+    def log_message(self, *_):
+        """Don't log requests to stderr."""
+
+
+class TestEventDispatcher(unittest.TestCase):
+    """Tests for background event dispatching, against a local fake countly server."""
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeCountlyHandler)
+        self.server.requests, self.server.events, self.server.failures = [], [], 0
+        self.server.release = threading.Event()
+        self.server.release.set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.release.set)
+        self.url = 'http://127.0.0.1:{}/i'.format(self.server.server_address[1])
+
+    def dispatcher(self, **kwargs):
+        """Create a dispatcher sending to the fake server."""
+        dispatcher = util.countly.EventDispatcher(self.url, **dict({'flush_interval': 60, 'backoff': 0.01}, **kwargs))
+        self.addCleanup(dispatcher.close, 5)
+        return dispatcher
+
+    def test_batches(self):
+        """Events are sent in batches of batch size, and the rest on close."""
+        dispatcher = self.dispatcher(batch_size=3)
+        for index in range(7):
+            dispatcher.add(util.countly.create_event('test_event', 1, index=index))
+        dispatcher.close(5)
+        self.assertEqual([len(json.loads(form['events'][0])) for form in self.server.requests], [3, 3, 1])
+        self.assertEqual([event['segmentation']['index'] for event in self.server.events], list(range(7)))
+        self.assertEqual(self.server.requests[0]['app_key'], [util.countly.APP_KEY])
+
+    def test_interval_and_flush(self):
+        """Events are sent after the flush interval, or when flushed."""
+        dispatcher = self.dispatcher(flush_interval=0.1, aggregate=False)
+        dispatcher.add(util.countly.create_event('test_event', 1))
+        dispatcher.add(util.countly.create_event('test_event', 2))
+        deadline = time.monotonic() + 5
+        while len(self.server.events) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.requests), 1)
+
+        dispatcher.settings = dispatcher.settings._replace(flush_interval=60)
+        dispatcher.flush(0.5)
+        dispatcher.add(util.countly.create_event('test_event', 3))
+        dispatcher.flush(5)
+        self.assertEqual([event['count'] for event in self.server.events], [1, 2, 3])
+
+    def test_overflow(self):
+        """Events beyond queue size are dropped by the overflow policy."""
+        for overflow_policy, expected_counts, dropped in (
+                ('drop-oldest', [0, 3, 4], 1 + 2), ('drop-newest', [0, 1, 2], 3 + 4)):
+            self.server.events.clear()
+            self.server.requests.clear()
+            self.server.release.clear()
+            dispatcher = self.dispatcher(
+                batch_size=1, queue_size=2, overflow_policy=overflow_policy, aggregate=False)
+            dispatcher.add(util.countly.create_event('test_event', 0))
+            deadline = time.monotonic() + 5
+            while not self.server.requests and time.monotonic() < deadline:
+                time.sleep(0.01)
+            for count in range(1, 5):
+                dispatcher.add(util.countly.create_event('test_event', count))
+            self.server.release.set()
+            dispatcher.close(5)
+            self.assertEqual(dispatcher.counts['dropped'], dropped)
+            self.assertEqual([event['count'] for event in self.server.events], expected_counts)
+
+    def test_retries(self):
+        """Failed batches are retried, and dropped after all retries fail."""
+        self.server.failures = 2
+        dispatcher = self.dispatcher(retries=2)
+        dispatcher.add(util.countly.create_event('test_event', 1))
+        dispatcher.flush(5)
+        self.assertEqual((len(self.server.requests), len(self.server.events), dispatcher.counts['failed']), (3, 1, 0))
+
+        self.server.failures = 10
+        with self.assertLogs('pkt.util', 'ERROR'):
+            dispatcher.add(util.countly.create_event('test_event', 2))
+            dispatcher.flush(5)
+        self.assertEqual((len(self.server.requests), len(self.server.events), dispatcher.counts['failed']), (6, 1, 2))
+
+    def test_aggregation(self):
+        """Events differing only in count and dur are merged, summing them."""
+        dispatcher = self.dispatcher(batch_size=3)
+        for index in range(1000):
+            dispatcher.add(util.countly.create_event('redirect', 1, source=['source{}'.format(index % 2)]))
+        dispatcher.add(util.countly.create_event('redirect', 2, dur=1.5, source=['source0']))
+        dispatcher.add(util.countly.create_event('redirect', 1, dur=0.5, source=['source0']))
+        dispatcher.add(util.countly.create_event('redirect', 1, timestamp=1, source=['source0']))
+        dispatcher.close(5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.events, [
+            {'key': 'redirect', 'count': 503, 'dur': 2.0, 'segmentation': {'source': ['source0']}},
+            {'key': 'redirect', 'count': 500, 'segmentation': {'source': ['source1']}},
+            {'key': 'redirect', 'count': 1, 'timestamp': 1, 'segmentation': {'source': ['source0']}}])
+        self.assertEqual(dispatcher.counts['merged'], 1000)
+
+    def test_fork(self):
+        """Forked processes send events over sessions of their own."""
+        dispatcher = self.dispatcher()
+        dispatcher.add(util.countly.create_event('parent', 1))
+        # Sent before forking, so the parent's thread has a pooled connection and is idle.
+        dispatcher.flush(5)
+        parent_session = util.countly.session()
+
+        def send_from_child():
+            dispatcher.add(util.countly.create_event('child', 1))
+            dispatcher.close(5)
+            if util.countly.session() is parent_session:
+                raise AssertionError("the child uses the parent's session")
+
+        process = multiprocessing.get_context('fork').Process(target=send_from_child)
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        self.assertIs(util.countly.session(), parent_session)
+        dispatcher.close(5)
+        self.assertEqual(sorted(event['key'] for event in self.server.events), ['child', 'parent'])
+
+    def test_aggregated_losses(self):
+        """Dropping a merged event counts all the events merged into it."""
+        dispatcher = self.dispatcher(queue_size=1)
+        for _ in range(3):
+            dispatcher.add(util.countly.create_event('redirect', 1, source=['first']))
+        dispatcher.add(util.countly.create_event('redirect', 1, source=['second']))
+        self.assertEqual((dispatcher.counts['merged'], dispatcher.counts['dropped']), (2, 3))
+        dispatcher.close(5)
+        dispatcher.add(util.countly.create_event('redirect', 2))
+        self.assertEqual(dispatcher.counts['dropped'], 5)
@@ -1,6 +1,14 @@
 """Tests for db module."""
+import collections
+import functools
 import os
+import threading
+import time
+import types
 import unittest
+from unittest import mock
+
+import mysql.connector
 
 import util.db
 import util.logger
@@ -52,6 +60,57 @@ class TestDB(unittest.TestCase):
         with self.assertRaises(ReferenceError):
             sql.fetchone()
 
+    def fill_tables(self, rows):
+        """
+        Create parent and child tables linked by a foreign key, with rows in each. Truncating parent fails unless
+        foreign key checks are disabled, deleting its rows deletes those of child in any order.
+        """
+        with self.sql() as sql:
+            sql.execute('CREATE TABLE parent(id INTEGER PRIMARY KEY)')
+            sql.execute('''
+                CREATE TABLE child(
+                    id INTEGER PRIMARY KEY, parent_id INTEGER,
+                    FOREIGN KEY (parent_id) REFERENCES parent(id) ON DELETE CASCADE)''')
+        util.db.bulk_insert(self.sql, 'parent', ({'id': index} for index in range(rows)))
+        util.db.bulk_insert(self.sql, 'child', ({'id': index, 'parent_id': index} for index in range(rows)))
+
+    def count_rows(self):
+        """Count rows of parent and child tables."""
+        with self.sql() as sql:
+            sql.execute('SELECT (SELECT COUNT(*) FROM parent) AS parents, (SELECT COUNT(*) FROM child) AS children')
+            return sql.fetchall()[0]
+
+    def test_clear_tables(self):
+        """Compare clearing tables by deleting and by truncating"""
+        timings = {}
+        for truncate in (False, True):
+            self.fill_tables(10000)
+            start = time.perf_counter()
+            util.db.clear_tables(self.sql, DB_NAME, truncate=truncate)
+            timings[truncate] = time.perf_counter() - start
+            self.assertEqual(self.count_rows(), {'parents': 0, 'children': 0})
+            util.db.drop_tables(self.sql, DB_NAME)
+        LOGGER.info('clearing 20000 rows took %.3fs deleting, %.3fs truncating', timings[False], timings[True])
+
+    def test_snapshot(self):
+        """Restore tables from a snapshot, and compare with refilling them"""
+        start = time.perf_counter()
+        self.fill_tables(1000)
+        fill_time = time.perf_counter() - start
+        util.db.snapshot_tables(self.sql, DB_NAME)
+        self.addCleanup(self.drop_snapshot)
+        util.db.clear_tables(self.sql, DB_NAME, truncate=True)
+        start = time.perf_counter()
+        util.db.restore_tables(self.sql, DB_NAME)
+        restore_time = time.perf_counter() - start
+        self.assertEqual(self.count_rows(), {'parents': 1000, 'children': 1000})
+        LOGGER.info('filling 2000 rows took %.3fs, restoring them %.3fs', fill_time, restore_time)
+
+    def drop_snapshot(self):
+        """Drop the snapshot database."""
+        with self.sql() as sql:
+            sql.execute('DROP DATABASE IF EXISTS {}_snapshot'.format(DB_NAME))
+
     def test_closing_on_exception(self):
         """Test closing connection on exception"""
         # YARIK, why doesn't this use self.assertRaises?
@@ -69,3 +128,462 @@ class TestDB(unittest.TestCase):
             LOGGER.info('attempting operation after raising exception')
             with self.assertRaises(ReferenceError):
                 sql.fetchone()
+
+
+class FakeCursor:
+    """Cursor of FakeConnection, recording statements and returning preset rows."""
+
+    def __init__(self, connection, **options):
+        self.connection = connection
+        self.options = options
+        self.rows = []
+
+    def execute(self, operation, params=None):
+        """Record a statement, raising the preset error of the connection if any."""
+        if not self.connection.connected:
+            raise mysql.connector.OperationalError('connection lost')
+        time.sleep(self.connection.preset.delay)
+        if self.connection.preset.error is not None:
+            raise self.connection.preset.error
+        self.connection.statements.append((operation, params))
+        self.rows = list(self.connection.preset.rows)
+
+    def fetchall(self):
+        """Return preset rows."""
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        """Return the next preset row."""
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        """Return up to size preset rows."""
+        self.connection.calls['fetchmany'] += 1
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    @property
+    def column_names(self):
+        """Preset column names of rows."""
+        return self.connection.preset.column_names
+
+    def close(self):
+        """Close the cursor."""
+        self.connection.calls['close_cursor'] += 1
+
+
+class FakeConnection:
+    """
+    Stand-in for a mysql connection, counting calls of its methods and of its cursors.
+    Its statements behave as preset: they take preset.delay seconds, raise preset.error if any, and return
+    preset.rows with preset.column_names.
+    """
+
+    def __init__(self, preset, **connect_kwargs):
+        self.preset = preset
+        self.connect_kwargs = connect_kwargs
+        self.connected = True
+        self.statements = []
+        self.cursor_options = []
+        self.isolation_level = None
+        self.calls = collections.Counter()
+
+    def cursor(self, **options):
+        """Create a cursor."""
+        self.cursor_options.append(options)
+        return FakeCursor(self, **options)
+
+    def start_transaction(self, isolation_level=None):
+        """Record isolation level."""
+        self.isolation_level = isolation_level
+
+    def commit(self):
+        """Count commits."""
+        self.calls['commit'] += 1
+
+    def rollback(self):
+        """Count rollbacks."""
+        if not self.connected:
+            raise mysql.connector.OperationalError('connection lost')
+        self.calls['rollback'] += 1
+
+    def is_connected(self):
+        """Check connection health."""
+        return self.connected
+
+    def close(self):
+        """Close the connection."""
+        self.connected = False
+
+
+class FakeConnectorTest(unittest.TestCase):
+    """Base class for tests using a fake mysql connector."""
+
+    def setUp(self):
+        self.connections = []
+        self.connection_delay = 0
+        self.connection_error = None
+        self.connection_rows = []
+        self.connection_column_names = ()
+        connect = mock.patch('mysql.connector.connect', side_effect=self.connect)
+        connect.start()
+        self.addCleanup(connect.stop)
+
+    def connect(self, **connect_kwargs):
+        """Create a fake connection."""
+        connection = FakeConnection(types.SimpleNamespace(
+            delay=self.connection_delay, error=self.connection_error, rows=self.connection_rows,
+            column_names=self.connection_column_names), **connect_kwargs)
+        self.connections.append(connection)
+        return connection
+
+
+class TestConnectionPool(FakeConnectorTest):
+    """Tests for connection pooling."""
+
+    def test_reuse(self):
+        """Connections are reused and committed like in sql_connection."""
+        sql = util.db.custom_pooled_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, size=2)
+        for _ in range(3):
+            with sql() as cursor:
+                cursor.execute('SELECT 1')
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].calls['commit'], 3)
+        self.assertEqual(self.connections[0].connect_kwargs['database'], DB_NAME)
+
+    def test_exceptions(self):
+        """Connections are rolled back and returned on exceptions, and closed if broken."""
+        pool = util.db.ConnectionPool(size=1, wait_timeout=0.1)
+        with self.assertRaises(ValueError):
+            with util.db.pooled_sql_connection(pool):
+                raise ValueError('failure')
+        self.assertEqual(self.connections[0].calls['rollback'], 1)
+
+        self.connections[0].preset.error = mysql.connector.DataError(
+            "1406 (22001): Data too long for column 'name' at row 1")
+        with self.assertRaises(util.db.DataTooBig):
+            with util.db.pooled_sql_connection(pool) as cursor:
+                cursor.execute('INSERT INTO test (name) VALUES (%s)', ('long',))
+        self.assertEqual(self.connections[0].calls['rollback'], 2)
+
+        self.connections[0].close()
+        with self.assertRaises(mysql.connector.OperationalError):
+            with util.db.pooled_sql_connection(pool) as cursor:
+                cursor.execute('SELECT 1')
+        with util.db.pooled_sql_connection(pool) as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(len(self.connections), 2)
+
+    def test_health_and_lifetime(self):
+        """Broken and expired connections are replaced."""
+        pool = util.db.ConnectionPool(size=1, health_check_after=0, max_lifetime=60, idle_timeout=60)
+        connection, created_at = pool.acquire()
+        pool.release(connection, created_at)
+        connection.close()
+        self.assertIsNot(pool.acquire()[0], connection)
+        self.assertEqual(len(self.connections), 2)
+        pool.release(self.connections[1], created_at - 61)
+        self.assertFalse(self.connections[1].connected)
+        connection, created_at = pool.acquire()
+        pool.release(connection, created_at)
+        pool.settings = pool.settings._replace(idle_timeout=0)
+        pool.acquire()
+        self.assertFalse(connection.connected)
+        self.assertEqual(len(self.connections), 4)
+
+    def test_expire_on_release(self):
+        """Connections idle for too long are closed when others are returned."""
+        pool = util.db.ConnectionPool(size=2, idle_timeout=0.05)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(*first)
+        time.sleep(0.1)
+        pool.release(*second)
+        self.assertFalse(first[0].connected)
+        self.assertEqual([connection for connection, _, _ in pool.idle], [second[0]])
+        self.assertEqual(pool.open_count, 1)
+
+    def test_wait_timeout(self):
+        """Checkout waits for a connection to be returned, up to a timeout."""
+        pool = util.db.ConnectionPool(size=1, wait_timeout=5)
+        connection, created_at = pool.acquire()
+        threading.Timer(0.1, pool.release, (connection, created_at)).start()
+        self.assertIs(pool.acquire()[0], connection)
+        pool.settings = pool.settings._replace(wait_timeout=0.1)
+        with self.assertRaises(util.db.PoolTimeout):
+            pool.acquire()
+
+
+class TestBulkInsert(FakeConnectorTest):
+    """Tests for bulk inserts."""
+
+    def setUp(self):
+        super().setUp()
+        self.sql = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+
+    def test_chunks(self):
+        """Rows are inserted in chunks of multi-row statements."""
+        rows = [{'id': index, 'number': index * 2} for index in range(5)]
+        stats = util.db.bulk_insert(self.sql, 'test', rows, chunk_size=2)
+        self.assertEqual((stats['rows'], stats['statements']), (5, 3))
+        statements = self.connections[0].statements
+        self.assertEqual(statements[0], (
+            'INSERT INTO `test` (`id`, `number`) VALUES (%s, %s), (%s, %s)', [0, 0, 1, 2]))
+        self.assertEqual(statements[2], ('INSERT INTO `test` (`id`, `number`) VALUES (%s, %s)', [4, 8]))
+        self.assertEqual(self.connections[0].calls['commit'], 1)
+
+    def test_packet_size_and_upsert(self):
+        """Statements are split before exceeding packet size, and can update existing rows."""
+        rows = ({'id': index, 'name': 'x' * 100} for index in range(4))
+        stats = util.db.bulk_insert(self.sql, 'test', rows, upsert=True, max_packet=600)
+        self.assertEqual(stats['statements'], 2)
+        self.assertTrue(all(statement.endswith(
+            ' ON DUPLICATE KEY UPDATE `id` = VALUES(`id`), `name` = VALUES(`name`)')
+                            for statement, _ in self.connections[0].statements))
+
+    def test_no_rows(self):
+        """Inserting no rows opens no connection."""
+        stats = util.db.bulk_insert(self.sql, 'test', iter(()))
+        self.assertEqual((stats['rows'], stats['statements'], self.connections), (0, 0, []))
+
+    def test_data_too_big(self):
+        """Oversized values raise DataTooBig naming the column."""
+        self.connection_error = mysql.connector.DataError("1406 (22001): Data too long for column 'name' at row 2")
+        with self.assertRaisesRegex(util.db.DataTooBig, 'name'):
+            util.db.bulk_insert(self.sql, 'test', [{'id': 1, 'name': 'x' * 1000}])
+
+
+class TestStreamQuery(FakeConnectorTest):
+    """Tests for streaming query results."""
+
+    def test_batches(self):
+        """Rows are fetched in batches from an unbuffered cursor."""
+        pool = util.db.ConnectionPool()
+        connection, created_at = pool.acquire()
+        connection.preset.rows = [(index,) for index in range(25)]
+        pool.release(connection, created_at)
+        rows = util.db.stream_query(
+            functools.partial(util.db.pooled_sql_connection, pool), 'SELECT id FROM test', batch_size=10,
+            row_type='tuple')
+        self.assertEqual(list(rows), connection.preset.rows)
+        self.assertEqual(connection.calls['fetchmany'], 4)
+        self.assertEqual(connection.cursor_options, [{'dictionary': False, 'buffered': False}])
+
+    def test_prepared(self):
+        """Rows of every type are streamed from prepared connections, which reject options they don't support."""
+        self.connection_rows = [(1, 'one'), (2, 'two')]
+        self.connection_column_names = ('id', 'name')
+        sql_connection = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, prepared=True)
+        for row_type, first_row in (
+                ('dict', {'id': 1, 'name': 'one'}), ('tuple', (1, 'one')), ('namedtuple', (1, 'one'))):
+            with self.subTest(row_type=row_type):
+                rows = list(util.db.stream_query(sql_connection, 'SELECT id, name FROM test', row_type=row_type))
+                self.assertEqual((len(rows), rows[0]), (2, first_row))
+                self.assertEqual(self.connections[-1].cursor_options, [{'prepared': True}])
+        self.assertEqual(rows[1].name, 'two')
+        with self.assertRaisesRegex(ValueError, 'buffered'):
+            with sql_connection(buffered=True):
+                pass
+
+
+class TestSchemaCache(FakeConnectorTest):
+    """Tests for schema metadata caching."""
+
+    def setUp(self):
+        super().setUp()
+        self.sql = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+        self.connection_rows = [
+            {'COLUMN_NAME': 'id', 'DATA_TYPE': 'tinyint', 'COLUMN_TYPE': 'tinyint(3) unsigned',
+             'CHARACTER_MAXIMUM_LENGTH': None},
+            {'COLUMN_NAME': 'name', 'DATA_TYPE': 'varchar', 'COLUMN_TYPE': 'varchar(4)',
+             'CHARACTER_MAXIMUM_LENGTH': 4}]
+        util.db.SCHEMA_CACHE.invalidate()
+        self.addCleanup(util.db.SCHEMA_CACHE.invalidate)
+
+    def test_cache(self):
+        """Columns are queried once until invalidated."""
+        self.assertEqual(util.db.get_table_columns(self.sql, DB_NAME, 'test'), ['id', 'name'])
+        self.assertEqual(util.db.get_table_columns(self.sql, DB_NAME, 'test'), ['id', 'name'])
+        self.assertEqual(len(self.connections), 1)
+        self.connection_rows = []
+        util.db.drop_tables(self.sql, DB_NAME)
+        with self.assertRaises(AssertionError):
+            util.db.get_table_columns(self.sql, DB_NAME, 'test')
+
+    def test_check_row_sizes(self):
+        """Values too big for their columns raise DataTooBig without a round trip."""
+        util.db.check_row_sizes(self.sql, DB_NAME, 'test', {'id': 255, 'name': 'four'})
+        with self.assertRaisesRegex(util.db.DataTooBig, 'name'):
+            util.db.check_row_sizes(self.sql, DB_NAME, 'test', {'id': 1, 'name': 'fives'})
+        with self.assertRaisesRegex(util.db.DataTooBig, 'id'):
+            util.db.check_row_sizes(self.sql, DB_NAME, 'test', {'id': 256})
+        with self.assertRaisesRegex(util.db.DataTooBig, 'id'):
+            util.db.check_row_sizes(self.sql, DB_NAME, 'test', {'id': -1})
+        self.assertEqual(len(self.connections), 1)
+
+
+class TestFastReset(FakeConnectorTest):
+    """Tests for fast clearing and dropping of tables."""
+
+    def setUp(self):
+        super().setUp()
+        self.sql = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+        self.connection_rows = [{'TABLE_NAME': 'parent'}, {'TABLE_NAME': 'child'}]
+
+    def executed(self):
+        """Statements executed by all connections."""
+        return [statement for connection in self.connections for statement, _ in connection.statements]
+
+    def listed_databases(self):
+        """Databases whose tables were listed, in order."""
+        return [params[0] for connection in self.connections for statement, params in connection.statements
+                if statement == util.db.TABLE_NAMES_QUERY]
+
+    def test_truncate(self):
+        """Tables are truncated with foreign key checks disabled."""
+        util.db.clear_tables(self.sql, 'paket')
+        util.db.clear_tables(self.sql, 'paket', truncate=True)
+        self.assertEqual(self.executed(), [
+            util.db.TABLE_NAMES_QUERY, 'DELETE from parent', 'DELETE from child',
+            'SET FOREIGN_KEY_CHECKS = 0', util.db.TABLE_NAMES_QUERY,
+            'TRUNCATE TABLE `paket`.`parent`', 'TRUNCATE TABLE `paket`.`child`',
+            'SET FOREIGN_KEY_CHECKS = 1'])
+        self.assertEqual(self.listed_databases(), ['paket', 'paket'])
+
+    def test_drop(self):
+        """Tables are dropped in a single statement."""
+        util.db.drop_tables(self.sql, 'paket')
+        self.assertEqual(self.executed(), [
+            util.db.TABLE_NAMES_QUERY,
+            'SET FOREIGN_KEY_CHECKS = 0', 'DROP TABLE `paket`.`parent`, `paket`.`child`', 'SET FOREIGN_KEY_CHECKS = 1'])
+        self.assertEqual(self.listed_databases(), ['paket'])
+
+    def test_snapshot(self):
+        """Snapshot copies tables to a snapshot database and restore copies them back."""
+        util.db.snapshot_tables(self.sql, 'paket')
+        util.db.restore_tables(self.sql, 'paket')
+        self.assertEqual(self.executed(), [
+            'DROP DATABASE IF EXISTS `paket_snapshot`', 'CREATE DATABASE `paket_snapshot`',
+            util.db.TABLE_NAMES_QUERY,
+            'CREATE TABLE `paket_snapshot`.`parent` LIKE `paket`.`parent`',
+            'INSERT INTO `paket_snapshot`.`parent` SELECT * FROM `paket`.`parent`',
+            'CREATE TABLE `paket_snapshot`.`child` LIKE `paket`.`child`',
+            'INSERT INTO `paket_snapshot`.`child` SELECT * FROM `paket`.`child`',
+            'SET FOREIGN_KEY_CHECKS = 0', util.db.TABLE_NAMES_QUERY,
+            'TRUNCATE TABLE `paket`.`parent`', 'INSERT INTO `paket`.`parent` SELECT * FROM `paket_snapshot`.`parent`',
+            'TRUNCATE TABLE `paket`.`child`', 'INSERT INTO `paket`.`child` SELECT * FROM `paket_snapshot`.`child`',
+            'SET FOREIGN_KEY_CHECKS = 1'])
+        self.assertEqual(self.listed_databases(), ['paket', 'paket_snapshot'])
+
+
+class TestInstrumentation(FakeConnectorTest):
+    """Tests for query instrumentation."""
+
+    def setUp(self):
+        super().setUp()
+        self.sql = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+        self.addCleanup(util.db.disable_instrumentation)
+
+    def test_disabled(self):
+        """Cursors are not wrapped when instrumentation is disabled."""
+        with self.sql() as sql:
+            self.assertIsInstance(sql, FakeCursor)
+        with util.db.pooled_sql_connection(util.db.ConnectionPool()) as sql:
+            self.assertIsInstance(sql, FakeCursor)
+
+    def test_stats(self):
+        """Statements are aggregated per template, with rows fetched and connection acquire times."""
+        stats = util.db.enable_instrumentation()
+        self.connection_rows = [{'id': 1}, {'id': 2}]
+        pooled_sql = util.db.custom_pooled_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+        for index, sql_connection in enumerate((self.sql, pooled_sql, pooled_sql)):
+            with sql_connection() as sql:
+                sql.execute('SELECT id FROM test WHERE id IN (%s, %s) AND number > {}'.format(index), (1, 2))
+                self.assertEqual(len(sql.fetchall()), 2)
+                sql.execute("UPDATE test SET name = 'name{}'".format(index))
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['acquire']['count'], 3)
+        select = snapshot['templates']['SELECT id FROM test WHERE id IN (...) AND number > ?']
+        self.assertEqual((select['count'], select['rows'], sum(select['histogram'])), (3, 6, 3))
+        self.assertEqual(snapshot['templates']['UPDATE test SET name = ?']['count'], 3)
+        stats.reset()
+        self.assertEqual(stats.snapshot()['templates'], {})
+
+    def test_reset_before_fetch(self):
+        """Resetting statistics between executing a statement and fetching its rows doesn't fail the fetch."""
+        stats = util.db.enable_instrumentation()
+        self.connection_rows = [{'id': 1}]
+        with self.sql() as sql:
+            sql.execute('SELECT 1')
+            stats.reset()
+            self.assertEqual(sql.fetchall(), [{'id': 1}])
+            sql.execute('SELECT 2')
+            self.assertEqual(sql.fetchone(), {'id': 1})
+        self.assertEqual(stats.snapshot()['templates']['SELECT ?']['rows'], 1)
+
+    def test_slow_queries(self):
+        """Statements slower than the threshold are logged."""
+        util.db.enable_instrumentation(slow_query_seconds=0.05)
+        with self.assertLogs('pkt.util.db', 'WARNING') as logs:
+            with self.sql() as sql:
+                sql.execute('SELECT 1')
+                sql.connection.preset.delay = 0.05
+                sql.execute('SELECT id FROM test WHERE id = 5')
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('SELECT id FROM test WHERE id = ?', logs.output[0])
+
+
+class TestTransactions(FakeConnectorTest):
+    """Tests for prepared statements, isolation levels and savepoints."""
+
+    def test_prepared(self):
+        """Each statement is prepared once per connection, and rows are dicts by default."""
+        self.connection_rows = [(1, 'one')]
+        sql_connection = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, prepared=True)
+        with sql_connection() as sql:
+            for index in range(3):
+                sql.execute(''.join(['SELECT id, name FROM test WHERE id = ', '%s']), (index,))
+            self.connections[0].preset.column_names = ('id', 'name')
+            self.assertEqual(sql.fetchall(), [{'id': 1, 'name': 'one'}])
+            sql.execute('INSERT INTO test (id) VALUES (%s)', (4,))
+        connection = self.connections[0]
+        self.assertTrue(connection.connect_kwargs['use_pure'])
+        self.assertEqual(connection.cursor_options, [{'prepared': True}] * 2)
+        self.assertEqual(len(connection.statements), 4)
+
+        with util.db.sql_connection(prepared=True, dictionary=False) as sql:
+            sql.cache_size = 1
+            sql.execute('SELECT 1')
+            self.assertEqual(sql.fetchone(), (1, 'one'))
+            sql.execute('SELECT 2')
+            sql.execute('SELECT 1')
+        self.assertEqual(self.connections[1].calls['close_cursor'], 2)
+        self.assertEqual(len(self.connections[1].cursor_options), 3)
+
+    def test_use_pure(self):
+        """Text protocol connections use the pure Python connector if asked to."""
+        for use_pure in (False, True):
+            with util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, use_pure=use_pure)():
+                pass
+        self.assertEqual([connection.connect_kwargs.get('use_pure') for connection in self.connections], [None, True])
+        self.assertEqual(self.connections[1].cursor_options, [{'dictionary': True}])
+
+    def test_isolation_level(self):
+        """Transactions can start with an isolation level."""
+        with util.db.sql_connection(isolation_level='READ COMMITTED'):
+            pass
+        self.assertEqual(self.connections[0].isolation_level, 'READ COMMITTED')
+
+    def test_savepoint(self):
+        """Savepoints roll back the statements of their block only."""
+        with util.db.sql_connection() as sql:
+            with util.db.savepoint(sql, 'first'):
+                sql.execute('INSERT INTO test (id) VALUES (1)')
+            with self.assertRaises(ValueError):
+                with util.db.savepoint(sql, 'second'):
+                    sql.execute('INSERT INTO test (id) VALUES (2)')
+                    raise ValueError('failure')
+        self.assertEqual([statement for statement, _ in self.connections[0].statements], [
+            'SAVEPOINT `first`', 'INSERT INTO test (id) VALUES (1)', 'RELEASE SAVEPOINT `first`',
+            'SAVEPOINT `second`', 'INSERT INTO test (id) VALUES (2)', 'ROLLBACK TO SAVEPOINT `second`'])
+        self.assertEqual(self.connections[0].calls['commit'], 1)
@@ -1,5 +1,12 @@
 """Test for geodecoding module."""
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 import util.geodecoding
 
@@ -59,3 +66,281 @@ class GeodecodingTest(unittest.TestCase):
                     obtained_country_code, '',
                     "place with coords {} has code {}, but does not any country code expected".format(
                         coords, obtained_country_code))
+
+
+def geocoding_response(body, status_code=200):
+    """Stand-in for a geocoding API response with a JSON body, or an invalid one if body is None."""
+    if body is None:
+        return mock.Mock(status_code=status_code, **{'json.side_effect': ValueError('not JSON')})
+    return mock.Mock(status_code=status_code, **{'json.return_value': body})
+
+
+class GeodecodingCacheTest(unittest.TestCase):
+    """Geodecoding cache test, with a stubbed geocoding API."""
+
+    def setUp(self):
+        self.requests = []
+        self.responses = {
+            '47.83,35.12': {'status': 'OK', 'results': [
+                {'types': ['country', 'political'], 'address_components': [{'short_name': 'UA'}]}]},
+            '19.13,169.99': {'status': 'ZERO_RESULTS', 'results': []}}
+        get = mock.patch.object(util.geodecoding.CLIENT.session, 'get', side_effect=self.get)
+        get.start()
+        self.addCleanup(get.stop)
+
+    def get(self, url, params, **_options):
+        """Respond by the coordinates truncated to two decimal places."""
+        self.requests.append(params['latlng'])
+        key = ','.join(part[:part.find('.') + 3] for part in params['latlng'].split(','))
+        return geocoding_response(self.responses.get(key, {'status': 'INVALID_REQUEST', 'error_message': url}))
+
+    def test_grid(self):
+        """Coordinates in the same grid cell are looked up once."""
+        cache = util.geodecoding.GeodecodingCache(grid=0.01, path='')
+        self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', cache), 'UA')
+        self.assertEqual(util.geodecoding.gps_to_country_code('47.8351,35.1231', cache), 'UA')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (1, 1))
+
+    def test_negative_and_errors(self):
+        """Places without a country are cached for negative_ttl, errors are not cached."""
+        cache = util.geodecoding.GeodecodingCache(negative_ttl=0, path='')
+        for _ in range(2):
+            self.assertEqual(util.geodecoding.gps_to_country_code('19.1352379,169.9914628', cache), '')
+        self.assertEqual(len(self.requests), 2)
+        cache.settings = cache.settings._replace(negative_ttl=60)
+        for _ in range(2):
+            self.assertEqual(util.geodecoding.gps_to_country_code('19.1352379,169.9914628', cache), '')
+        self.assertEqual(len(self.requests), 3)
+        for coords in ('31.7481223,35.2149544', '31.7481223,35.2149544', 'onetwo,three,four'):
+            with self.assertRaises(util.geodecoding.GeodecodingError):
+                util.geodecoding.gps_to_country_code(coords, cache)
+        self.assertEqual(len(self.requests), 6)
+
+    def test_lru(self):
+        """Least recently used cells are forgotten when the cache is full."""
+        cache = util.geodecoding.GeodecodingCache(size=1, path='')
+        for coords in ('47.8376698,35.1217301', '19.1352379,169.9914628', '47.8376698,35.1217301'):
+            util.geodecoding.gps_to_country_code(coords, cache)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_disk_store(self):
+        """Caches with the same path share cells."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'geodecoding.sqlite')
+            first_cache = util.geodecoding.GeodecodingCache(path=path)
+            self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', first_cache), 'UA')
+            second_cache = util.geodecoding.GeodecodingCache(path=path)
+            self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', second_cache), 'UA')
+            self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', second_cache), 'UA')
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual((second_cache.stats['disk_hits'], second_cache.stats['hits']), (1, 2))
+            second_cache.clear()
+            first_cache.entries.clear()
+            self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', first_cache), 'UA')
+            self.assertEqual(len(self.requests), 2)
+            first_cache.local.connection.close()
+            second_cache.local.connection.close()
+
+    def test_disk_errors(self):
+        """Database errors are logged, falling back to the memory cache."""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = util.geodecoding.GeodecodingCache(path=os.path.join(directory, 'missing', 'geodecoding.sqlite'))
+            with self.assertLogs('pkt.util.geodecoding', 'WARNING'):
+                for _ in range(2):
+                    self.assertEqual(util.geodecoding.gps_to_country_code('47.8376698,35.1217301', cache), 'UA')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((cache.stats['hits'], cache.stats['disk_errors']), (1, 2))
+
+    def test_fork(self):
+        """Forked processes open their own database connections."""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = util.geodecoding.GeodecodingCache(path=os.path.join(directory, 'geodecoding.sqlite'))
+            cache.put((1, 2), 'UA')
+            connection = cache.local.connection
+            self.addCleanup(connection.close)
+            with mock.patch.object(util.geodecoding.os, 'getpid', return_value=cache.pid + 1):
+                cache.entries.clear()
+                self.assertEqual(cache.get((1, 2)), 'UA')
+                self.assertIsNot(cache.local.connection, connection)
+                cache.local.connection.close()
+
+
+# Made up countries: AA with a hole holding the enclave BB, and CC bordering AA with an island.
+BOUNDARIES = {'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature', 'properties': {'ISO_A2': 'AA'}, 'geometry': {'type': 'Polygon', 'coordinates': [
+        [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]]}},
+    {'type': 'Feature', 'properties': {'ISO_A2': 'BB'}, 'geometry': {'type': 'Polygon', 'coordinates': [
+        [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]]}},
+    {'type': 'Feature', 'properties': {'ISO_A2': 'CC'}, 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+        [[[10, 0], [20.5, 0], [20.5, 10], [10, 10], [10, 0]]],
+        [[[0.25, 20.25], [2.5, 20.25], [0.25, 22.75], [0.25, 20.25]]]]}}]}
+
+
+def ray_casting_country_code(latitude, longitude):
+    """Find the country of coordinates in BOUNDARIES by ray casting over all their edges."""
+    for feature in BOUNDARIES['features']:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        inside = False
+        for ring in (ring for polygon in polygons for ring in polygon):
+            for (start_longitude, start_latitude), (end_longitude, end_latitude) in zip(ring, ring[1:]):
+                if (start_latitude > latitude) != (end_latitude > latitude) and longitude < start_longitude + (
+                        (latitude - start_latitude) * (end_longitude - start_longitude)
+                        / (end_latitude - start_latitude)):
+                    inside = not inside
+        if inside:
+            return feature['properties']['ISO_A2']
+    return ''
+
+
+class CountryIndexTest(unittest.TestCase):
+    """Offline country lookup test, with made up boundaries."""
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'boundaries.geojson')
+            with open(path, 'w') as boundaries_file:
+                json.dump(BOUNDARIES, boundaries_file)
+            self.index = util.geodecoding.CountryIndex.load(path, margin=0.01)
+
+    def test_lookup(self):
+        """Coordinates are resolved to countries, enclaves and islands, or left ambiguous near borders."""
+        for coordinates, country_code in (
+                ((2, 2), 'AA'), ((5, 5), 'BB'), ((4.5, 5.5), 'BB'), ((3.9, 4.5), 'AA'), ((5, 15), 'CC'),
+                ((20.5, 0.5), 'CC'), ((22.5, 1.5), ''), ((-5, 5), ''), ((30, 30), ''),
+                ((5, 9.995), None), ((5, 10), None), ((6.001, 5), None)):
+            with self.subTest(coordinates=coordinates):
+                self.assertEqual(self.index.lookup(*coordinates), country_code)
+
+    def test_accuracy(self):
+        """Lookups agree with ray casting, unless ambiguous."""
+        randomizer = random.Random(0)
+        ambiguous = 0
+        for _ in range(5000):
+            latitude, longitude = randomizer.uniform(-1, 24), randomizer.uniform(-1, 22)
+            country_code = self.index.lookup(latitude, longitude)
+            if country_code is None:
+                ambiguous += 1
+            else:
+                self.assertEqual(country_code, ray_casting_country_code(latitude, longitude), (latitude, longitude))
+        self.assertLess(ambiguous, 50)
+
+    def test_fallback(self):
+        """Only ambiguous coordinates are requested from the API."""
+        with mock.patch.object(util.geodecoding.CLIENT, 'request_country_code', return_value='CC') as request:
+            self.assertEqual(util.geodecoding.gps_to_country_code('2,2', None, self.index), 'AA')
+            self.assertEqual(util.geodecoding.gps_to_country_code('30,30', None, self.index), '')
+            self.assertEqual(util.geodecoding.gps_to_country_code('5,10.001', None, self.index), 'CC')
+        request.assert_called_once_with('5,10.001')
+
+    def test_fallback_not_cached(self):
+        """Ambiguous coordinates in the same cache cell but different countries are each requested."""
+        cache = util.geodecoding.GeodecodingCache(grid=0.01, path='')
+        with mock.patch.object(util.geodecoding.CLIENT, 'request_country_code', side_effect=lambda gps_coords: (
+                'CC' if float(gps_coords.split(',')[1]) > 10 else 'AA')) as request:
+            self.assertEqual(util.geodecoding.gps_to_country_code('5,10.004', cache, self.index), 'CC')
+            self.assertEqual(util.geodecoding.gps_to_country_code('5,9.996', cache, self.index), 'AA')
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(len(cache.entries), 0)
+
+
+def country_response(country_code):
+    """Get a geocoding API response body with a country code."""
+    return {'status': 'OK', 'results': [
+        {'types': ['country', 'political'], 'address_components': [{'short_name': country_code}]}]}
+
+
+class GeodecodingClientTest(unittest.TestCase):
+    """Geodecoding client test, with a stubbed session."""
+
+    def setUp(self):
+        self.client = util.geodecoding.GeodecodingClient(timeout=3, backoff=0, workers=4)
+        self.addCleanup(self.client.close)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def stub(self, get):
+        """Stub the session of the client, returning the stub."""
+        patcher = mock.patch.object(self.client.session, 'get', side_effect=get)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def echo(self, _url, params, **_options):
+        """Respond slowly with the latitude as country code, tracking concurrent requests."""
+        with self.lock:
+            self.requests.append(params['latlng'])
+        time.sleep(0.05)
+        return geocoding_response(country_response(params['latlng'].split(',')[0]))
+
+    def test_params_per_call(self):
+        """Concurrent requests get their own coordinates, and shared params are not modified."""
+        get = self.stub(self.echo)
+        results = {}
+
+        def request(latitude):
+            results[latitude] = self.client.request_country_code('{},0'.format(latitude))
+
+        threads = [threading.Thread(target=request, args=(latitude,)) for latitude in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {latitude: str(latitude) for latitude in range(20)})
+        self.assertNotIn('latlng', util.geodecoding.PARAMS)
+        self.assertEqual(get.call_args[1]['timeout'], 3)
+
+    def test_retries(self):
+        """Connection failures, server errors and retried statuses are retried, other errors are not."""
+        responses = [
+            util.geodecoding.requests.ConnectionError('refused'), geocoding_response(None, 503),
+            geocoding_response({'status': 'OVER_QUERY_LIMIT'}), geocoding_response(country_response('UA'))]
+        get = self.stub(responses)
+        with self.assertRaisesRegex(util.geodecoding.GeodecodingError, 'OVER_QUERY_LIMIT'):
+            self.client.request_country_code('47.83,35.12')
+        self.assertEqual(self.client.request_country_code('47.83,35.12'), 'UA')
+        self.assertEqual(get.call_count, 4)
+
+        self.stub([geocoding_response({'status': 'REQUEST_DENIED', 'error_message': 'denied'})])
+        with self.assertRaisesRegex(util.geodecoding.GeodecodingError, 'denied'):
+            self.client.request_country_code('47.83,35.12')
+        self.stub([geocoding_response(None, 403)])
+        with self.assertRaisesRegex(util.geodecoding.GeodecodingError, 'status 403'):
+            self.client.request_country_code('47.83,35.12')
+
+    def test_batch(self):
+        """Batches are looked up concurrently and in order, each distinct coordinates once."""
+        self.stub(self.echo)
+        gps_coords_list = ['{},0'.format(latitude % 10) for latitude in range(30)]
+        start = time.perf_counter()
+        self.assertEqual(
+            util.geodecoding.gps_to_country_codes(gps_coords_list, None, client=self.client),
+            [str(latitude % 10) for latitude in range(30)])
+        # Ten distinct coordinates take 0.5 seconds one by one, and three rounds of requests with four workers.
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertEqual(sorted(self.requests), sorted(set(gps_coords_list)))
+        self.assertEqual(util.geodecoding.gps_to_country_codes([], client=self.client), [])
+
+    def test_batch_pool(self):
+        """The pool of the client is grown to keep alive connections of all the workers of a batch."""
+        self.stub(self.echo)
+        adapter = self.client.session.get_adapter(util.geodecoding.URL)
+        util.geodecoding.gps_to_country_codes(['1,0', '2,0'], None, client=self.client, workers=8)
+        self.assertIs(self.client.session.get_adapter(util.geodecoding.URL), adapter)
+        util.geodecoding.gps_to_country_codes(
+            ['{},0'.format(latitude) for latitude in range(10)], None, client=self.client, workers=8)
+        self.assertEqual(self.client.workers, 8)
+        adapter = self.client.session.get_adapter(util.geodecoding.URL)
+        self.assertEqual(adapter.get_connection(util.geodecoding.URL).pool.maxsize, 8)
+
+    def test_batch_errors(self):
+        """Batch errors are raised, or returned in place of country codes."""
+        self.stub(lambda url, params, timeout: geocoding_response(
+            country_response('UA') if params['latlng'] == '47.83,35.12' else {'status': 'INVALID_REQUEST'}))
+        with self.assertRaises(util.geodecoding.GeodecodingError):
+            util.geodecoding.gps_to_country_codes(['47.83,35.12', 'one,two'], None, client=self.client)
+        results = util.geodecoding.gps_to_country_codes(
+            ['47.83,35.12', 'one,two'], None, client=self.client, return_exceptions=True)
+        self.assertEqual(results[0], 'UA')
+        self.assertIsInstance(results[1], util.geodecoding.GeodecodingError)
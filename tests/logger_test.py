@@ -1,5 +1,18 @@
 """Tests for logger module."""
-from unittest import TestCase
+import asyncio
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
 
 import util.logger
 
@@ -24,3 +37,474 @@ class TestLogger(TestCase):
                     self.assertIn(message, log_capture.output[0])
             except AttributeError:
                 pkt_logger.warning('No logging function for %s(%s)', level_name, level)
+
+
+class TestAsyncLogger(TestCase):
+    """Testing async mode."""
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.log_dir.cleanup)
+        self.addCleanup(util.logger.setup)
+        self.original_log_dir = util.logger.LOG_DIR_NAME
+        util.logger.LOG_DIR_NAME = self.log_dir.name
+        self.addCleanup(setattr, util.logger, 'LOG_DIR_NAME', self.original_log_dir)
+
+    def test_flush_on_shutdown(self):
+        """No records are lost when shutting down."""
+        util.logger.setup(async_mode=True)
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.async')
+        for index in range(1000):
+            pkt_logger.info('async record %s', index)
+        util.logger.shutdown()
+        with open(os.path.join(self.log_dir.name, util.logger.LOG_FILE_NAME)) as log_file:
+            lines = log_file.readlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertIn('async record 999', lines[-1])
+
+    def test_overflow_policies(self):
+        """Full queue drops records according to policy."""
+        record = util.logger.logging.makeLogRecord
+        handler = util.logger.QueueHandler(queue.Queue(2), 'drop-oldest')
+        for index in range(5):
+            handler.handle(record({'msg': 'record %s' % index, 'levelno': 10, 'levelname': 'DEBUG'}))
+        self.assertEqual(handler.dropped['DEBUG'], 3)
+        self.assertEqual([handler.queue.get().msg for _ in range(2)], ['record 3', 'record 4'])
+
+        handler = util.logger.QueueHandler(queue.Queue(1), 'drop-below-level', 'WARNING')
+        handler.handle(record({'msg': 'first', 'levelno': 40, 'levelname': 'ERROR'}))
+        handler.handle(record({'msg': 'second', 'levelno': 20, 'levelname': 'INFO'}))
+        self.assertEqual(handler.dropped, {'INFO': 1})
+        self.assertEqual(handler.queue.get().msg, 'first')
+
+        with self.assertRaises(ValueError):
+            util.logger.QueueHandler(queue.Queue(1), 'drop-newest')
+
+    def test_overflow_while_stopping(self):
+        """Dropping the oldest record never drops the sentinel stopping the writer thread."""
+        handler = util.logger.QueueHandler(queue.Queue(2), 'drop-oldest')
+        handler.queue.put(None)
+        for index in range(2):
+            handler.handle(util.logger.logging.makeLogRecord(
+                {'msg': 'record %s' % index, 'levelno': 10, 'levelname': 'DEBUG'}))
+        self.assertEqual(handler.dropped['DEBUG'], 1)
+        self.assertEqual([getattr(handler.queue.get(), 'msg', None) for _ in range(2)], ['record 0', None])
+
+    def test_log_after_shutdown(self):
+        """Records logged after shutdown are written, even if they would overflow the queue, and the process exits."""
+        script = (
+            "import logging, util.logger\n"
+            "util.logger.setup(async_mode=True, log_to_stream=False)\n"
+            "util.logger.shutdown()\n"
+            "for index in range(100):\n"
+            "    logging.getLogger('pkt.logger.after').warning('after shutdown %s', index)\n")
+        environment = dict(os.environ, PAKET_LOG_DIR=self.log_dir.name, PAKET_LOG_QUEUE_SIZE='2',
+                           PAKET_LOG_OVERFLOW='block')
+        process = subprocess.run(
+            [sys.executable, '-c', script], env=environment, timeout=30, check=False,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(process.returncode, 0)
+        with open(os.path.join(self.log_dir.name, util.logger.LOG_FILE_NAME)) as log_file:
+            lines = log_file.readlines()
+        self.assertEqual(len(lines), 100)
+        self.assertIn('after shutdown 99', lines[-1])
+
+    def test_fork(self):
+        """Forked processes write their records with a writer thread of their own."""
+        util.logger.setup(async_mode=True, log_to_stream=False)
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.fork')
+        pkt_logger.info('parent record')
+
+        def log_in_child():
+            pkt_logger.info('child record')
+            util.logger.shutdown()
+
+        process = multiprocessing.get_context('fork').Process(target=log_in_child)
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        util.logger.shutdown()
+        with open(os.path.join(self.log_dir.name, util.logger.LOG_FILE_NAME)) as log_file:
+            messages = sorted(line.split(': ', 1)[1].split(' - ')[0] for line in log_file)
+        self.assertEqual(messages, ['child record', 'parent record'])
+
+
+class TestBufferedFileHandler(TestCase):
+    """Testing buffered file handler."""
+
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.log_path = os.path.join(log_dir.name, 'buffered.log')
+        self.handler = util.logger.BufferedFileHandler(self.log_path, capacity=100, flush_interval=0)
+        self.addCleanup(self.handler.close)
+        self.logger = util.logger.logging.getLogger('pkt.logger.buffered')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+
+    def read_lines(self):
+        """Read lines written to file so far."""
+        with open(self.log_path) as log_file:
+            return log_file.read().splitlines()
+
+    def test_flushing(self):
+        """Records are written on full buffer, on error and on close."""
+        self.logger.warning('short')
+        self.assertEqual(self.read_lines(), [])
+        self.logger.warning('x' * 100)
+        self.assertEqual(self.read_lines(), ['short', 'x' * 100])
+        self.logger.warning('before error')
+        self.logger.error('error')
+        self.assertEqual(self.read_lines()[-2:], ['before error', 'error'])
+        self.logger.warning('last')
+        self.handler.close()
+        self.assertEqual(self.read_lines()[-1], 'last')
+
+    def test_flush_interval(self):
+        """Idle buffer is written after flush interval."""
+        handler = util.logger.BufferedFileHandler(self.log_path, capacity=100, flush_interval=0.05)
+        self.addCleanup(handler.close)
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.logger.warning('idle')
+        self.assertEqual(self.read_lines(), [])
+        time.sleep(0.2)
+        self.assertEqual(self.read_lines(), ['idle'])
+
+    def test_setup_again(self):
+        """Setting up again closes the handlers of the previous setup, stopping their flush threads."""
+        self.addCleanup(util.logger.setup)
+        with mock.patch.object(util.logger, 'LOG_DIR_NAME', os.path.dirname(self.log_path)), \
+                mock.patch.object(util.logger, 'BUFFER_SIZE', 100):
+            util.logger.setup(log_to_stream=False)
+            handler = util.logger.logging.getLogger().handlers[0]
+            util.logger.setup(log_to_stream=False)
+        self.assertIsInstance(handler, util.logger.BufferedFileHandler)
+        self.assertTrue(handler.closing.is_set())
+        self.assertIsNone(handler.stream)
+
+
+class TestRotatingFileHandler(TestCase):
+    """Testing log rotation."""
+
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.log_dir = log_dir.name
+        self.log_path = os.path.join(self.log_dir, 'rotating.log')
+        self.logger = util.logger.logging.getLogger('pkt.logger.rotating')
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+
+    def use_handler(self, **kwargs):
+        """Log through a new rotating handler."""
+        handler = util.logger.RotatingFileHandler(self.log_path, **kwargs)
+        self.addCleanup(handler.close)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def test_size_rotation(self):
+        """File is rotated by size, segments are compressed and old ones deleted, other files are kept."""
+        other_names = ('rotating.log.bak', 'rotating.log.lock', 'rotating.log.20200101-000000-000000.old')
+        for name in other_names:
+            with open(os.path.join(self.log_dir, name), 'w'):
+                pass
+        handler = self.use_handler(max_bytes=100, backup_count=2)
+        for index in range(10):
+            self.logger.warning('%02d %s', index, 'x' * 40)
+        handler.close()
+        self.assertTrue(all(os.path.exists(os.path.join(self.log_dir, name)) for name in other_names))
+        segments = sorted(name for name in os.listdir(self.log_dir) if name not in other_names + ('rotating.log',))
+        self.assertEqual(len(segments), 2)
+        self.assertTrue(all(segment.endswith('.gz') for segment in segments))
+        with gzip.open(os.path.join(self.log_dir, segments[-1]), 'rt') as segment:
+            self.assertEqual([line[:2] for line in segment], ['06', '07'])
+        with open(self.log_path) as log_file:
+            self.assertEqual([line[:2] for line in log_file], ['08', '09'])
+
+    def test_interval_rotation(self):
+        """File is rotated when the interval boundary is passed."""
+        handler = self.use_handler(interval=3600, compression='none')
+        self.logger.warning('first')
+        handler.rollover_at = time.time()
+        self.logger.warning('second')
+        handler.close()
+        segments = [name for name in os.listdir(self.log_dir) if name != 'rotating.log']
+        self.assertEqual(len(segments), 1)
+        with open(os.path.join(self.log_dir, segments[0])) as segment:
+            self.assertEqual(segment.read(), 'first\n')
+        self.assertGreater(handler.rollover_at, time.time())
+
+
+class TestJsonFormatter(TestCase):
+    """Testing JSON output."""
+
+    def test_format(self):
+        """Records are formatted as parsable JSON with extra fields and exception info."""
+        formatter = util.logger.JsonFormatter(util.logger.DATE_FORMAT)
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.json')
+        record = pkt_logger.makeRecord(
+            pkt_logger.name, util.logger.logging.INFO, __file__, 7, 'quoted "%s"', ('ünicode',), None,
+            extra={'user': 'paket', 'amount': 5})
+        self.assertEqual(json.loads(formatter.format(record)), {
+            'timestamp': formatter.formatTime(record, util.logger.DATE_FORMAT) + '.%03d' % record.msecs,
+            'level': 'INFO', 'name': 'pkt.logger.json', 'lineno': 7, 'message': 'quoted "ünicode"',
+            'user': 'paket', 'amount': 5})
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            record = pkt_logger.makeRecord(
+                pkt_logger.name, util.logger.logging.ERROR, __file__, 7, 'failed', (), sys.exc_info())
+        formatted = json.loads(formatter.format(record))
+        self.assertEqual(formatted['level'], 'ERROR')
+        self.assertIn('ValueError: failure', formatted['exc_info'])
+
+    def test_async(self):
+        """Records prepared for async mode or formatted by other formatters are formatted without looking for extras."""
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.addCleanup(util.logger.setup)
+        with mock.patch.object(util.logger, 'FORMAT', 'json'), \
+                mock.patch.object(util.logger, 'LOG_DIR_NAME', log_dir.name):
+            util.logger.setup(async_mode=True, log_to_stream=False)
+        formatter = util.logger.SETUP['listener'].handlers[0].formatter
+        extra_fields = mock.patch.object(formatter, 'extra_fields', wraps=formatter.extra_fields)
+        self.addCleanup(extra_fields.stop)
+        extra_fields = extra_fields.start()
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.json')
+        pkt_logger.info('plain %s', 'record')
+        pkt_logger.info('extra record', extra={'user': 'paket'})
+        util.logger.shutdown()
+        record = pkt_logger.makeRecord(pkt_logger.name, util.logger.logging.INFO, __file__, 7, 'preformatted', (), None)
+        util.logger.logging.Formatter('%(asctime)s %(message)s').format(record)
+        self.assertEqual(json.loads(formatter.format(record))['message'], 'preformatted')
+        with open(os.path.join(log_dir.name, util.logger.LOG_FILE_NAME)) as log_file:
+            lines = [json.loads(line) for line in log_file]
+        self.assertEqual([line['message'] for line in lines], ['plain record', 'extra record'])
+        self.assertEqual(lines[1]['user'], 'paket')
+        self.assertEqual(extra_fields.call_count, 1)
+
+
+class TestStreamFormatter(TestCase):
+    """Testing stream formatter selection."""
+
+    def test_color_detection(self):
+        """Colors are used only for terminals, unless overridden."""
+        terminal, pipe = mock.Mock(), io.StringIO()
+        terminal.isatty.return_value = True
+        self.assertIsInstance(util.logger.create_stream_formatter(terminal), util.logger.coloredlogs.ColoredFormatter)
+        self.assertNotIsInstance(util.logger.create_stream_formatter(pipe), util.logger.coloredlogs.ColoredFormatter)
+        with mock.patch.object(util.logger, 'COLOR', 'always'):
+            self.assertIsInstance(util.logger.create_stream_formatter(pipe), util.logger.coloredlogs.ColoredFormatter)
+        with mock.patch.object(util.logger, 'COLOR', 'never'):
+            self.assertNotIsInstance(
+                util.logger.create_stream_formatter(terminal), util.logger.coloredlogs.ColoredFormatter)
+
+    def test_file_only(self):
+        """Stream handler can be disabled."""
+        self.addCleanup(util.logger.setup)
+        util.logger.setup(log_to_stream=False)
+        self.assertEqual(
+            [type(handler) for handler in util.logger.logging.getLogger().handlers], [util.logger.logging.FileHandler])
+
+
+class TestLevels(TestCase):
+    """Testing per logger levels."""
+
+    def setUp(self):
+        self.addCleanup(util.logger.configure_levels, {})
+
+    def test_configure_levels(self):
+        """Levels apply to descendants and are reverted when no longer configured."""
+        util.logger.configure_levels({'pkt.levels': 'WARNING', 'pkt.levels.debug': 'DEBUG'})
+        self.assertFalse(util.logger.logging.getLogger('pkt.levels.child').isEnabledFor(util.logger.logging.INFO))
+        self.assertTrue(util.logger.logging.getLogger('pkt.levels.debug.child').isEnabledFor(
+            util.logger.logging.DEBUG))
+        util.logger.configure_levels({'pkt.levels.debug': 'INFO'})
+        self.assertEqual(util.logger.logging.getLogger('pkt.levels').level, util.logger.logging.NOTSET)
+        self.assertFalse(util.logger.logging.getLogger('pkt.levels.debug').isEnabledFor(util.logger.logging.DEBUG))
+
+    def test_reload_on_signal(self):
+        """Levels file is read again on signal."""
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as levels_file:
+            json.dump({'pkt.levels.reload': 'ERROR'}, levels_file)
+            levels_file.flush()
+            with mock.patch.object(util.logger, 'LEVELS', 'pkt.levels.env=ERROR'), \
+                    mock.patch.object(util.logger, 'LEVELS_FILE', levels_file.name):
+                previous_handler = util.logger.signal.getsignal(util.logger.signal.SIGHUP)
+                self.addCleanup(util.logger.signal.signal, util.logger.signal.SIGHUP, previous_handler)
+                util.logger.install_reload_signal()
+                os.kill(os.getpid(), util.logger.signal.SIGHUP)
+        self.assertEqual(util.logger.logging.getLogger('pkt.levels.reload').level, util.logger.logging.ERROR)
+        self.assertEqual(util.logger.logging.getLogger('pkt.levels.env').level, util.logger.logging.ERROR)
+
+
+class TestRateLimitFilter(TestCase):
+    """Testing rate limiting."""
+
+    def test_rate_limit(self):
+        """Records beyond rate are suppressed and summarized by the next record let through."""
+        rate_limit = util.logger.RateLimitFilter(rate=2, period=0.1)
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.limited')
+        pkt_logger.addFilter(rate_limit)
+        self.addCleanup(pkt_logger.removeFilter, rate_limit)
+        with self.assertLogs(pkt_logger.name) as log_capture:
+            for index in range(5):
+                pkt_logger.warning('limited %s', index)
+            pkt_logger.warning('other template')
+            self.assertFalse(rate_limit.allows(pkt_logger.name, 'limited %s'))
+            time.sleep(0.1)
+            self.assertTrue(rate_limit.allows(pkt_logger.name, 'limited %s'))
+            pkt_logger.warning('limited %s', 5)
+        self.assertEqual(log_capture.output, [
+            'WARNING:pkt.logger.limited:limited 0', 'WARNING:pkt.logger.limited:limited 1',
+            'WARNING:pkt.logger.limited:other template',
+            'WARNING:pkt.logger.limited:limited 5 (suppressed 4 similar messages)'])
+        self.assertEqual(log_capture.records[-1].suppressed, 4)
+
+
+def hammer_collector(socket_path, worker, records):
+    """Log records from a worker process through the collector."""
+    pkt_logger = util.logger.logging.getLogger('pkt.logger.collector')
+    pkt_logger.propagate = False
+    pkt_logger.handlers = [util.logger.CollectorHandler(socket_path, util.logger.logging.NullHandler())]
+    for index in range(records):
+        pkt_logger.warning('worker %s record %s %s', worker, index, 'x' * (index % 200))
+    pkt_logger.handlers[0].close()
+
+
+class TestLogCollector(TestCase):
+    """Testing multi process log collection."""
+
+    def setUp(self):
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.socket_path = os.path.join(log_dir.name, 'collector.sock')
+        self.log_path = os.path.join(log_dir.name, 'collected.log')
+
+    def test_many_processes(self):
+        """Records of many processes are collected without tearing or loss."""
+        file_handler = util.logger.logging.FileHandler(self.log_path)
+        file_handler.setFormatter(util.logger.logging.Formatter('%(process)d %(message)s'))
+        collector = util.logger.LogCollector(self.socket_path, [file_handler])
+        threading.Thread(target=collector.serve_forever, daemon=True).start()
+        workers, records = 4, 2000
+        processes = [
+            multiprocessing.get_context('fork').Process(
+                target=hammer_collector, args=(self.socket_path, worker, records))
+            for worker in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        collector.shutdown()
+        collector.server_close()
+
+        # Connection threads may still be writing the last records.
+        deadline = time.monotonic() + 10
+        while True:
+            with open(self.log_path) as log_file:
+                lines = log_file.read().splitlines()
+            if len(lines) >= workers * records or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        file_handler.close()
+        self.assertEqual(len(lines), workers * records)
+        expected = {'worker {} record {} {}'.format(worker, index, 'x' * (index % 200))
+                    for worker in range(workers) for index in range(records)}
+        self.assertEqual({line.split(' ', 1)[1] for line in lines}, expected)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_run_collector(self):
+        """The collector writes records without context in the configured format."""
+        log_dir = os.path.dirname(self.log_path)
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'import util.logger; util.logger.run_collector({!r})'.format(self.socket_path)],
+            env=dict(os.environ, PAKET_LOG_DIR=log_dir),
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.addCleanup(process.wait, 10)
+        self.addCleanup(process.terminate)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        handler = util.logger.CollectorHandler(self.socket_path, util.logger.logging.NullHandler())
+        handler.handle(util.logger.logging.LogRecord(
+            'pkt.logger.collector', util.logger.logging.WARNING, __file__, 0, 'collected record', None, None))
+        handler.close()
+        # The connection thread of the collector may still be writing the record.
+        deadline = time.monotonic() + 10
+        while True:
+            with open(os.path.join(log_dir, util.logger.LOG_FILE_NAME)) as log_file:
+                lines = log_file.readlines()
+            if lines or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(lines), 1)
+        self.assertIn('collected record', lines[0])
+
+    def test_fallback(self):
+        """Records are written directly when the collector is down."""
+        fallback_handler = util.logger.logging.FileHandler(self.log_path, delay=True)
+        handler = util.logger.CollectorHandler(self.socket_path, fallback_handler)
+        handler.handle(util.logger.logging.makeLogRecord({'msg': 'fallback record'}))
+        handler.close()
+        with open(self.log_path) as log_file:
+            self.assertEqual(log_file.read(), 'fallback record\n')
+
+
+class TestContext(TestCase):
+    """Testing context propagation."""
+
+    def capture(self):
+        """Capture records of a logger, passed through the context filter."""
+        pkt_logger = util.logger.logging.getLogger('pkt.logger.context')
+        exit_stack = contextlib.ExitStack()
+        self.addCleanup(exit_stack.close)
+        records = exit_stack.enter_context(self.assertLogs(pkt_logger.name)).records
+        pkt_logger.handlers[-1].addFilter(util.logger.add_context)
+        return pkt_logger, records
+
+    def test_bind(self):
+        """Bound fields are added to records within the block only."""
+        pkt_logger, records = self.capture()
+        pkt_logger.info('unbound')
+        with util.logger.bind(request_id='abc'):
+            with util.logger.bind(user='paket'):
+                pkt_logger.info('bound')
+            pkt_logger.info('outer')
+        self.assertEqual(records[0].context, '')
+        self.assertEqual((records[1].request_id, records[1].user), ('abc', 'paket'))
+        self.assertEqual(records[1].context, ' [request_id=abc user=paket]')
+        self.assertEqual(records[2].context, ' [request_id=abc]')
+        self.assertFalse(hasattr(records[2], 'user'))
+        with self.assertRaises(KeyError):
+            with util.logger.bind(name='reserved'):
+                pass
+
+    def test_propagation(self):
+        """Bound fields are inherited by asyncio tasks and wrapped thread targets."""
+        pkt_logger, records = self.capture()
+
+        async def log_in_task():
+            pkt_logger.info('task')
+
+        async def start_task():
+            await asyncio.create_task(log_in_task())
+
+        with util.logger.bind(request_id='abc'):
+            asyncio.run(start_task())
+            thread = threading.Thread(target=util.logger.in_context(pkt_logger.info), args=('thread',))
+        thread.start()
+        thread.join()
+        self.assertEqual([record.context for record in records], [' [request_id=abc]'] * 2)
+
+    def test_json(self):
+        """Bound fields are added to JSON output."""
+        record = util.logger.logging.makeLogRecord({'name': 'pkt.logger.context', 'msg': 'json'})
+        with util.logger.bind(request_id='abc'):
+            util.logger.add_context(record)
+        self.assertEqual(json.loads(util.logger.JsonFormatter().format(record))['request_id'], 'abc')
@@ -0,0 +1,116 @@
+"""Tests for redirector module."""
+import asyncio
+import threading
+import time
+import unittest
+import urllib.parse
+from unittest import mock
+
+import util.countly
+import util.redirector
+
+
+class TestRedirector(unittest.TestCase):
+    """Tests for the WSGI and ASGI redirectors."""
+
+    def setUp(self):
+        # A dispatcher holding events long enough to inspect them.
+        self.dispatcher = util.countly.EventDispatcher('http://127.0.0.1:9/i', flush_interval=60, retries=0)
+        patcher = mock.patch.dict(util.countly.SHARED, dispatcher=self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.dispatcher.close, 0)
+        self.addCleanup(self.dispatcher.events.clear)
+
+    def wsgi(self, query_string):
+        """Call the WSGI application, returning status, headers and body."""
+        response = {}
+
+        def start_response(status, headers):
+            response.update(status=status, headers=headers)
+
+        body = util.redirector.application({'QUERY_STRING': query_string}, start_response)
+        return response['status'], response['headers'], body
+
+    def asgi(self, query_string):
+        """Call the ASGI application, returning the messages it sent."""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'query_string': query_string.encode(), 'headers': [(b'x-request-id', b'test')]}
+        asyncio.run(util.redirector.asgi_application(scope, receive, send))
+        return messages
+
+    def test_redirect(self):
+        """Redirects respond at once, leaving the event queued."""
+        self.assertEqual(self.wsgi('target=https://paket.global&source=test'), (
+            '302 Found', [('Location', 'https://paket.global')], b''))
+        self.assertEqual(self.asgi('target=https://paket.global&source=test'), [
+            {'type': 'http.response.start', 'status': 302, 'headers': [(b'location', b'https://paket.global')]},
+            {'type': 'http.response.body', 'body': b''}])
+        self.assertEqual(list(self.dispatcher.events.values()), [{
+            'key': 'redirect', 'count': 2,
+            'segmentation': {'target': ('https://paket.global',), 'source': ('test',)}}])
+
+    def test_pages(self):
+        """Both applications serve the same pages."""
+        for query_string in ('', 'link=https://paket.global&source=test'):
+            status, headers, body = self.wsgi(query_string)
+            messages = self.asgi(query_string)
+            self.assertEqual(len(messages), 2)
+            start, body_message = messages[0], messages[1]
+            self.assertEqual((status, start['status'], body_message['body']), ('200 OK', 200, body))
+            self.assertEqual(start['headers'], [
+                (b'content-type', b'text/html'), (b'content-length', str(len(body)).encode())])
+            self.assertEqual(headers, [('Content-Type', 'text/html'), ('Content-Length', str(len(body)))])
+        self.assertIn(b'/linker?target=https%3A%2F%2Fpaket.global&source=test', body)
+
+    def test_tracking_failure(self):
+        """Failing to queue an event does not fail the redirect."""
+        with mock.patch.object(self.dispatcher, 'add', side_effect=RuntimeError('broken')):
+            with self.assertLogs('pkt.util.redirector', 'ERROR'):
+                self.assertEqual(self.wsgi('target=https://paket.global')[0], '302 Found')
+
+    def test_asgi_never_waits(self):
+        """The ASGI application drops redirect events rather than wait for the dispatcher lock."""
+        self.dispatcher.settings = self.dispatcher.settings._replace(add_timeout=5)
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.dispatcher.condition:
+                held.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait(5)
+        try:
+            start = time.perf_counter()
+            self.assertEqual(self.asgi('target=https://paket.global')[0]['status'], 302)
+            self.assertLess(time.perf_counter() - start, 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(self.dispatcher.counts['timed_out'], 1)
+
+    def test_parse_query(self):
+        """Queries are parsed like parse_qs, for the given keys only."""
+        for query_string in ('', 'a&b=&c=1&c=2&d', 'a=1=2&%20x=y+z', '=x&x==',
+                             'target=https%3A%2F%2Fp.g%2F%C3%A9&source=a+b&source=c'):
+            with self.subTest(query_string=query_string):
+                self.assertEqual(util.redirector.parse_query(query_string), urllib.parse.parse_qs(query_string))
+        self.assertEqual(util.redirector.parse_query('link=a&other=b&sour%63e=c', util.redirector.PAGE_KEYS), {
+            'link': ['a'], 'source': ['c']})
+
+    def test_link_page_cache(self):
+        """Link pages are generated once per link and source."""
+        util.redirector.link_page.cache_clear()
+        with mock.patch('urllib.parse.urlencode', wraps=urllib.parse.urlencode) as urlencode:
+            for _ in range(3):
+                self.wsgi('link=https://paket.global&source=test')
+        self.assertEqual(urlencode.call_count, 1)
@@ -1,8 +1,10 @@
 """Run all tests."""
 # pylint: disable=wildcard-import,unused-wildcard-import
+from tests.async_db_test import *
 from tests.conversion_test import *
 from tests.countly_test import *
 from tests.db_test import *
 from tests.distance_test import *
 from tests.geodecoding_test import *
 from tests.logger_test import *
+from tests.redirector_test import *
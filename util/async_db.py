@@ -0,0 +1,204 @@
+"""
+Asyncio database utils.
+Queries run on a bounded thread pool using the blocking connector and util.db.ConnectionPool, so many queries can be
+in flight per process without blocking the event loop.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import time
+
+import mysql.connector
+
+import util.db
+
+
+class AsyncConnectionPool:
+    """
+    Bounded pool of database connections for coroutines, with a worker thread per connection.
+    Coroutines wait for a free connection on the event loop, so worker threads never wait for one.
+    Arguments are those of util.db.ConnectionPool.
+    """
+
+    def __init__(self, connect_kwargs=None, **settings):
+        self.pool = util.db.ConnectionPool(connect_kwargs, **settings)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.pool.settings.size, thread_name_prefix='pkt-db')
+        # Created on first use in each event loop, since semaphores belong to the loop they are used in.
+        self.semaphore = self.loop = None
+
+    async def run(self, function, *args, **kwargs):
+        """Run a blocking function on a worker thread, in the context (and logging context) of the caller."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(contextvars.copy_context().run, function, *args, **kwargs))
+
+    async def acquire(self):
+        """Check out a connection, returning it with its creation time, once a connection is free."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphore, self.loop = asyncio.Semaphore(self.pool.settings.size), loop
+        await self.semaphore.acquire()
+        checkout = asyncio.ensure_future(self.run(self.pool.acquire))
+        try:
+            return await asyncio.shield(checkout)
+        except asyncio.CancelledError:
+            # The checkout completes on its worker thread regardless, so hand the connection back when it does.
+            checkout.add_done_callback(self.release_cancelled)
+            raise
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release_cancelled(self, checkout):
+        """Return the connection of a checkout whose caller was cancelled."""
+        if not checkout.cancelled() and checkout.exception() is None:
+            self.pool.release(*checkout.result())
+        self.semaphore.release()
+
+    async def release(self, connection, created_at, cursor, committed):
+        """Close cursor and check in its connection, rolling back uncommitted transactions, even if cancelled."""
+        try:
+            await asyncio.shield(self.run(util.db.finish, self.pool, connection, created_at, cursor, committed))
+        finally:
+            self.semaphore.release()
+
+    async def close(self):
+        """Close all idle connections and stop the worker threads."""
+        await self.run(self.pool.close)
+        self.executor.shutdown(wait=False)
+
+
+class AsyncCursor:
+    """Cursor whose blocking calls run on the worker threads of its pool."""
+
+    def __init__(self, cursor, pool):
+        self.cursor = cursor
+        self.pool = pool
+
+    async def execute(self, operation, params=None):
+        """Execute a statement."""
+        return await self.pool.run(self.cursor.execute, operation, params)
+
+    async def executemany(self, operation, seq_params):
+        """Execute a statement for each set of params."""
+        return await self.pool.run(self.cursor.executemany, operation, seq_params)
+
+    async def fetchone(self):
+        """Fetch the next row."""
+        return await self.pool.run(self.cursor.fetchone)
+
+    async def fetchmany(self, size=1):
+        """Fetch up to size rows."""
+        return await self.pool.run(self.cursor.fetchmany, size)
+
+    async def fetchall(self):
+        """Fetch all remaining rows."""
+        return await self.pool.run(self.cursor.fetchall)
+
+    @property
+    def rowcount(self):
+        """Number of rows affected or fetched by the last statement."""
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        """Auto increment value generated by the last statement."""
+        return self.cursor.lastrowid
+
+
+class AsyncSqlConnection:
+    """
+    Async context manager for querying the database with a connection from pool.
+    Like util.db.pooled_sql_connection, commits on success, translates data errors to util.db.DataTooBig, and on
+    failure rolls back and returns the connection, or closes it if it is broken. The cursor is instrumented if
+    util.db instrumentation is enabled.
+    """
+
+    def __init__(self, pool, **cursor_options):
+        self.pool = pool
+        self.cursor_options = dict({'dictionary': True}, **cursor_options)
+        self.connection = self.created_at = self.cursor = None
+
+    async def __aenter__(self):
+        stats = util.db.query_stats()
+        if stats is None:
+            self.connection, self.created_at = await self.pool.acquire()
+        else:
+            start = time.perf_counter()
+            self.connection, self.created_at = await self.pool.acquire()
+            stats.record_acquire(time.perf_counter() - start)
+        try:
+            self.cursor = await self.pool.run(self.connection.cursor, **self.cursor_options)
+        except BaseException:
+            await self.pool.release(self.connection, self.created_at, None, False)
+            raise
+        return AsyncCursor(util.db.instrumented(self.cursor, stats), self.pool)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        committed = False
+        try:
+            if exc_type is None:
+                try:
+                    await self.pool.run(self.connection.commit)
+                except mysql.connector.DataError as data_error:
+                    util.db.check_data_error(data_error)
+                committed = True
+            elif issubclass(exc_type, mysql.connector.DataError):
+                util.db.check_data_error(exc_value)
+        finally:
+            await self.pool.release(self.connection, self.created_at, self.cursor, committed)
+        return False
+
+
+def custom_async_sql_connection(host=None, port=3306, user=None, password=None, db_name=None, **settings):
+    """Return a customized AsyncSqlConnection factory, with its own pool with util.db.PoolSettings settings."""
+    pool = AsyncConnectionPool(util.db.connection_args(db_name, host, port, user, password), **settings)
+    return functools.partial(AsyncSqlConnection, pool)
+
+
+async def table_names(sql, db_name):
+    """Get the names of all tables in the database."""
+    await sql.execute(util.db.TABLE_NAMES_QUERY, (db_name,))
+    return [row['TABLE_NAME'] for row in await sql.fetchall()]
+
+
+async def clear_tables(active_sql_connection, db_name, truncate=False):
+    """Clear all tables in the database, by deleting rows or, with truncate, like util.db.clear_tables."""
+    async with active_sql_connection() as sql:
+        tables = await table_names(sql, db_name)
+        if not truncate:
+            for table_name in tables:
+                await sql.execute("DELETE from {}".format(util.db.qualified_name(db_name, table_name)))
+            return
+        await sql.execute('SET FOREIGN_KEY_CHECKS = 0')
+        try:
+            for table_name in tables:
+                await sql.execute("TRUNCATE TABLE {}".format(util.db.qualified_name(db_name, table_name)))
+        finally:
+            await sql.execute('SET FOREIGN_KEY_CHECKS = 1')
+
+
+async def drop_tables(active_sql_connection, db_name):
+    """Drop all tables in the database, in a single statement with foreign key checks disabled."""
+    try:
+        async with active_sql_connection() as sql:
+            tables = await table_names(sql, db_name)
+            if tables:
+                await sql.execute('SET FOREIGN_KEY_CHECKS = 0')
+                try:
+                    await sql.execute("DROP TABLE {}".format(', '.join(
+                        util.db.qualified_name(db_name, table_name) for table_name in tables)))
+                finally:
+                    await sql.execute('SET FOREIGN_KEY_CHECKS = 1')
+    finally:
+        util.db.SCHEMA_CACHE.invalidate(db_name)
+
+
+async def get_table_columns(active_sql_connection, db_name, table_name):
+    """Get the fields of a specific table, sharing the schema cache of util.db."""
+    columns = util.db.SCHEMA_CACHE.lookup(db_name, table_name)
+    if columns is None:
+        async with active_sql_connection() as sql:
+            await sql.execute(util.db.COLUMNS_QUERY, (db_name, table_name))
+            columns = util.db.SCHEMA_CACHE.store(db_name, table_name, await sql.fetchall())
+    return list(columns)
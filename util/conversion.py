@@ -8,6 +8,17 @@ STELLAR_DECIMALS = 7
 DECIMAL_POINT = '.'
 
 LOGGER = util.logger.logging.getLogger('pkt.util.currency_conversions')
+# Precision is lost on almost every conversion, so warnings about it are rate limited.
+PRECISION_LOSS = util.logger.RateLimitFilter()
+LOGGER.addFilter(PRECISION_LOSS)
+PRECISION_LOSS_MESSAGE = "precision loss: %s converted to %s"
+POSSIBLE_PRECISION_LOSS_MESSAGE = "possible precision loss: %s / %s = %s"
+
+
+def warn_precision_loss(message, *args):
+    """Log a precision loss warning unless rate limited, without checking the rate limit if warnings are disabled."""
+    if LOGGER.isEnabledFor(util.logger.logging.WARNING) and PRECISION_LOSS.allows(LOGGER.name, message):
+        LOGGER.warning(message, *args)
 
 
 def divisible_to_indivisible(amount, decimals):
@@ -128,9 +139,10 @@ def currency_to_euro_cents(amount, eur_price, decimals):
     fictitious_units_amount = fictitious_units_price * amount
     # minus two because initial price was in EUR and we want euro cents
     euro_cents = indivisible_to_divisible(fictitious_units_amount, price_decimals + decimals - 2)
-    LOGGER.warning("precision loss: %s converted to %s", euro_cents, round(float(euro_cents)))
     # integer part of result will be amount of euro cents
-    return round(float(euro_cents))
+    rounded_euro_cents = round(float(euro_cents))
+    warn_precision_loss(PRECISION_LOSS_MESSAGE, euro_cents, rounded_euro_cents)
+    return rounded_euro_cents
 
 
 def btc_to_euro_cents(amount, eur_price):
@@ -192,7 +204,7 @@ def euro_cents_to_xlm_stroops(euro_cents_amount, xlm_price):
     fictitious_units_amount = divisible_to_indivisible(euro_cents_amount, STELLAR_DECIMALS + price_decimals)
     fictitious_units_price = divisible_to_indivisible(xlm_price, price_decimals + 2)
     stroops = fictitious_units_amount // fictitious_units_price
-    LOGGER.warning("possible precision loss: %s / %s = %s", fictitious_units_amount, fictitious_units_price, stroops)
+    warn_precision_loss(POSSIBLE_PRECISION_LOSS_MESSAGE, fictitious_units_amount, fictitious_units_price, stroops)
     return stroops
 
 
@@ -211,5 +223,5 @@ def euro_cents_to_bul_stroops(euro_cents_amount, bul_price):
     fictitious_units_amount = divisible_to_indivisible(euro_cents_amount, STELLAR_DECIMALS + price_decimals)
     fictitious_units_price = divisible_to_indivisible(bul_price, price_decimals + 2)
     stroops = fictitious_units_amount // fictitious_units_price
-    LOGGER.warning("possible precision loss: %s / %s = %s", fictitious_units_amount, fictitious_units_price, stroops)
+    warn_precision_loss(POSSIBLE_PRECISION_LOSS_MESSAGE, fictitious_units_amount, fictitious_units_price, stroops)
     return stroops
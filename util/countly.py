@@ -1,11 +1,77 @@
 """Send events to count.ly"""
+import atexit
+import collections
 import json
 import logging
+import os
+import threading
+import time
 
 import requests
 
 LOGGER = logging.getLogger('pkt.util')
 COUNTLY_URL = 'http://c.paket.global/i'
+APP_KEY = 'e9c76edc986ea951ece1d4ae1cf4081686142dd4'
+# Seconds to wait for count.ly to respond.
+TIMEOUT = float(os.environ.get('PAKET_COUNTLY_TIMEOUT', 5))
+# Background dispatching: events are sent in batches of up to BATCH_SIZE, at least every FLUSH_INTERVAL seconds.
+BATCH_SIZE = int(os.environ.get('PAKET_COUNTLY_BATCH_SIZE', 100))
+FLUSH_INTERVAL = float(os.environ.get('PAKET_COUNTLY_FLUSH_INTERVAL', 5))
+# At most QUEUE_SIZE events wait to be sent, the overflow policy decides which are dropped when it is exceeded.
+QUEUE_SIZE = int(os.environ.get('PAKET_COUNTLY_QUEUE_SIZE', 10000))
+OVERFLOW_POLICY = os.environ.get('PAKET_COUNTLY_OVERFLOW', 'drop-oldest')
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest')
+# Failed batches are retried RETRIES times, waiting BACKOFF seconds before the first retry and doubling each time.
+RETRIES = int(os.environ.get('PAKET_COUNTLY_RETRIES', 3))
+BACKOFF = float(os.environ.get('PAKET_COUNTLY_BACKOFF', 0.5))
+# Queued events with the same key, segmentation and time fields are merged into one, summing count and dur.
+AGGREGATE = os.environ.get('PAKET_COUNTLY_AGGREGATE', '1') == '1'
+# Seconds an event may wait for the queue lock before it is dropped, capping the cost of queueing it.
+ADD_TIMEOUT = float(os.environ.get('PAKET_COUNTLY_ADD_TIMEOUT', 0.05))
+SUMMED_EVENT_KEYS = ('count', 'dur')
+
+# Sessions of send_countly_event by process id, so that forked processes don't share pooled connections.
+SESSIONS = {}
+# The shared dispatcher of get_dispatcher, created on first use.
+SHARED = {'dispatcher': None}
+DISPATCHER_LOCK = threading.Lock()
+
+
+def session():
+    """Get the session of send_countly_event in this process, creating it on first use."""
+    pid = os.getpid()
+    process_session = SESSIONS.get(pid)
+    if process_session is None:
+        # Sessions inherited from a parent process are dropped, not closed, since the parent still uses them.
+        SESSIONS.clear()
+        process_session = SESSIONS.setdefault(pid, requests.Session())
+    return process_session
+
+
+def create_event(key, count, **kwargs):
+    """
+    Create a countly event.
+    Known event keys (dur, timestamp, hour, dow) are entered directly, other kwargs go in the segmentation dict.
+    """
+    event = {'key': key, 'count': int(str(count)), 'segmentation': {}}
+    known_event_keys = ['dur', 'timestamp', 'hour', 'dow']
+    for event_key, value in kwargs.items():
+        if event_key in known_event_keys:
+            event[event_key] = value
+        else:
+            event['segmentation'][event_key] = value
+    return event
+
+
+def create_payload(events, begin_session=None, end_session=None):
+    """Create the request parameters sending a list of events."""
+    return {
+        'app_key': APP_KEY,
+        'device_id': 'None',
+        'begin_session': begin_session,
+        'end_session': end_session,
+        'events': json.dumps(events)
+    }
 
 
 def send_countly_event(key, count, begin_session=None, end_session=None, **kwargs):
@@ -25,26 +91,188 @@ def send_countly_event(key, count, begin_session=None, end_session=None, **kwarg
     :param end_session: Optional, Integer
     :return:
     """
-    event = {'key': key, 'count': int(str(count)), 'segmentation': {}}
-    known_event_keys = ['dur', 'timestamp', 'hour', 'dow']
-    for event_key, value in kwargs.items():
-        if event_key in known_event_keys:
-            event[event_key] = value
-        else:
-            event['segmentation'][event_key] = value
-    payload = {
-        'app_key': 'e9c76edc986ea951ece1d4ae1cf4081686142dd4',
-        'device_id': 'None',
-        'begin_session': begin_session,
-        'end_session': end_session,
-        'events': json.dumps([event])
-    }
+    payload = create_payload([create_event(key, count, **kwargs)], begin_session, end_session)
     # pylint: disable=broad-except
     try:
-        response = requests.get(COUNTLY_URL, params=payload)
-        LOGGER.debug("response: %s", response)
-        LOGGER.debug("URI: %s", response.url)
-        LOGGER.debug("text: %s", response.text)
+        response = session().get(COUNTLY_URL, params=payload, timeout=TIMEOUT)
+        # Decoding the response text is wasted work unless debug output is enabled.
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("response: %s", response)
+            LOGGER.debug("URI: %s", response.url)
+            LOGGER.debug("text: %s", response.text)
     except Exception as exception:
         LOGGER.error('failed request to countly: %s', str(exception))
     # pylint: enable=broad-except
+
+
+# Settings of an EventDispatcher, see its docstring.
+DispatcherSettings = collections.namedtuple(
+    'DispatcherSettings', (
+        'url', 'batch_size', 'flush_interval', 'queue_size', 'overflow_policy', 'retries', 'backoff', 'timeout',
+        'aggregate', 'add_timeout'),
+    defaults=(
+        COUNTLY_URL, BATCH_SIZE, FLUSH_INTERVAL, QUEUE_SIZE, OVERFLOW_POLICY, RETRIES, BACKOFF, TIMEOUT, AGGREGATE,
+        ADD_TIMEOUT))
+
+
+class EventDispatcher:
+    """
+    Send countly events to url in batches from a background thread, over a pooled HTTP session of the thread.
+    Events are queued without waiting, and sent once batch_size of them are queued or flush_interval seconds after
+    the previous batch. At most queue_size events are kept; when full, the overflow policy drops either the oldest
+    queued event (drop-oldest) or the new one (drop-newest), counting them in counts['dropped'].
+    Failed batches are retried with exponential backoff, and then dropped and counted in counts['failed'].
+    Lost events are counted by their count, so that a lost merged event counts all the events merged into it.
+    With aggregate, events queued in the same flush window that differ only in count and dur are merged into one event,
+    summing them, and counted in counts['merged']. Batch and queue sizes count merged events once.
+    The thread starts on the first event (in each process, so that dispatchers survive forking), and close sends
+    the remaining events. Settings are those of DispatcherSettings, and all but url are keyword only.
+    """
+
+    def __init__(self, url=COUNTLY_URL, **settings):
+        self.settings = DispatcherSettings(url, **settings)
+        if self.settings.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy {}".format(self.settings.overflow_policy))
+        # Queued events by aggregation key (or by a key of their own if not aggregating), oldest first.
+        self.events = collections.OrderedDict()
+        # Events merged, lost (dropped, failed and timed out) and in flight: taken from the queue and not yet sent.
+        self.counts = collections.Counter()
+        self.timed_out_lock = threading.Lock()
+        self.condition = threading.Condition()
+        # Either 'open', 'flushing' until the queue is empty, or 'closed'.
+        self.state = 'open'
+        self.thread = None
+
+    def add(self, event, timeout=None):
+        """
+        Queue an event to be sent.
+        Waits at most timeout seconds (add_timeout by default, not at all if 0) for the queue lock, then drops the
+        event and counts it in counts['timed_out'].
+        """
+        key = self.aggregation_key(event) if self.settings.aggregate else object()
+        if not self.condition.acquire(timeout=self.settings.add_timeout if timeout is None else timeout):
+            with self.timed_out_lock:
+                self.counts['timed_out'] += event['count']
+            return
+        try:
+            if self.state == 'closed':
+                self.counts['dropped'] += event['count']
+                return
+            if self.thread is None or not self.thread.is_alive():
+                # The first event, or the first in a forked process, where the parent's thread doesn't run.
+                self.events, self.counts['in_flight'] = collections.OrderedDict(), 0
+                self.thread = threading.Thread(target=self.run, name='pkt-countly', daemon=True)
+                self.thread.start()
+            queued = self.events.get(key)
+            if queued is not None:
+                for summed_key in SUMMED_EVENT_KEYS:
+                    if summed_key in event:
+                        queued[summed_key] = queued.get(summed_key, 0) + event[summed_key]
+                self.counts['merged'] += 1
+                return
+            if len(self.events) >= self.settings.queue_size:
+                if self.settings.overflow_policy == 'drop-newest':
+                    self.counts['dropped'] += event['count']
+                    return
+                self.counts['dropped'] += self.events.popitem(last=False)[1]['count']
+            self.events[key] = dict(event)
+            if len(self.events) >= self.settings.batch_size:
+                self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    @staticmethod
+    def aggregation_key(event):
+        """Get a key telling apart events that can't be merged."""
+        return json.dumps(
+            {key: value for key, value in event.items() if key not in SUMMED_EVENT_KEYS}, sort_keys=True, default=str)
+
+    def next_batch(self):
+        """Wait for a batch to be due, and take it. Return None once closed and all events are taken."""
+        batch_size = self.settings.batch_size
+        with self.condition:
+            deadline = time.monotonic() + self.settings.flush_interval
+            while len(self.events) < batch_size and self.state == 'open':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if not self.events:
+                if self.state == 'flushing':
+                    self.state = 'open'
+                self.condition.notify_all()
+                return None if self.state == 'closed' else []
+            batch = [self.events.popitem(last=False)[1] for _ in range(min(batch_size, len(self.events)))]
+            self.counts['in_flight'] = len(batch)
+            return batch
+
+    def run(self):
+        """Send batches until closed, over a session of this thread."""
+        with requests.Session() as http_session:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                if batch:
+                    self.send(http_session, batch)
+                with self.condition:
+                    self.counts['in_flight'] = 0
+                    self.condition.notify_all()
+
+    def send(self, http_session, events):
+        """Send a batch of events, retrying connection failures and server errors. Return whether it was sent."""
+        # Batches may be too long for a query string, and count.ly accepts the same parameters posted.
+        payload = create_payload(events)
+        settings = self.settings
+        for attempt in range(settings.retries + 1):
+            if attempt:
+                time.sleep(settings.backoff * 2 ** (attempt - 1))
+            try:
+                response = http_session.post(settings.url, data=payload, timeout=settings.timeout)
+            except requests.RequestException as exception:
+                error = str(exception)
+                continue
+            if response.status_code < 400:
+                return True
+            error = 'status {}'.format(response.status_code)
+            if response.status_code < 500:
+                break
+        LOGGER.error('failed sending %s events to countly: %s', len(events), error)
+        with self.condition:
+            self.counts['failed'] += sum(event['count'] for event in events)
+        return False
+
+    def flush(self, timeout=None):
+        """Send all queued events now, waiting up to timeout seconds for them to be sent."""
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                return
+            if self.state == 'open':
+                self.state = 'flushing'
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not (self.events or self.counts['in_flight']), timeout)
+
+    def close(self, timeout=None):
+        """Stop accepting events, and wait up to timeout seconds for the queued ones to be sent."""
+        with self.condition:
+            self.state = 'closed'
+            self.condition.notify_all()
+            thread = self.thread
+        # The thread of a parent process counts as stopped in forked processes.
+        if thread is not None:
+            thread.join(timeout)
+
+
+def get_dispatcher():
+    """Get the shared dispatcher, configured by environment, creating it on first use."""
+    with DISPATCHER_LOCK:
+        dispatcher = SHARED['dispatcher']
+        if dispatcher is None:
+            dispatcher = SHARED['dispatcher'] = EventDispatcher()
+            atexit.register(dispatcher.close, TIMEOUT)
+        return dispatcher
+
+
+def dispatch_countly_event(key, count, **kwargs):
+    """Queue an event to be sent to countly in the background, taking the same arguments as send_countly_event."""
+    get_dispatcher().add(create_event(key, count, **kwargs))
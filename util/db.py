@@ -1,21 +1,335 @@
 """Database utils."""
+import bisect
+import collections
 import contextlib
 import functools
+import itertools
+import logging
+import os
 import re
+import threading
+import time
 
 import mysql.connector
 
+LOGGER = logging.getLogger('pkt.util.db')
+# Default limit of bulk insert statement size, the default max_allowed_packet of MySQL 5.7.
+MAX_PACKET = 4 * 1024 * 1024
+# Cursor options for each type of streamed rows.
+ROW_TYPES = {
+    'dict': {'dictionary': True},
+    'tuple': {'dictionary': False},
+    'namedtuple': {'dictionary': False, 'named_tuple': True}}
+# Seconds for which table columns are cached.
+SCHEMA_CACHE_TTL = 300
+# Sizes of integer column types, in bits.
+INTEGER_BITS = {'tinyint': 8, 'smallint': 16, 'mediumint': 24, 'int': 32, 'integer': 32, 'bigint': 64}
+TABLE_NAMES_QUERY = "SELECT TABLE_NAME FROM information_schema.tables WHERE TABLE_SCHEMA = %s"
+COLUMNS_QUERY = """
+    SELECT COLUMN_NAME, DATA_TYPE, COLUMN_TYPE, CHARACTER_MAXIMUM_LENGTH FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION"""
+# Number of prepared statements a PreparedCursor keeps per connection.
+PREPARED_STATEMENTS = int(os.environ.get('PAKET_DB_PREPARED_STATEMENTS', 100))
+# Query instrumentation, off by default: statements slower than SLOW_QUERY_SECONDS are logged as warnings.
+INSTRUMENT = os.environ.get('PAKET_DB_INSTRUMENT', '0') == '1'
+SLOW_QUERY_SECONDS = float(os.environ.get('PAKET_DB_SLOW_QUERY_SECONDS', 1))
+# Upper bounds, in seconds, of the buckets of latency histograms. A last bucket holds slower statements.
+HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
 
 class DataTooBig(Exception):
     """Data too big for database column."""
 
 
+class PoolTimeout(Exception):
+    """No pooled connection became available in time."""
+
+
+# Literals, parameter placeholders and lists of them, replaced to get statement templates.
+LITERALS = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|\b\d+(?:\.\d+)?\b|%s|%\(\w+\)s""")
+LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+WHITESPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_query(operation):
+    """Get the template of a statement, with literals and parameters replaced by ? and lists of them by (...)."""
+    if isinstance(operation, (bytes, bytearray)):
+        operation = operation.decode(errors='replace')
+    template = LITERALS.sub('?', operation)
+    template = LISTS.sub('(...)', template)
+    return WHITESPACE.sub(' ', template).strip()
+
+
+class QueryStats:
+    """
+    Statement statistics aggregated per statement template: count, rows fetched, total and maximum seconds and a
+    histogram of seconds (bucket counts by HISTOGRAM_BOUNDS), and the same for connection acquire times.
+    Statements slower than slow_query_seconds are logged.
+    """
+
+    def __init__(self, slow_query_seconds=SLOW_QUERY_SECONDS):
+        self.slow_query_seconds = slow_query_seconds
+        self.templates = {}
+        self.acquire = self.new_entry()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_entry():
+        """Create empty statistics."""
+        return {'count': 0, 'rows': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1)}
+
+    @staticmethod
+    def add(entry, seconds):
+        """Add a duration to statistics."""
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['max_seconds'] = max(entry['max_seconds'], seconds)
+        entry['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+
+    def record_statement(self, operation, seconds):
+        """Record the duration of a statement, logging it if it is slow."""
+        template = normalize_query(operation)
+        with self.lock:
+            entry = self.templates.get(template)
+            if entry is None:
+                entry = self.templates[template] = self.new_entry()
+            self.add(entry, seconds)
+        if seconds >= self.slow_query_seconds:
+            LOGGER.warning("slow query (%.3fs): %s", seconds, template)
+        return template
+
+    def record_rows(self, template, rows):
+        """Record rows fetched by a statement of template, unless its statistics were reset since it ran."""
+        with self.lock:
+            entry = self.templates.get(template)
+            if entry is not None:
+                entry['rows'] += rows
+
+    def record_acquire(self, seconds):
+        """Record the time taken to get a connection."""
+        with self.lock:
+            self.add(self.acquire, seconds)
+
+    def snapshot(self):
+        """Get a copy of the statistics, as {'acquire': statistics, 'templates': {template: statistics}}."""
+        with self.lock:
+            return {
+                'acquire': dict(self.acquire, histogram=list(self.acquire['histogram'])),
+                'templates': {template: dict(entry, histogram=list(entry['histogram']))
+                              for template, entry in self.templates.items()}}
+
+    def reset(self):
+        """Forget all statistics."""
+        with self.lock:
+            self.templates = {}
+            self.acquire = self.new_entry()
+
+
+class InstrumentedCursor:
+    """Cursor wrapper recording the duration of statements and the number of rows fetched in QueryStats."""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+        self.template = None
+
+    def execute(self, operation, *args, **kwargs):
+        """Execute a statement, timing it."""
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(operation, *args, **kwargs)
+        finally:
+            self.template = self.stats.record_statement(operation, time.perf_counter() - start)
+
+    def executemany(self, operation, seq_params):
+        """Execute a statement for each set of params, timing them together."""
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(operation, seq_params)
+        finally:
+            self.template = self.stats.record_statement(operation, time.perf_counter() - start)
+
+    def count_rows(self, rows):
+        """Record fetched rows, returning them."""
+        if self.template is not None and rows:
+            self.stats.record_rows(self.template, len(rows) if isinstance(rows, list) else 1)
+        return rows
+
+    def fetchone(self):
+        """Fetch the next row."""
+        return self.count_rows(self.cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        """Fetch up to size rows."""
+        return self.count_rows(self.cursor.fetchmany(size))
+
+    def fetchall(self):
+        """Fetch all remaining rows."""
+        return self.count_rows(self.cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+# QueryStats statements of all connections are recorded in, None while instrumentation is disabled.
+INSTRUMENTATION = {'stats': QueryStats() if INSTRUMENT else None}
+
+
+def query_stats():
+    """Get the QueryStats statements are recorded in, or None if instrumentation is disabled."""
+    return INSTRUMENTATION['stats']
+
+
+def enable_instrumentation(slow_query_seconds=SLOW_QUERY_SECONDS):
+    """Start recording statement statistics of all connections, returning the QueryStats they are recorded in."""
+    stats = INSTRUMENTATION['stats'] = QueryStats(slow_query_seconds)
+    return stats
+
+
+def disable_instrumentation():
+    """Stop recording statement statistics."""
+    INSTRUMENTATION['stats'] = None
+
+
+def instrumented(cursor, stats):
+    """Wrap cursor to record its statements in stats, if instrumentation is enabled (stats is not None)."""
+    return cursor if stats is None else InstrumentedCursor(cursor, stats)
+
+
+@functools.lru_cache(maxsize=128)
+def row_class(column_names):
+    """Get the namedtuple class of rows with column_names."""
+    return collections.namedtuple('Row', column_names)
+
+
+class PreparedCursor:
+    """
+    Cursor running statements as server-side prepared statements, each prepared once per connection.
+    Up to cache_size statements stay prepared, the least recently used are deallocated.
+    Rows are dicts, unless cursor options say otherwise (dictionary=False for tuples, named_tuple=True for
+    namedtuples). Rows are read as they are fetched, as with buffered=False, and other options are not supported.
+    """
+
+    def __init__(self, connection, cache_size=PREPARED_STATEMENTS, **cursor_options):
+        unsupported = sorted(
+            option for option, value in cursor_options.items() if value and option not in ('dictionary', 'named_tuple'))
+        if unsupported:
+            raise ValueError("prepared cursors don't support {}".format(', '.join(unsupported)))
+        self.connection = connection
+        self.named_tuple = cursor_options.get('named_tuple', False)
+        self.dictionary = cursor_options.get('dictionary', not self.named_tuple)
+        self.cache_size = cache_size
+        # Prepared cursors with the operation they prepared, by operation, least recently used first.
+        self.statements = collections.OrderedDict()
+        self.cursor = None
+
+    def prepared(self, operation):
+        """Get the prepared cursor of operation, and the operation object it was prepared with."""
+        entry = self.statements.pop(operation, None)
+        if entry is None:
+            if len(self.statements) >= self.cache_size:
+                self.statements.popitem(last=False)[1][1].close()
+            entry = (operation, self.connection.cursor(prepared=True))
+        self.statements[operation] = entry
+        return entry
+
+    def execute(self, operation, params=None):
+        """Execute a statement, preparing it if it was not prepared yet."""
+        # Prepared cursors compare operations by identity, so pass the very object they prepared.
+        operation, self.cursor = self.prepared(operation)
+        return self.cursor.execute(operation, params or ())
+
+    def executemany(self, operation, seq_params):
+        """Execute a statement for each set of params."""
+        operation, self.cursor = self.prepared(operation)
+        return self.cursor.executemany(operation, seq_params)
+
+    def make_row(self, row):
+        """Convert a row to a dict or namedtuple if required."""
+        if row is None:
+            return row
+        if self.dictionary:
+            return dict(zip(self.cursor.column_names, row))
+        if self.named_tuple:
+            return row_class(tuple(self.cursor.column_names))(*row)
+        return row
+
+    def fetchone(self):
+        """Fetch the next row."""
+        return self.make_row(self.cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        """Fetch up to size rows."""
+        return [self.make_row(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        """Fetch all remaining rows."""
+        return [self.make_row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @property
+    def rowcount(self):
+        """Number of rows affected or fetched by the last statement."""
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        """Auto increment value generated by the last statement."""
+        return self.cursor.lastrowid
+
+    def close(self):
+        """Deallocate all prepared statements."""
+        statements, self.statements = self.statements, collections.OrderedDict()
+        for _, cursor in statements.values():
+            cursor.close()
+
+
+def connection_args(db_name=None, host=None, port=3306, user=None, password=None):
+    """Get the arguments of mysql.connector.connect for a database."""
+    return {'host': host, 'port': port, 'user': user, 'passwd': password, 'database': db_name}
+
+
+def connect(stats, **connect_kwargs):
+    """Connect to the database, recording the time it took in stats unless they are None."""
+    if stats is None:
+        return mysql.connector.connect(**connect_kwargs)
+    start = time.perf_counter()
+    connection = mysql.connector.connect(**connect_kwargs)
+    stats.record_acquire(time.perf_counter() - start)
+    return connection
+
+
 @contextlib.contextmanager
-def sql_connection(db_name=None, host=None, port=3306, user=None, password=None):
-    """Context manager for querying the database."""
+def sql_connection(db_name=None, host=None, port=3306, user=None, password=None, *, prepared=False,
+                   isolation_level=None, use_pure=False, **cursor_options):
+    """
+    Context manager for querying the database, with a dictionary cursor unless cursor_options say otherwise.
+    The cursor is instrumented if instrumentation is enabled.
+    :param prepared: use a PreparedCursor (with the pure Python connector, which supports them), with cursor_options
+        it supports
+    :param isolation_level: start the transaction with this isolation level, e.g. 'READ COMMITTED'
+    :param use_pure: use the pure Python connector even if the C extension is available
+    """
+    stats = query_stats()
+    connect_kwargs = connection_args(db_name, host, port, user, password)
+    if prepared or use_pure:
+        connect_kwargs['use_pure'] = True
     try:
-        connection = mysql.connector.connect(host=host, port=port, user=user, passwd=password, database=db_name)
-        yield connection.cursor(dictionary=True)
+        connection = connect(stats, **connect_kwargs)
+        if isolation_level is not None:
+            connection.start_transaction(isolation_level=isolation_level)
+        if prepared:
+            cursor = PreparedCursor(connection, **cursor_options)
+        else:
+            cursor = connection.cursor(**dict({'dictionary': True}, **cursor_options))
+        yield instrumented(cursor, stats)
         connection.commit()
     except mysql.connector.DataError as data_error:
         check_data_error(data_error)
@@ -37,35 +351,455 @@ def check_data_error(data_error):
     raise data_error
 
 
-def custom_sql_connection(host=None, port=3306, user=None, password=None, db_name=None):
+def custom_sql_connection(host=None, port=3306, user=None, password=None, db_name=None, *, prepared=False,
+                          isolation_level=None, use_pure=False):
     """Return a customized sql_connection context manager."""
-    return functools.partial(sql_connection, db_name, host, port, user, password)
+    return functools.partial(
+        sql_connection, db_name, host, port, user, password, prepared=prepared, isolation_level=isolation_level,
+        use_pure=use_pure)
+
+
+@contextlib.contextmanager
+def savepoint(sql, name='savepoint'):
+    """
+    Context manager for a savepoint in the transaction of cursor sql.
+    On exception, only the statements executed within the block are rolled back, and the exception is raised.
+    """
+    name = quote_identifier(name)
+    sql.execute('SAVEPOINT {}'.format(name))
+    try:
+        yield
+    except BaseException:
+        sql.execute('ROLLBACK TO SAVEPOINT {}'.format(name))
+        raise
+    sql.execute('RELEASE SAVEPOINT {}'.format(name))
+
+
+def rollback(connection):
+    """Roll back the current transaction, returning whether the connection is still usable."""
+    try:
+        connection.rollback()
+        return True
+    except mysql.connector.Error:
+        return False
+
+
+# Settings of a ConnectionPool: its size and connection lifetimes and timeouts, in seconds.
+PoolSettings = collections.namedtuple(
+    'PoolSettings', ('size', 'max_lifetime', 'idle_timeout', 'wait_timeout', 'health_check_after'),
+    defaults=(5, 3600, 300, 10, 1))
 
 
-def clear_tables(active_sql_connection, db_name):
-    """Clear all tables in the database."""
+class ConnectionPool:
+    """
+    Bounded pool of connections to the database of connect_kwargs (see connection_args), with PoolSettings.
+    Connections idle for more than health_check_after seconds are pinged on checkout, connections older than
+    max_lifetime seconds are closed on checkin, and connections idle for more than idle_timeout seconds are closed
+    on checkout or checkin.
+    Checkout waits up to wait_timeout seconds for a connection to be returned before raising PoolTimeout.
+    A pool inherited by a forked process forgets the connections of its parent.
+    """
+
+    def __init__(self, connect_kwargs=None, **settings):
+        self.connect_kwargs = connection_args() if connect_kwargs is None else connect_kwargs
+        self.settings = PoolSettings(**settings)
+        # Idle connections as (connection, creation time, checkin time), most recently returned last.
+        self.idle = collections.deque()
+        self.open_count = 0
+        self.condition = threading.Condition()
+        self.pid = os.getpid()
+
+    def acquire(self):
+        """Check out a healthy connection, returning it with its creation time."""
+        deadline = time.monotonic() + self.settings.wait_timeout
+        while True:
+            connection, created_at, idle_since = self.reserve(deadline)
+            if connection is None:
+                try:
+                    return mysql.connector.connect(**self.connect_kwargs), time.monotonic()
+                except BaseException:
+                    self.forget()
+                    raise
+            if time.monotonic() - idle_since < self.settings.health_check_after or connection.is_connected():
+                return connection, created_at
+            self.discard(connection)
+
+    def reserve(self, deadline):
+        """Take an idle connection, or a slot for a new connection (returned as None), waiting until deadline."""
+        expired = []
+        try:
+            with self.condition:
+                if self.pid != os.getpid():
+                    self.pid, self.idle, self.open_count = os.getpid(), collections.deque(), 0
+                expired = self.expire()
+                while True:
+                    if self.idle:
+                        return self.idle.pop()
+                    if self.open_count < self.settings.size:
+                        self.open_count += 1
+                        return None, None, None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout("no database connection available within {} seconds".format(
+                            self.settings.wait_timeout))
+                    self.condition.wait(remaining)
+        finally:
+            for connection in expired:
+                self.close_connection(connection)
+
+    def release(self, connection, created_at, reusable=True):
+        """Check in a connection, closing it if it is not reusable or too old."""
+        if not reusable or time.monotonic() - created_at > self.settings.max_lifetime:
+            self.discard(connection)
+            return
+        expired = []
+        with self.condition:
+            if self.pid == os.getpid():
+                expired = self.expire()
+                self.idle.append((connection, created_at, time.monotonic()))
+                self.condition.notify()
+        for expired_connection in expired:
+            self.close_connection(expired_connection)
+
+    def expire(self):
+        """Take the connections idle for more than idle_timeout out of the pool, to be closed without the lock."""
+        expired = []
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][2] > self.settings.idle_timeout:
+            expired.append(self.idle.popleft()[0])
+            self.open_count -= 1
+        return expired
+
+    def discard(self, connection):
+        """Close a checked out connection and free its slot."""
+        self.close_connection(connection)
+        self.forget()
+
+    def forget(self):
+        """Free the slot of a checked out connection."""
+        with self.condition:
+            self.open_count -= 1
+            self.condition.notify()
+
+    @staticmethod
+    def close_connection(connection):
+        """Close a connection, ignoring errors of broken connections."""
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
+
+    def close(self):
+        """Close all idle connections."""
+        with self.condition:
+            idle, self.idle = self.idle, collections.deque()
+            self.open_count -= len(idle)
+        for connection, _, _ in idle:
+            self.close_connection(connection)
+
+
+@contextlib.contextmanager
+def pooled_sql_connection(pool, **cursor_options):
+    """
+    Context manager for querying the database with a connection from pool.
+    Like sql_connection, commits on success and translates data errors. On failure the transaction is
+    rolled back, and the connection is returned to the pool, or closed if it is broken.
+    """
+    stats = query_stats()
+    if stats is None:
+        connection, created_at = pool.acquire()
+    else:
+        start = time.perf_counter()
+        connection, created_at = pool.acquire()
+        stats.record_acquire(time.perf_counter() - start)
+    committed = False
+    cursor = None
+    try:
+        cursor = connection.cursor(**dict({'dictionary': True}, **cursor_options))
+        yield instrumented(cursor, stats)
+        connection.commit()
+        committed = True
+    except mysql.connector.DataError as data_error:
+        check_data_error(data_error)
+    finally:
+        finish(pool, connection, created_at, cursor, committed)
+
+
+def finish(pool, connection, created_at, cursor, committed):
+    """Close cursor and return its connection to pool, rolling back the transaction unless committed."""
+    if cursor is not None:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            committed = False
+    pool.release(connection, created_at, committed or rollback(connection))
+
+
+def custom_pooled_sql_connection(host=None, port=3306, user=None, password=None, db_name=None, **settings):
+    """Return a customized pooled_sql_connection context manager, with its own pool with PoolSettings settings."""
+    return functools.partial(
+        pooled_sql_connection, ConnectionPool(connection_args(db_name, host, port, user, password), **settings))
+
+
+def quote_identifier(identifier):
+    """Quote a table or column name."""
+    return '`{}`'.format(identifier.replace('`', '``'))
+
+
+def qualified_name(db_name, table_name):
+    """Quote a table name qualified by its database name."""
+    return '{}.{}'.format(quote_identifier(db_name), quote_identifier(table_name))
+
+
+def estimate_size(value):
+    """Estimate the size of a value in a statement, assuming every byte needs escaping."""
+    if isinstance(value, (bytes, bytearray)):
+        return 2 * len(value) + 3
+    return 2 * len(str(value).encode()) + 3
+
+
+def insert_statement_parts(table_name, columns, upsert=False):
+    """
+    Get the parts of a multi-row INSERT statement of columns: the head up to VALUES, the placeholders of a row, and
+    the tail updating existing rows with upsert.
+    """
+    head = 'INSERT INTO {} ({}) VALUES '.format(
+        quote_identifier(table_name), ', '.join(quote_identifier(column) for column in columns))
+    placeholders = '({})'.format(', '.join(['%s'] * len(columns)))
+    tail = ' ON DUPLICATE KEY UPDATE {}'.format(', '.join(
+        '{0} = VALUES({0})'.format(quote_identifier(column)) for column in columns)) if upsert else ''
+    return head, placeholders, tail
+
+
+def insert_chunks(rows, columns, chunk_size, max_size, row_overhead):
+    """
+    Generate chunks of rows as (number of rows, values of columns of all rows), each of up to chunk_size rows and an
+    estimated size of up to max_size, counting row_overhead for each row. A row bigger than max_size is a chunk.
+    """
+    chunk, chunk_rows, chunk_bytes = [], 0, 0
+    for row in rows:
+        values = [row[column] for column in columns]
+        row_size = row_overhead + sum(estimate_size(value) for value in values)
+        if chunk_rows and (chunk_rows >= chunk_size or chunk_bytes + row_size > max_size):
+            yield chunk_rows, chunk
+            chunk, chunk_rows, chunk_bytes = [], 0, 0
+        chunk.extend(values)
+        chunk_rows += 1
+        chunk_bytes += row_size
+    if chunk_rows:
+        yield chunk_rows, chunk
+
+
+def insert_statements(table_name, rows, chunk_size, upsert, max_packet):
+    """Generate the multi-row INSERT statements of bulk_insert, as (statement, values, number of rows)."""
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+    columns = list(first_row)
+    head, placeholders, tail = insert_statement_parts(table_name, columns, upsert)
+    for chunk_rows, values in insert_chunks(
+            itertools.chain((first_row,), rows), columns, chunk_size, max_packet - len(head) - len(tail),
+            len(placeholders) + 2):
+        yield head + ', '.join([placeholders] * chunk_rows) + tail, values, chunk_rows
+
+
+def bulk_insert(active_sql_connection, table_name, rows, chunk_size=1000, *, upsert=False, max_packet=MAX_PACKET):
+    """
+    Insert rows (dicts with the keys of the first row) using multi-row INSERT statements, in one transaction.
+    A statement holds up to chunk_size rows, and is cut short before its estimated size exceeds max_packet.
+    With upsert, rows with an existing key update all given columns of the existing row instead.
+    Return the number of rows and statements, the elapsed seconds and rows per second.
+    """
+    start = time.perf_counter()
+    stats = {'rows': 0, 'statements': 0}
+    statements = insert_statements(table_name, rows, chunk_size, upsert, max_packet)
+    first_statement = next(statements, None)
+    if first_statement is not None:
+        with active_sql_connection() as sql:
+            for statement, values, chunk_rows in itertools.chain((first_statement,), statements):
+                sql.execute(statement, values)
+                stats['statements'] += 1
+                stats['rows'] += chunk_rows
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+def stream_query(active_sql_connection, query, params=None, batch_size=1000, row_type='dict'):
+    """
+    Generate the rows of a query without holding the whole result in memory.
+    Rows are read from an unbuffered cursor batch_size at a time, as dicts, tuples or namedtuples.
+    Closing the generator early closes (or, if pooled, discards) the connection instead of reading the rest.
+    """
+    with active_sql_connection(buffered=False, **ROW_TYPES[row_type]) as sql:
+        sql.execute(query, params)
+        while True:
+            rows = sql.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+
+def table_names(sql, db_name):
+    """Get the names of all tables in the database."""
+    sql.execute(TABLE_NAMES_QUERY, (db_name,))
+    return [row['TABLE_NAME'] for row in sql.fetchall()]
+
+
+@contextlib.contextmanager
+def foreign_key_checks_disabled(sql):
+    """Disable foreign key checks of the connection within the block."""
+    sql.execute('SET FOREIGN_KEY_CHECKS = 0')
+    try:
+        yield
+    finally:
+        sql.execute('SET FOREIGN_KEY_CHECKS = 1')
+
+
+def clear_tables(active_sql_connection, db_name, truncate=False):
+    """
+    Clear all tables in the database.
+    With truncate, tables are truncated with foreign key checks disabled, which is much faster than deleting rows
+    but commits implicitly and resets auto increment counters.
+    """
     with active_sql_connection() as sql:
-        sql.execute("SELECT TABLE_NAME FROM information_schema.tables WHERE TABLE_SCHEMA = %s", (db_name,))
-        for table_name in [row['TABLE_NAME'] for row in sql.fetchall()]:
+        if truncate:
+            with foreign_key_checks_disabled(sql):
+                for table_name in table_names(sql, db_name):
+                    sql.execute("TRUNCATE TABLE {}".format(qualified_name(db_name, table_name)))
+            return
+        for table_name in table_names(sql, db_name):
             sql.execute("DELETE from {}".format(table_name))
 
 
 def drop_tables(active_sql_connection, db_name):
-    """Drop all tables in the database."""
+    """Drop all tables in the database, in a single statement with foreign key checks disabled."""
+    try:
+        with active_sql_connection() as sql:
+            tables = table_names(sql, db_name)
+            if tables:
+                with foreign_key_checks_disabled(sql):
+                    sql.execute("DROP TABLE {}".format(', '.join(
+                        qualified_name(db_name, table_name)
+                        for table_name in tables)))
+    finally:
+        SCHEMA_CACHE.invalidate(db_name)
+
+
+def snapshot_tables(active_sql_connection, db_name, snapshot_db_name=None):
+    """
+    Copy all tables of the database into a snapshot database, to be restored by restore_tables.
+    The snapshot database (by default named after the database with a _snapshot suffix) is recreated.
+    """
+    snapshot_db_name = snapshot_db_name or '{}_snapshot'.format(db_name)
+    try:
+        with active_sql_connection() as sql:
+            sql.execute("DROP DATABASE IF EXISTS {}".format(quote_identifier(snapshot_db_name)))
+            sql.execute("CREATE DATABASE {}".format(quote_identifier(snapshot_db_name)))
+            for table_name in table_names(sql, db_name):
+                source = qualified_name(db_name, table_name)
+                target = qualified_name(snapshot_db_name, table_name)
+                sql.execute("CREATE TABLE {} LIKE {}".format(target, source))
+                sql.execute("INSERT INTO {} SELECT * FROM {}".format(target, source))
+    finally:
+        SCHEMA_CACHE.invalidate(snapshot_db_name)
+
+
+def restore_tables(active_sql_connection, db_name, snapshot_db_name=None):
+    """
+    Reset the tables of the database to their contents in a snapshot taken by snapshot_tables.
+    Tables created after the snapshot are left as they are.
+    """
+    snapshot_db_name = snapshot_db_name or '{}_snapshot'.format(db_name)
     with active_sql_connection() as sql:
-        sql.execute("SELECT TABLE_NAME FROM information_schema.tables WHERE TABLE_SCHEMA = %s", (db_name,))
-        for table_name in [row['TABLE_NAME'] for row in sql.fetchall()]:
-            sql.execute("DROP TABLE {}".format(table_name))
+        with foreign_key_checks_disabled(sql):
+            for table_name in table_names(sql, snapshot_db_name):
+                source = qualified_name(snapshot_db_name, table_name)
+                target = qualified_name(db_name, table_name)
+                sql.execute("TRUNCATE TABLE {}".format(target))
+                sql.execute("INSERT INTO {} SELECT * FROM {}".format(target, source))
+
+
+class SchemaCache:
+    """
+    Cache of table columns by database and table name, with their types and maximum lengths.
+    Entries expire after ttl seconds, and are invalidated by drop_tables or by calling invalidate.
+    The cache does not tell servers apart, so use separate caches for databases of the same name on different servers.
+    """
+
+    def __init__(self, ttl=SCHEMA_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def columns(self, active_sql_connection, db_name, table_name):
+        """
+        Get the columns of a table, in order, mapped to their DATA_TYPE, COLUMN_TYPE and CHARACTER_MAXIMUM_LENGTH.
+        """
+        columns = self.lookup(db_name, table_name)
+        if columns is not None:
+            return columns
+        with active_sql_connection() as sql:
+            sql.execute(COLUMNS_QUERY, (db_name, table_name))
+            return self.store(db_name, table_name, sql.fetchall())
+
+    def lookup(self, db_name, table_name):
+        """Get the cached columns of a table, or None if they are not cached or expired."""
+        with self.lock:
+            entry = self.entries.get((db_name, table_name))
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def store(self, db_name, table_name, rows):
+        """Cache the columns of a table from the rows of COLUMNS_QUERY, returning them."""
+        assert rows, "table {} does not exist".format(table_name)
+        columns = collections.OrderedDict((row['COLUMN_NAME'], {
+            'DATA_TYPE': row['DATA_TYPE'], 'COLUMN_TYPE': row['COLUMN_TYPE'],
+            'CHARACTER_MAXIMUM_LENGTH': row['CHARACTER_MAXIMUM_LENGTH']}) for row in rows)
+        with self.lock:
+            self.entries[(db_name, table_name)] = (time.monotonic(), columns)
+        return columns
+
+    def invalidate(self, db_name=None, table_name=None):
+        """Forget a table, all tables of a database, or everything."""
+        with self.lock:
+            if db_name is None:
+                self.entries.clear()
+            elif table_name is not None:
+                self.entries.pop((db_name, table_name), None)
+            else:
+                for key in [key for key in self.entries if key[0] == db_name]:
+                    del self.entries[key]
+
+
+SCHEMA_CACHE = SchemaCache()
 
 
 def get_table_columns(active_sql_connection, db_name, table_name):
     """Get the fields of a specific table."""
-    with active_sql_connection() as sql:
-        sql.execute("""
-            SELECT TABLE_NAME FROM information_schema.tables
-            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s""", (db_name, table_name))
-        tables = sql.fetchall()
-        assert len(tables) == 1, "table {} does not exist".format(table_name)
-        sql.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s",
-                    (db_name, table_name))
-        return [column['COLUMN_NAME'] for column in sql.fetchall()]
+    return list(SCHEMA_CACHE.columns(active_sql_connection, db_name, table_name))
+
+
+def check_row_sizes(active_sql_connection, db_name, table_name, row):
+    """
+    Raise DataTooBig for values of row (a dict) that don't fit their columns, judging by cached table columns.
+    Checks string lengths of character and binary columns and ranges of integer columns.
+    """
+    columns = SCHEMA_CACHE.columns(active_sql_connection, db_name, table_name)
+    for column_name, value in row.items():
+        column = columns.get(column_name)
+        if column is None or value is None:
+            continue
+        max_length = column['CHARACTER_MAXIMUM_LENGTH']
+        if max_length is not None and isinstance(value, (str, bytes, bytearray)) and len(value) > max_length:
+            raise DataTooBig("Data too big for {}".format(column_name))
+        bits = INTEGER_BITS.get(column['DATA_TYPE'])
+        if bits is not None and isinstance(value, int):
+            if 'unsigned' in column['COLUMN_TYPE']:
+                minimum, maximum = 0, 2 ** bits - 1
+            else:
+                minimum, maximum = -2 ** (bits - 1), 2 ** (bits - 1) - 1
+            if not minimum <= value <= maximum:
+                raise DataTooBig("Data too big for {}".format(column_name))
@@ -1,8 +1,18 @@
 """Reverse geocoding utils."""
+import bisect
+import collections
+import concurrent.futures
+import json
+import logging
+import math
 import os
+import sqlite3
+import threading
+import time
 
 import requests
 
+LOGGER = logging.getLogger('pkt.util.geodecoding')
 GOOGLE_API_KEY = os.environ.get('PAKET_GOOGLE_API_KEY')
 URL = 'https://maps.googleapis.com/maps/api/geocode/json'
 RESULT_TYPE = 'country'
@@ -10,23 +20,449 @@ PARAMS = {
     'language': 'en',
     'result_type': RESULT_TYPE,
     'key': GOOGLE_API_KEY}
+# Seconds to wait for the API, and times failed requests are retried, waiting BACKOFF seconds before the first retry
+# and doubling each time.
+TIMEOUT = float(os.environ.get('PAKET_GEODECODING_TIMEOUT', 5))
+RETRIES = int(os.environ.get('PAKET_GEODECODING_RETRIES', 2))
+BACKOFF = float(os.environ.get('PAKET_GEODECODING_BACKOFF', 0.5))
+# API statuses of requests that may succeed if retried.
+RETRIED_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+# Maximal number of concurrent requests of batch lookups, and of pooled connections.
+WORKERS = int(os.environ.get('PAKET_GEODECODING_WORKERS', 8))
+# Coordinates are cached by cells of a grid, CACHE_GRID degrees wide (0.01 degrees is up to 1.1km).
+CACHE_GRID = float(os.environ.get('PAKET_GEODECODING_CACHE_GRID', 0.01))
+# Number of cells cached in memory, and seconds for which country codes and places without one are cached.
+CACHE_SIZE = int(os.environ.get('PAKET_GEODECODING_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('PAKET_GEODECODING_CACHE_TTL', 30 * 24 * 3600))
+CACHE_NEGATIVE_TTL = float(os.environ.get('PAKET_GEODECODING_CACHE_NEGATIVE_TTL', 24 * 3600))
+# SQLite file shared by all processes, not used if empty.
+CACHE_PATH = os.environ.get('PAKET_GEODECODING_CACHE_PATH', '')
+# GeoJSON file of country boundaries for offline lookups, not used if empty, and the property with country codes.
+BOUNDARIES_PATH = os.environ.get('PAKET_GEODECODING_BOUNDARIES', '')
+BOUNDARIES_CODE_PROPERTY = os.environ.get('PAKET_GEODECODING_BOUNDARIES_CODE_PROPERTY', 'ISO_A2')
+# Width in degrees of the cells of the boundaries index, and distance in degrees from borders within which
+# lookups are ambiguous and left to the API.
+INDEX_GRID = float(os.environ.get('PAKET_GEODECODING_INDEX_GRID', 1))
+BORDER_MARGIN = float(os.environ.get('PAKET_GEODECODING_BORDER_MARGIN', 0.02))
+# Position of reference points in index cells, as fractions of the cell, irrational so borders don't cross them.
+REFERENCE_OFFSET = (math.sqrt(2) - 1, (math.sqrt(5) - 1) / 2)
 
 
 class GeodecodingError(Exception):
     """Geodecoding error."""
 
 
-def gps_to_country_code(gps_coords):
-    """Obtain short country code by GPS coordinates."""
-    PARAMS['latlng'] = gps_coords
-    response = requests.get(URL, PARAMS).json()
+# Settings of a GeodecodingCache, see its docstring.
+CacheSettings = collections.namedtuple(
+    'CacheSettings', ('grid', 'size', 'ttl', 'negative_ttl', 'path'),
+    defaults=(CACHE_GRID, CACHE_SIZE, CACHE_TTL, CACHE_NEGATIVE_TTL, CACHE_PATH))
 
-    if response['status'] == 'ZERO_RESULTS':
+
+class GeodecodingCache:
+    """
+    Cache of country codes by cells of a grid of coordinates, grid degrees wide.
+    Up to size cells are kept in memory, least recently used first to go. Country codes expire after ttl seconds,
+    and places without a country code (cached as '') after negative_ttl seconds.
+    With a path, cells are also stored in an SQLite database there, which processes can share. Errors of the database
+    are logged and counted in stats as disk_errors, falling back to the memory cache.
+    Hits (from memory or disk) and misses are counted in stats. Settings are those of CacheSettings, keyword only.
+    """
+
+    def __init__(self, **settings):
+        self.settings = CacheSettings(**settings)
+        # Country codes and their expiry times by cell, least recently used first.
+        self.entries = collections.OrderedDict()
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        # SQLite connections can't be shared by threads, nor by forked processes.
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    def key(self, coordinates):
+        """Get the grid cell of (latitude, longitude) coordinates."""
+        return round(coordinates[0] / self.settings.grid), round(coordinates[1] / self.settings.grid)
+
+    def database(self):
+        """Get the SQLite connection of this thread and process, creating the table on first use."""
+        if self.pid != os.getpid():
+            self.pid, self.local = os.getpid(), threading.local()
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.settings.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS country_codes (
+                    grid REAL, latitude INTEGER, longitude INTEGER, country_code TEXT, expires REAL,
+                    PRIMARY KEY (grid, latitude, longitude))''')
+            self.local.connection = connection
+        return connection
+
+    def execute(self, query, params=()):
+        """Execute a query in the database, returning its rows, or None if it failed."""
+        try:
+            return self.database().execute(query, params).fetchall()
+        except sqlite3.Error as error:
+            LOGGER.warning("can't use geodecoding cache at %s: %s", self.settings.path, error)
+            with self.lock:
+                self.stats['disk_errors'] += 1
+            return None
+
+    def get(self, key):
+        """Get the cached country code of a cell, or None if it is not cached."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                del self.entries[key]
+        if self.settings.path:
+            rows = self.execute(
+                'SELECT country_code, expires FROM country_codes WHERE grid = ? AND latitude = ? AND longitude = ?',
+                (self.settings.grid,) + key)
+            row = rows[0] if rows else None
+            if row is not None and row[1] > now:
+                self.remember(key, *row)
+                with self.lock:
+                    self.stats['hits'] += 1
+                    self.stats['disk_hits'] += 1
+                return row[0]
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, country_code):
+        """Cache the country code of a cell, '' if it has none."""
+        expires = time.time() + (self.settings.ttl if country_code else self.settings.negative_ttl)
+        self.remember(key, country_code, expires)
+        if self.settings.path:
+            self.execute(
+                'INSERT OR REPLACE INTO country_codes VALUES (?, ?, ?, ?, ?)',
+                (self.settings.grid,) + key + (country_code, expires))
+
+    def remember(self, key, country_code, expires):
+        """Keep a country code in memory, forgetting the least recently used one if full."""
+        with self.lock:
+            self.entries[key] = (country_code, expires)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.settings.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget all cached country codes, in memory and on disk, and reset stats."""
+        with self.lock:
+            self.entries.clear()
+            self.stats.clear()
+        if self.settings.path:
+            self.execute('DELETE FROM country_codes')
+
+
+CACHE = GeodecodingCache()
+
+
+def segment_distance_squared(point, start, end):
+    """Get the squared distance of a point from a segment, in degrees, treating them as planar."""
+    (latitude, longitude), (start_latitude, start_longitude) = point, start
+    delta_latitude, delta_longitude = end[0] - start_latitude, end[1] - start_longitude
+    length_squared = delta_latitude * delta_latitude + delta_longitude * delta_longitude
+    fraction = 0.0 if not length_squared else max(0.0, min(1.0, (
+        (latitude - start_latitude) * delta_latitude + (longitude - start_longitude) * delta_longitude
+    ) / length_squared))
+    delta_latitude = start_latitude + fraction * delta_latitude - latitude
+    delta_longitude = start_longitude + fraction * delta_longitude - longitude
+    return delta_latitude * delta_latitude + delta_longitude * delta_longitude
+
+
+def orientation(origin, first, second):
+    """Get the sign of the turn from origin to first to second: positive if counterclockwise."""
+    return (first[1] - origin[1]) * (second[0] - origin[0]) - (first[0] - origin[0]) * (second[1] - origin[1])
+
+
+def crosses(start, end, edge):
+    """
+    Check if segment from start to end crosses an edge. Edge ends exactly on the line of the segment count as being
+    on one side of it, so crossings of polygons through vertices are counted like by ray casting.
+    """
+    edge_start, edge_end = edge
+    if (orientation(start, end, edge_start) > 0) == (orientation(start, end, edge_end) > 0):
+        return False
+    return (orientation(edge_start, edge_end, start) > 0) != (orientation(edge_start, edge_end, end) > 0)
+
+
+class CountryIndex:
+    """
+    Offline index of country boundaries, for looking up country codes of coordinates.
+    Boundaries are polygons with holes, as lists of rings of (latitude, longitude) points, by country code.
+    Coordinates are indexed by cells of a grid, grid degrees wide. Cells inside a single country and cells outside all
+    countries resolve at once. In cells crossed by borders, a point is in a country if the segment to it from a
+    reference point of the cell crosses the country's edges in the cell an even number of times and the reference
+    point is in the country, or an odd number of times and it is not. Points less than margin degrees from an edge are
+    ambiguous, since boundaries are simplified.
+    """
+
+    def __init__(self, boundaries, grid=INDEX_GRID, margin=BORDER_MARGIN):
+        self.grid = grid
+        self.margin = margin
+        # By cell: a country code, or (reference point, [(country code, whether reference point is in it, edges)]).
+        self.cells = {}
+        for country_code, polygons in boundaries.items():
+            self.add_country(country_code, [
+                (tuple(ring[index]), tuple(ring[index + 1]))
+                for polygon in polygons for ring in polygon for index in range(len(ring) - 1)])
+
+    def cell(self, latitude, longitude):
+        """Get the grid cell of coordinates."""
+        return math.floor(latitude / self.grid), math.floor(longitude / self.grid)
+
+    def add_country(self, country_code, edges):
+        """Index a country by the edges of its polygons, as pairs of (latitude, longitude) points."""
+        if not edges:
+            return
+        # Edges of the country by cell, for cells the edges come within margin of.
+        cell_edges = collections.defaultdict(list)
+        for edge in edges:
+            (first_row, first_column), (last_row, last_column) = (
+                self.cell(min(edge[0][0], edge[1][0]) - self.margin, min(edge[0][1], edge[1][1]) - self.margin),
+                self.cell(max(edge[0][0], edge[1][0]) + self.margin, max(edge[0][1], edge[1][1]) + self.margin))
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    cell_edges[(row, column)].append(edge)
+
+        first_row, first_column = self.cell(min(y for edge in edges for y, _ in edge), min(
+            x for edge in edges for _, x in edge))
+        last_row, last_column = self.cell(max(y for edge in edges for y, _ in edge), max(
+            x for edge in edges for _, x in edge))
+        for row in range(first_row, last_row + 1):
+            reference_latitude = (row + REFERENCE_OFFSET[0]) * self.grid
+            # Longitudes where the edges cross the latitude of the reference points of the row, for ray casting.
+            crossings = sorted(
+                start[1] + (reference_latitude - start[0]) * (end[1] - start[1]) / (end[0] - start[0])
+                for start, end in edges if (start[0] > reference_latitude) != (end[0] > reference_latitude))
+            for column in range(first_column, last_column + 1):
+                reference = (reference_latitude, (column + REFERENCE_OFFSET[1]) * self.grid)
+                inside = bisect.bisect_left(crossings, reference[1]) % 2 == 1
+                self.add_cell((row, column), reference, (country_code, inside, cell_edges.get((row, column), [])))
+
+    def add_cell(self, cell, reference, country):
+        """
+        Index a cell of a country, given the reference point of the cell and the country as (country code, whether
+        the reference point is in it, edges in the cell).
+        """
+        country_code, inside, edges = country
+        entry = self.cells.get(cell)
+        if not edges:
+            if not inside:
+                return
+            if entry is None:
+                self.cells[cell] = country_code
+                return
+        if entry is None:
+            entry = self.cells[cell] = (reference, [])
+        elif isinstance(entry, str):
+            entry = self.cells[cell] = (reference, [(entry, True, [])])
+        entry[1].append(country)
+
+    def lookup(self, latitude, longitude):
+        """Get the country code of coordinates, '' if they are in no country, or None if they are ambiguous."""
+        entry = self.cells.get(self.cell(latitude, longitude))
+        if entry is None or isinstance(entry, str):
+            return entry or ''
+        reference, countries = entry
+        point = (latitude, longitude)
+        margin_squared = self.margin * self.margin
+        found = ''
+        for country_code, inside, edges in countries:
+            for edge in edges:
+                if segment_distance_squared(point, *edge) < margin_squared:
+                    return None
+                if crosses(reference, point, edge):
+                    inside = not inside
+            if inside and not found:
+                found = country_code
+        return found
+
+    @classmethod
+    def load(cls, path, code_property=BOUNDARIES_CODE_PROPERTY, **kwargs):
+        """
+        Load an index from a GeoJSON file of Polygon and MultiPolygon features, with country codes in the
+        code_property property of features.
+        """
+        with open(path) as boundaries_file:
+            features = json.load(boundaries_file)['features']
+        boundaries = collections.defaultdict(list)
+        for feature in features:
+            geometry = feature['geometry']
+            polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+            # GeoJSON positions are [longitude, latitude].
+            boundaries[feature['properties'][code_property]].extend(
+                [[(latitude, longitude) for longitude, latitude in ring] for ring in polygon] for polygon in polygons)
+        return cls(boundaries, **kwargs)
+
+
+# Country indexes of boundaries files by path, loaded on first use.
+COUNTRY_INDEXES = {}
+COUNTRY_INDEX_LOCK = threading.Lock()
+
+
+# Settings of a GeodecodingClient, see its docstring.
+ClientSettings = collections.namedtuple(
+    'ClientSettings', ('url', 'api_key', 'timeout', 'retries', 'backoff', 'workers'),
+    defaults=(URL, GOOGLE_API_KEY, TIMEOUT, RETRIES, BACKOFF, WORKERS))
+
+
+class GeodecodingClient:
+    """
+    Client of the geocoding API at url, safe to share by threads, over a pooled keep-alive session of up to workers
+    connections, grown by reserve for more concurrent requests. Requests wait timeout seconds for the API, and
+    connection failures, server errors and retried statuses are retried with exponential backoff.
+    Settings are those of ClientSettings, and all but url are keyword only.
+    """
+
+    def __init__(self, url=URL, **settings):
+        self.settings = ClientSettings(url, **settings)
+        self.params = dict(PARAMS, key=self.settings.api_key)
+        self.session = requests.Session()
+        # Concurrent requests the pool keeps connections alive for.
+        self.workers = 0
+        self.lock = threading.Lock()
+        self.reserve(self.settings.workers)
+
+    def reserve(self, workers):
+        """Grow the pool to keep alive connections of up to workers concurrent requests, if it is smaller."""
+        with self.lock:
+            if workers <= self.workers:
+                return
+            self.workers = workers
+            previous_adapter = self.session.adapters.get('https://')
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            # Requests in flight on the previous adapter close their connections once done.
+            if previous_adapter is not None:
+                previous_adapter.close()
+
+    def request_country_code(self, gps_coords):
+        """Request short country code by GPS coordinates from the geocoding API."""
+        params = dict(self.params, latlng=gps_coords)
+        settings = self.settings
+        for attempt in range(settings.retries + 1):
+            if attempt:
+                time.sleep(settings.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.get(settings.url, params=params, timeout=settings.timeout)
+            except requests.RequestException as exception:
+                error = str(exception)
+                continue
+            if response.status_code >= 500 or response.status_code == 429:
+                error = 'status {}'.format(response.status_code)
+                continue
+            try:
+                body = response.json()
+            except ValueError as exception:
+                raise GeodecodingError('invalid response, status {}'.format(response.status_code)) from exception
+            if body['status'] in RETRIED_STATUSES:
+                error = body.get('error_message', body['status'])
+                continue
+            return country_code_of(body)
+        raise GeodecodingError(error)
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+
+CLIENT = GeodecodingClient()
+
+
+def country_code_of(body):
+    """Get short country code from a geocoding API response body."""
+    if body['status'] == 'ZERO_RESULTS':
         return ''
 
-    if response['status'] != 'OK':
-        raise GeodecodingError(response['error_message'])
+    if body['status'] != 'OK':
+        raise GeodecodingError(body.get('error_message', body['status']))
 
-    result = next((result for result in response['results'] if RESULT_TYPE in result['types']), None)
+    result = next((result for result in body['results'] if RESULT_TYPE in result['types']), None)
     country_code = result['address_components'][0]['short_name'] if result is not None else ''
     return country_code
+
+
+def parse_coordinates(gps_coords):
+    """Get (latitude, longitude) of coordinates given as 'latitude,longitude', or None if they are not valid."""
+    try:
+        latitude, longitude = (float(coordinate) for coordinate in gps_coords.split(','))
+    except ValueError:
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+
+def get_country_index():
+    """Get the country index of the boundaries in BOUNDARIES_PATH, loading it on first use, or None if not set."""
+    if not BOUNDARIES_PATH:
+        return None
+    country_index = COUNTRY_INDEXES.get(BOUNDARIES_PATH)
+    if country_index is None:
+        with COUNTRY_INDEX_LOCK:
+            country_index = COUNTRY_INDEXES.get(BOUNDARIES_PATH)
+            if country_index is None:
+                country_index = COUNTRY_INDEXES[BOUNDARIES_PATH] = CountryIndex.load(BOUNDARIES_PATH)
+    return country_index
+
+
+def gps_to_country_code(gps_coords, cache=CACHE, country_index=None, client=None):
+    """
+    Obtain short country code by GPS coordinates.
+    With a country index (by default the one of BOUNDARIES_PATH, if set), coordinates are looked up offline, and
+    only those too close to a border are requested from the API, with client (by default the shared one).
+    Country codes of places in the same cell of the cache grid are requested once, errors are not cached. Places too
+    close to a border are not cached, since a cell there can span several countries.
+    """
+    request_country_code = (client or CLIENT).request_country_code
+    coordinates = parse_coordinates(gps_coords)
+    if coordinates is None:
+        return request_country_code(gps_coords)
+    country_index = country_index or get_country_index()
+    if country_index is not None:
+        country_code = country_index.lookup(*coordinates)
+        if country_code is not None:
+            return country_code
+    if cache is None or country_index is not None:
+        return request_country_code(gps_coords)
+    key = cache.key(coordinates)
+    country_code = cache.get(key)
+    if country_code is None:
+        country_code = request_country_code(gps_coords)
+        cache.put(key, country_code)
+    return country_code
+
+
+def gps_to_country_codes(gps_coords_list, cache=CACHE, country_index=None, client=None, *, workers=WORKERS,
+                         return_exceptions=False):
+    """
+    Obtain short country codes of several GPS coordinates, in the same order, looking them up concurrently in up to
+    workers threads, with the pool of client (by default the shared one) grown to keep alive a connection per thread.
+    Identical coordinates are looked up once.
+    The first error is raised once all lookups are done, or with return_exceptions errors are returned in place of
+    the country codes they failed to obtain.
+    """
+    gps_coords_list = list(gps_coords_list)
+    unique_gps_coords = list(dict.fromkeys(gps_coords_list))
+    if not unique_gps_coords:
+        return []
+    workers = min(workers, len(unique_gps_coords))
+    (client or CLIENT).reserve(workers)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {
+            gps_coords: executor.submit(gps_to_country_code, gps_coords, cache, country_index, client)
+            for gps_coords in unique_gps_coords}
+    results = []
+    for gps_coords in gps_coords_list:
+        exception = futures[gps_coords].exception()
+        if exception is not None and not return_exceptions:
+            raise exception
+        results.append(exception or futures[gps_coords].result())
+    return results
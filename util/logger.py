@@ -1,39 +1,806 @@
 """PAKET logging."""
+import atexit
+import collections
+import contextlib
+import contextvars
+import copy
+import functools
+import gzip
+import json
 import logging
+import logging.handlers
 import os
+import pickle
+import queue
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import traceback
 
 import coloredlogs
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOG_DIR_NAME = os.environ.get('PAKET_LOG_DIR', './')
 LOG_FILE_NAME = os.environ.get('PAKET_LOG_FILE', 'paket.log')
-FORMAT = os.environ.get('PAKET_LOG_FMT', '%(asctime)s %(levelname).3s: %(message)s - %(name)s +%(lineno)03d')
+# Either a logging format string or 'json' for one JSON object per line.
+# %(context)s holds the fields bound to the current context, if any.
+FORMAT = os.environ.get(
+    'PAKET_LOG_FMT', '%(asctime)s %(levelname).3s: %(message)s%(context)s - %(name)s +%(lineno)03d')
 DATE_FORMAT = os.environ.get('PAKET_LOG_DATE_FMT', '%Y-%m-%d %H:%M:%S')
 LEVEL = os.environ.get('PAKET_LOG_LEVEL', logging.DEBUG)
 
+# Levels of specific loggers and their descendants, as 'pkt.util=DEBUG,pkt.util.test=WARNING',
+# and a JSON file mapping logger names to levels, which is read again on reload.
+LEVELS = os.environ.get('PAKET_LOG_LEVELS', '')
+LEVELS_FILE = os.environ.get('PAKET_LOG_LEVELS_FILE')
+
+# Default number of records per period seconds let through by RateLimitFilter.
+RATE_LIMIT = int(os.environ.get('PAKET_LOG_RATE_LIMIT', 10))
+RATE_LIMIT_PERIOD = float(os.environ.get('PAKET_LOG_RATE_LIMIT_PERIOD', 1))
+
+# Unix socket of the log collector process. When set, records are sent to the collector, which owns the log file.
+SOCKET = os.environ.get('PAKET_LOG_SOCKET')
+
+# Stream logging to stderr, colored when it is a terminal ('auto'), 'always' or 'never'.
+STREAM = os.environ.get('PAKET_LOG_STREAM', '1') == '1'
+COLOR = os.environ.get('PAKET_LOG_COLOR', 'auto')
+
+# Async mode: records are put on a bounded queue and written by a dedicated thread.
+ASYNC = os.environ.get('PAKET_LOG_ASYNC', '0') == '1'
+QUEUE_SIZE = int(os.environ.get('PAKET_LOG_QUEUE_SIZE', 10000))
+OVERFLOW_POLICY = os.environ.get('PAKET_LOG_OVERFLOW', 'block')
+OVERFLOW_LEVEL = os.environ.get('PAKET_LOG_OVERFLOW_LEVEL', logging.WARNING)
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-below-level')
+
+# Buffered file writes, disabled when buffer size is 0.
+BUFFER_SIZE = int(os.environ.get('PAKET_LOG_BUFFER_SIZE', 0))
+FLUSH_INTERVAL = float(os.environ.get('PAKET_LOG_FLUSH_INTERVAL', 1))
+FLUSH_LEVEL = os.environ.get('PAKET_LOG_FLUSH_LEVEL', logging.ERROR)
+
+# Rotation by size in bytes and by interval in seconds, disabled when both are 0.
+ROTATE_BYTES = int(os.environ.get('PAKET_LOG_MAX_BYTES', 0))
+ROTATE_INTERVAL = float(os.environ.get('PAKET_LOG_ROTATE_INTERVAL', 0))
+BACKUP_COUNT = int(os.environ.get('PAKET_LOG_BACKUP_COUNT', 0))
+BACKUP_MAX_BYTES = int(os.environ.get('PAKET_LOG_BACKUP_MAX_BYTES', 0))
+COMPRESSION = os.environ.get('PAKET_LOG_COMPRESSION', 'gzip')
+COMPRESSION_SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+# Rotated segments are named by the log file, a timestamp and the suffix of their compression.
+SEGMENT_SUFFIX = r'\.\d{8}-\d{6}-\d{6}(?:' + '|'.join(
+    re.escape(suffix) for suffix in COMPRESSION_SUFFIXES.values() if suffix) + r')?\Z'
+
+# Settings of a BufferedFileHandler: buffer capacity in characters, flush interval in seconds and flush level.
+Buffering = collections.namedtuple(
+    'Buffering', ('capacity', 'flush_interval', 'flush_level'), defaults=(65536, 1.0, logging.ERROR))
+UNBUFFERED = Buffering(0, 0)
+# Settings of a RotatingFileHandler: rotation, retention of rotated segments and their compression.
+Rotation = collections.namedtuple(
+    'Rotation', ('max_bytes', 'interval', 'backup_count', 'backup_max_bytes', 'compression'),
+    defaults=(0, 0, 0, 0, 'gzip'))
+
+# Writer thread of async mode, if running, and handlers created by the last setup, closed when setting up again.
+SETUP = {'listener': None, 'handlers': []}
+# Names of loggers with levels set by configure_levels.
+CONFIGURED_LOGGERS = set()
+# Fields bound to the current context, with their rendering for %(context)s, or None.
+CONTEXT = contextvars.ContextVar('pkt_log_context', default=None)
+# Attributes of records, which can't be used as names of extra or bound fields.
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__)
+# Attributes added to records by formatters, the async queue and the context filter.
+ADDED_ATTRIBUTES = frozenset(('message', 'asctime', 'context'))
+RESERVED_ATTRIBUTES = RECORD_ATTRIBUTES | ADDED_ATTRIBUTES
+
+
+def level_number(level):
+    """Convert a level name or number to a level number."""
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError("unknown level {}".format(level))
+    return number
+
+
+def load_levels():
+    """Load logger levels from environment and from the levels file, which takes precedence."""
+    levels = {}
+    for item in LEVELS.split(','):
+        if item.strip():
+            logger_name, level = item.split('=')
+            levels[logger_name.strip()] = level.strip()
+    if LEVELS_FILE:
+        with open(LEVELS_FILE) as levels_file:
+            levels.update(json.load(levels_file))
+    return levels
+
+
+def configure_levels(levels):
+    """
+    Set the levels of loggers by name, applying to their descendants as well.
+    Loggers configured by a previous call and missing from levels revert to inheriting their level.
+    """
+    levels = {logger_name: level_number(level) for logger_name, level in levels.items()}
+    for logger_name in CONFIGURED_LOGGERS - set(levels):
+        logging.getLogger(logger_name).setLevel(logging.NOTSET)
+    for logger_name, level in levels.items():
+        logging.getLogger(logger_name).setLevel(level)
+    CONFIGURED_LOGGERS.clear()
+    CONFIGURED_LOGGERS.update(levels)
+
+
+def reload_levels(*_):
+    """Configure logger levels again from environment and levels file. Can be used as a signal handler."""
+    try:
+        configure_levels(load_levels())
+    except (OSError, ValueError) as error:
+        logging.getLogger('pkt.util.logger').error("can't reload logger levels: %s", error)
+
+
+def install_reload_signal(signum=signal.SIGHUP):
+    """Reload logger levels whenever the process receives signum. Must be called from the main thread."""
+    signal.signal(signum, reload_levels)
+
+
+@contextlib.contextmanager
+def bind(**fields):
+    """
+    Bind fields to all records logged within the block, on top of fields already bound.
+    Asyncio tasks created within the block inherit the fields; threads do so when their target is wrapped
+    with in_context.
+    """
+    reserved = RESERVED_ATTRIBUTES.intersection(fields)
+    if reserved:
+        raise KeyError("can't bind reserved record attributes {}".format(', '.join(sorted(reserved))))
+    bound = CONTEXT.get()
+    if bound is not None:
+        fields = dict(bound[0], **fields)
+    rendered = ' [{}]'.format(' '.join('{}={}'.format(key, value) for key, value in fields.items()))
+    token = CONTEXT.set((fields, rendered))
+    try:
+        yield
+    finally:
+        CONTEXT.reset(token)
+
+
+def in_context(function):
+    """Wrap function to run with the fields bound when wrapping, for use as a thread target or in an executor."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def run_in_context(*args, **kwargs):
+        """Run function in a copy of the captured context."""
+        return context.copy().run(function, *args, **kwargs)
+    return run_in_context
+
+
+def add_context(record):
+    """
+    Filter adding the fields bound to the current context to records, as attributes and rendered as context,
+    unless they already went through it.
+    """
+    if 'context' in record.__dict__:
+        return True
+    bound = CONTEXT.get()
+    if bound is None:
+        record.context = ''
+    else:
+        record.__dict__.update(bound[0])
+        record.context = bound[1]
+    return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most rate records per period seconds for each logger and message template.
+    The first record let through after others were suppressed gets their count appended to its message,
+    and as a suppressed attribute. Hot paths can call allows before logging, to skip creating doomed records.
+    """
+    MAX_WINDOWS = 1024
+
+    def __init__(self, rate=RATE_LIMIT, period=RATE_LIMIT_PERIOD):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        # Per key: [window start, records let through, records suppressed, suppressed in earlier windows].
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def current_window(self, key):
+        """Get the current window of key, starting a new one if it expired. Must be called with lock held."""
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.period:
+            if window is None and len(self.windows) >= self.MAX_WINDOWS:
+                self.windows = {
+                    old_key: old_window for old_key, old_window in self.windows.items()
+                    if now - old_window[0] < self.period or old_window[2] + old_window[3]}
+            window = self.windows[key] = [now, 0, 0, window[2] + window[3] if window else 0]
+        return window
+
+    def allows(self, logger_name, msg):
+        """Check if a record would be let through, counting it as suppressed if not."""
+        with self.lock:
+            window = self.current_window((logger_name, msg))
+            if window[1] < self.rate:
+                return True
+            window[2] += 1
+            return False
+
+    def filter(self, record):
+        """Let the record through if its key is within rate."""
+        with self.lock:
+            window = self.current_window((record.name, record.msg))
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            suppressed, window[3] = window[3], 0
+        if suppressed:
+            record.msg = "{} (suppressed {} similar messages)".format(record.msg, suppressed)
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as compact JSON objects, one per line.
+    The serialized level, logger name and line number are cached per call site,
+    and the formatted timestamp is cached per second.
+    """
+    encode_string = staticmethod(json.encoder.encode_basestring_ascii)
+
+    def __init__(self, datefmt=None):
+        super().__init__(datefmt=datefmt)
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+        self.call_sites = {}
+        self.second = (None, None)
+
+    def format(self, record):
+        """Format a record as a single line of JSON."""
+        call_site = (record.name, record.levelno, record.lineno)
+        prefix = self.call_sites.get(call_site)
+        if prefix is None:
+            prefix = self.call_sites[call_site] = '","level":{},"name":{},"lineno":{},"message":'.format(
+                self.encode_string(record.levelname), self.encode_string(record.name), record.lineno)
+        line = '{"timestamp":"' + self.timestamp(record) + prefix + self.encode_string(record.getMessage())
+
+        # Only records with more attributes than those of all records and those added along the way have extras.
+        if len(record.__dict__) - len(record.__dict__.keys() & ADDED_ATTRIBUTES) > len(RECORD_ATTRIBUTES):
+            extra = self.extra_fields(record)
+            if extra:
+                line += ',' + self.encoder.encode(extra)[1:-1]
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += ',"exc_info":' + self.encode_string(record.exc_text)
+        if record.stack_info:
+            line += ',"stack_info":' + self.encode_string(self.formatStack(record.stack_info))
+        return line + '}'
+
+    @staticmethod
+    def extra_fields(record):
+        """Get the fields added to a record as extra or bound to its context."""
+        return {key: value for key, value in record.__dict__.items() if key not in RESERVED_ATTRIBUTES}
+
+    def timestamp(self, record):
+        """Format the record creation time, reusing the formatted second of the previous record."""
+        second, formatted_second = self.second
+        if second != int(record.created):
+            second = int(record.created)
+            formatted_second = time.strftime(self.datefmt or self.default_time_format, self.converter(second))
+            self.second = second, formatted_second
+        return '%s.%03d' % (formatted_second, record.msecs)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Put records on a bounded queue, to be written by a QueueListener thread.
+    When the queue is full the overflow policy decides what happens:
+        block - wait for the writer thread to make room
+        drop-oldest - discard the oldest queued record
+        drop-below-level - discard the new record if it is below overflow_level, block otherwise
+    Discarded records are counted by level name in the dropped counter.
+    In a forked process, the first record starts a new queue and writer thread, since the parent's thread doesn't run
+    there and the parent writes the records it queued.
+    """
+
+    def __init__(self, record_queue, overflow_policy='block', overflow_level=logging.WARNING):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy {}".format(overflow_policy))
+        super().__init__(record_queue)
+        self.overflow_policy = overflow_policy
+        self.overflow_level = level_number(overflow_level)
+        self.dropped = collections.Counter()
+        self.dropped_lock = threading.Lock()
+        # Writer thread of the queue, if any, and the process the queue belongs to.
+        self.listener = None
+        self.pid = os.getpid()
+
+    def prepare(self, record):
+        """Merge the message arguments on the calling thread, leaving formatting to the writer thread."""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """Put a record on the queue, applying the overflow policy if it is full."""
+        if self.pid != os.getpid():
+            self.restart()
+        if self.overflow_policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.overflow(record)
+
+    def overflow(self, record):
+        """Handle a record that does not fit in the queue."""
+        if self.overflow_policy == 'drop-below-level':
+            if record.levelno < self.overflow_level:
+                self.drop(record)
+            else:
+                self.queue.put(record)
+            return
+        while True:
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self.queue.task_done()
+                if oldest is None:
+                    # The writer thread is stopping. Its sentinel goes back in, and the new record is dropped.
+                    self.queue.put_nowait(oldest)
+                    self.drop(record)
+                    return
+                self.drop(oldest)
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                continue
+
+    def drop(self, record):
+        """Count a discarded record."""
+        if record is None:
+            return
+        with self.dropped_lock:
+            self.dropped[record.levelname] += 1
+
+    def restart(self):
+        """Start over with an empty queue in a forked process, and a writer thread if the parent had one."""
+        self.pid = os.getpid()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.dropped_lock = threading.Lock()
+        if self.listener is not None:
+            self.listener.restart(self.queue)
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """Write queued records on a dedicated thread."""
+
+    def __init__(self, record_queue, *handlers, respect_handler_level=False):
+        super().__init__(record_queue, *handlers, respect_handler_level=respect_handler_level)
+        # Process the thread was started in.
+        self.pid = None
+
+    def start(self):
+        """Start the thread."""
+        self.pid = os.getpid()
+        super().start()
+
+    def restart(self, record_queue):
+        """Start a thread writing records of a new queue, in a forked process where the parent's thread doesn't run."""
+        self.queue = record_queue
+        self._thread = None
+        self.start()
+
+    def enqueue_sentinel(self):
+        """Wait for room for the sentinel, so stopping never loses queued records."""
+        self.queue.put(self._sentinel)
 
-def setup(suppress_loggers=None):
-    """Setup the root logger."""
-    # Colored logs for terminal. Do this first, because it messes with the logger's level.
-    stream_formatter = coloredlogs.ColoredFormatter(
+
+class BufferedFileHandler(logging.FileHandler):
+    """
+    Write records to file in large batches instead of one write per record.
+    Buffered records are written when they exceed capacity characters, when flush_interval seconds have passed
+    since the last write, and immediately on records of flush_level and above.
+    """
+
+    def __init__(self, filename, capacity=65536, flush_interval=1.0, flush_level=logging.ERROR):
+        self.buffering = Buffering(capacity, flush_interval, level_number(flush_level))
+        self.buffer = []
+        self.buffered_size = 0
+        self.last_flush = time.monotonic()
+        self.closing = threading.Event()
+        super().__init__(filename)
+        if flush_interval:
+            threading.Thread(target=self.flush_periodically, daemon=True).start()
+
+    def emit(self, record):
+        """Buffer a record, writing the buffer if needed."""
+        try:
+            line = self.format(record) + self.terminator
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        self.buffer.append(line)
+        self.buffered_size += len(line)
+        buffering = self.buffering
+        if self.buffered_size >= buffering.capacity or record.levelno >= buffering.flush_level or (
+                buffering.flush_interval and time.monotonic() - self.last_flush >= buffering.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write out all buffered records in a single write."""
+        self.acquire()
+        try:
+            if self.buffer:
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(''.join(self.buffer))
+                self.buffer = []
+                self.buffered_size = 0
+            super().flush()
+            self.last_flush = time.monotonic()
+        finally:
+            self.release()
+
+    def flush_periodically(self):
+        """Write out the buffer of an idle handler every flush_interval seconds, until closed."""
+        while not self.closing.wait(self.buffering.flush_interval):
+            if self.buffer and time.monotonic() - self.last_flush >= self.buffering.flush_interval:
+                self.flush()
+
+    def close(self):
+        """Write out the buffer and close the file."""
+        self.closing.set()
+        self.flush()
+        super().close()
+
+
+def compress_file(path, compression):
+    """Compress a file next to itself and remove the original."""
+    temporary_path = path + COMPRESSION_SUFFIXES[compression] + '.tmp'
+    with open(path, 'rb') as source:
+        if compression == 'zstd':
+            with open(temporary_path, 'wb') as target:
+                zstandard.ZstdCompressor().copy_stream(source, target)
+        else:
+            with gzip.open(temporary_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+    os.rename(temporary_path, path + COMPRESSION_SUFFIXES[compression])
+    os.remove(path)
+
+
+class RotatingFileHandler(BufferedFileHandler):
+    """
+    File handler with Buffering settings (unbuffered by default) that rotates the file as set by Rotation settings:
+    when it exceeds max_bytes and every interval seconds.
+    Intervals are aligned to the epoch, so a daily interval rotates at midnight UTC.
+    Rotated segments get a timestamp suffix and are compressed on a background thread, after which
+    the oldest segments beyond backup_count or backup_max_bytes in total are deleted (0 means no limit).
+    """
+
+    def __init__(self, filename, buffering=UNBUFFERED, **rotation):
+        self.rotation = Rotation(**rotation)
+        if self.rotation.compression not in COMPRESSION_SUFFIXES:
+            raise ValueError("unknown compression {}".format(self.rotation.compression))
+        if self.rotation.compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.rollover_at = self.next_rollover(time.time())
+        self.segments = queue.Queue()
+        self.compressor = None
+        self.file_size = 0
+        super().__init__(filename, *buffering)
+        self.file_size = os.path.getsize(self.baseFilename)
+
+    def next_rollover(self, now):
+        """Get the time of the first interval boundary after now."""
+        return (now // self.rotation.interval + 1) * self.rotation.interval if self.rotation.interval else None
+
+    def should_rotate(self):
+        """Check if buffered records should go to a new file."""
+        max_bytes = self.rotation.max_bytes
+        if max_bytes and self.file_size and self.file_size + self.buffered_size > max_bytes:
+            return True
+        return bool(self.rotation.interval) and time.time() >= self.rollover_at
+
+    def flush(self):
+        """Write out all buffered records, rotating the file first if needed."""
+        self.acquire()
+        try:
+            if self.buffer and self.should_rotate():
+                self.rotate()
+            self.file_size += self.buffered_size
+            super().flush()
+        finally:
+            self.release()
+
+    def rotate(self):
+        """Move the current file aside and hand it over to the compressor thread."""
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        segment = "{}.{}-{:06d}".format(
+            self.baseFilename, time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)), int(now % 1 * 1000000))
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, segment)
+            if self.compressor is None:
+                self.compressor = threading.Thread(target=self.process_segments, daemon=True)
+                self.compressor.start()
+            self.segments.put(segment)
+        self.stream = self._open()
+        self.file_size = 0
+        self.rollover_at = self.next_rollover(now)
+
+    def process_segments(self):
+        """Compress rotated segments and enforce retention, until closed."""
+        while True:
+            segment = self.segments.get()
+            try:
+                if segment is None:
+                    return
+                if self.rotation.compression != 'none':
+                    compress_file(segment, self.rotation.compression)
+                self.remove_old_segments()
+            except OSError:
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                self.segments.task_done()
+
+    def remove_old_segments(self):
+        """Delete the oldest segments beyond retention limits."""
+        directory, base_name = os.path.split(self.baseFilename)
+        segment_name = re.compile(re.escape(base_name) + SEGMENT_SUFFIX)
+        segments = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if segment_name.match(name))
+        total_size = sum(os.path.getsize(segment) for segment in segments)
+        while segments and (
+                (self.rotation.backup_count and len(segments) > self.rotation.backup_count) or
+                (self.rotation.backup_max_bytes and total_size > self.rotation.backup_max_bytes)):
+            oldest = segments.pop(0)
+            total_size -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def close(self):
+        """Close the file and wait for pending compressions."""
+        super().close()
+        if self.compressor is not None:
+            self.segments.put(None)
+            self.compressor.join()
+            self.compressor = None
+
+
+def create_file_formatter():
+    """Create a formatter for files, as configured by environment."""
+    return JsonFormatter(DATE_FORMAT) if FORMAT == 'json' else logging.Formatter(FORMAT, DATE_FORMAT)
+
+
+def create_file_handler(path):
+    """Create a file handler, rotating, buffered and formatted as configured by environment."""
+    if ROTATE_BYTES or ROTATE_INTERVAL:
+        file_handler = RotatingFileHandler(
+            path, Buffering(BUFFER_SIZE, FLUSH_INTERVAL if BUFFER_SIZE else 0, FLUSH_LEVEL), max_bytes=ROTATE_BYTES,
+            interval=ROTATE_INTERVAL, backup_count=BACKUP_COUNT, backup_max_bytes=BACKUP_MAX_BYTES,
+            compression=COMPRESSION)
+    elif BUFFER_SIZE:
+        file_handler = BufferedFileHandler(path, BUFFER_SIZE, FLUSH_INTERVAL, FLUSH_LEVEL)
+    else:
+        file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(create_file_formatter())
+    return file_handler
+
+
+class CollectorHandler(logging.handlers.SocketHandler):
+    """
+    Send records to a log collector over a Unix socket.
+    While the collector is unreachable records are written by the fallback handler instead.
+    Each process opens its own connection, so handlers created before forking are safe to use.
+    """
+
+    def __init__(self, socket_path, fallback):
+        super().__init__(socket_path, None)
+        self.fallback = fallback
+        self.pid = os.getpid()
+
+    def emit(self, record):
+        """Send a record to the collector, or to the fallback handler if that fails."""
+        if self.pid != os.getpid():
+            # The connection was inherited from the parent process.
+            self.pid, self.sock, self.retryTime = os.getpid(), None, None
+        # Failures to send close the connection and are not errors; failures to pickle are, and keep it open.
+        super().emit(record)
+        if self.sock is None:
+            self.fallback.handle(record)
+
+    def close(self):
+        """Close the connection and the fallback handler."""
+        super().close()
+        self.fallback.close()
+
+
+class CollectorRequestHandler(socketserver.StreamRequestHandler):
+    """Read records sent by a CollectorHandler."""
+
+    def handle(self):
+        """Pass received records to the handlers of the collector until the connection is closed."""
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            length = struct.unpack('>L', header)[0]
+            data = self.rfile.read(length)
+            if len(data) < length:
+                return
+            record = logging.makeLogRecord(pickle.loads(data))
+            for handler in self.server.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class LogCollector(socketserver.ThreadingUnixStreamServer):
+    """
+    Receive records from CollectorHandlers of other processes and write them with handlers of this process.
+    Records are unpickled, so the socket is accessible only to processes of the same user.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, handlers):
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as existing:
+                if existing.connect_ex(socket_path) == 0:
+                    raise OSError("log collector already running on {}".format(socket_path))
+            os.remove(socket_path)
+        self.handlers = handlers
+        super().__init__(socket_path, CollectorRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        """Close the socket and remove it from the file system."""
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def run_collector(socket_path=SOCKET):
+    """Write records sent by other processes to the log file, until terminated."""
+    file_handler = create_file_handler(os.path.join(LOG_DIR_NAME, LOG_FILE_NAME))
+    # Records of handlers not set up by setup have no context, which the format may use.
+    file_handler.addFilter(add_context)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    with LogCollector(socket_path, [file_handler]) as collector:
+        try:
+            collector.serve_forever()
+        finally:
+            file_handler.close()
+
+
+def dropped_records():
+    """Return the number of records dropped by async mode, by level name."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            with handler.dropped_lock:
+                return dict(handler.dropped)
+    return {}
+
+
+def shutdown():
+    """
+    Stop the writer thread of async mode, after all queued records were written, and write records directly from
+    then on. Safe to call repeatedly.
+    """
+    listener, SETUP['listener'] = SETUP['listener'], None
+    if listener is None:
+        return
+    running = listener.pid == os.getpid()
+    if running:
+        listener.stop()
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler) and handler.listener is listener:
+            logger.removeHandler(handler)
+    for handler in listener.handlers:
+        handler.addFilter(add_context)
+        logger.addHandler(handler)
+    # Records queued by other threads while the writer thread was stopping.
+    while running:
+        try:
+            record = listener.queue.get_nowait()
+        except queue.Empty:
+            break
+        if record is not None:
+            listener.handle(record)
+    for handler in listener.handlers:
+        handler.flush()
+
+
+# Registered after logging's own exit handler, so it runs before the handlers are closed.
+atexit.register(shutdown)
+
+
+def colored_formatter():
+    """Create a formatter with ANSI colors, for terminals."""
+    return coloredlogs.ColoredFormatter(
         fmt=FORMAT, datefmt=DATE_FORMAT, level_styles={
             'info': {'color': 'green'}, 'warning': {'color': 'yellow', 'bold': True},
             'error': {'color': 'red', 'bold': True}, 'critical': {'color': 'red', 'bold': True},
         }, field_styles={'name': {'color': 'cyan'}, 'lineno': {'color': 'cyan'}})
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(stream_formatter)
+
+
+def create_stream_formatter(stream):
+    """Create a formatter for stream, colored only if it is a terminal or colors are forced by environment."""
+    if FORMAT == 'json':
+        return JsonFormatter(DATE_FORMAT)
+    if COLOR == 'always' or (COLOR == 'auto' and hasattr(stream, 'isatty') and stream.isatty()):
+        return colored_formatter()
+    return logging.Formatter(FORMAT, DATE_FORMAT)
+
+
+def setup(suppress_loggers=None, async_mode=ASYNC, log_to_stream=STREAM, levels=None):
+    """Setup the root logger, and levels of specific loggers (by default from environment)."""
+    handlers = []
+
+    # Logging to terminal. Do this first, because colored logs mess with the logger's level.
+    if log_to_stream:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(create_stream_formatter(stream_handler.stream))
+        handlers.append(stream_handler)
 
     # Logging to file.
-    file_formatter = logging.Formatter(FORMAT, DATE_FORMAT)
-    file_handler = logging.FileHandler(os.path.join(LOG_DIR_NAME, LOG_FILE_NAME))
-    file_handler.setFormatter(file_formatter)
+    if SOCKET:
+        fallback_handler = logging.FileHandler(os.path.join(LOG_DIR_NAME, LOG_FILE_NAME), delay=True)
+        fallback_handler.setFormatter(create_file_formatter())
+        handlers.append(CollectorHandler(SOCKET, fallback_handler))
+    else:
+        handlers.append(create_file_handler(os.path.join(LOG_DIR_NAME, LOG_FILE_NAME)))
 
     # Suppress handlers of unwanted loggers.
     if suppress_loggers is not None:
         for logger_name in suppress_loggers:
             logging.getLogger(logger_name).handlers = []
 
+    # Write out anything still queued by a previous async setup.
+    shutdown()
+
     logger = logging.getLogger()
     logger.handlers = []
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    for handler in SETUP['handlers']:
+        handler.close()
+    SETUP['handlers'] = handlers
+    if async_mode:
+        record_queue = queue.Queue(QUEUE_SIZE)
+        queue_handler = QueueHandler(record_queue, OVERFLOW_POLICY, OVERFLOW_LEVEL)
+        queue_handler.addFilter(add_context)
+        logger.addHandler(queue_handler)
+        listener = SETUP['listener'] = queue_handler.listener = QueueListener(
+            record_queue, *handlers, respect_handler_level=True)
+        listener.start()
+    else:
+        for handler in handlers:
+            handler.addFilter(add_context)
+            logger.addHandler(handler)
     logger.setLevel(LEVEL)
+    configure_levels(load_levels() if levels is None else levels)
+
+
+if __name__ == '__main__':
+    run_collector()
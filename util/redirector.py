@@ -1,29 +1,124 @@
 'Link redirector.'
+import functools
+import logging
+import os
 import urllib.parse
+import uuid
+
 import util.countly
+import util.logger
 
+LOGGER = logging.getLogger('pkt.util.redirector')
 HTML_HEAD = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>PAKET Linker</title></head><body>'
 HTML_FORM = '<form><input name=link placeholder=link><input name=source placeholder=source><input type=submit></form>'
 HTML_TAIL = '</body></html>'
+FORM_PAGE = "{}{}{}".format(HTML_HEAD, HTML_FORM, HTML_TAIL).encode()
+FORM_HEADERS = (('Content-Type', 'text/html'), ('Content-Length', str(len(FORM_PAGE))))
+# Query keys the pages depend on. Other keys are only parsed for redirect events.
+PAGE_KEYS = frozenset(('target', 'link', 'source'))
+# Number of parsed query strings and generated link pages to cache.
+CACHE_SIZE = int(os.environ.get('PAKET_REDIRECTOR_CACHE_SIZE', 1024))
+
+
+def unquote(text):
+    """Decode a query string name or value, skipping the work if there is nothing to decode."""
+    if '+' in text:
+        text = text.replace('+', ' ')
+    if '%' in text:
+        text = urllib.parse.unquote(text)
+    return text
+
+
+def parse_query(query_string, keys=None):
+    """
+    Parse a query string like urllib.parse.parse_qs, into lists of values by name, but only for names in keys
+    (all names if keys is None). Values of other names are not decoded.
+    """
+    fields = {}
+    for field in query_string.split('&'):
+        name, _, value = field.partition('=')
+        if not value:
+            continue
+        name = unquote(name)
+        if keys is None or name in keys:
+            fields.setdefault(name, []).append(unquote(value))
+    return fields
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def page_fields(query_string):
+    """Get the fields of a query string that pages depend on. Shared, so not to be modified."""
+    return parse_query(query_string, PAGE_KEYS)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def redirect_fields(query_string):
+    """Get all fields of a redirect query string, with tuples of values, to be used as event segmentation."""
+    return {name: tuple(values) for name, values in parse_query(query_string).items()}
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def link_page(link, source):
+    """Get the page and headers showing a redirect link to link from source."""
+    query_string = urllib.parse.urlencode({'target': link, 'source': source})
+    page = "{head}<a href='/linker?{query}'>https://c.paket.global/linker?{query}</a>{tail}".format(
+        head=HTML_HEAD, query=query_string, tail=HTML_TAIL).encode()
+    return page, (('Content-Type', 'text/html'), ('Content-Length', str(len(page))))
+
+
+def track_redirect(kwargs, timeout=None):
+    """
+    Hand a redirect event to the background countly dispatcher.
+    Queueing never waits on count.ly, and waits at most timeout seconds (the dispatcher's add_timeout by default)
+    for its lock, so it can't hold up the redirect. Failures to create the dispatcher or start its thread are logged,
+    not raised.
+    """
+    try:
+        util.countly.get_dispatcher().add(util.countly.create_event('redirect', 1, **kwargs), timeout)
+    except (ValueError, RuntimeError):
+        LOGGER.exception("can't track redirect")
+
+
+def respond(query_string, tracking_timeout=None):
+    """
+    Get status, headers and body of the response to a query string, tracking redirects with tracking_timeout.
+    Only the keys pages depend on are parsed, and parsed queries and pages are precomputed or cached.
+    """
+    fields = page_fields(query_string)
+    if 'target' in fields:
+        track_redirect(redirect_fields(query_string), tracking_timeout)
+        return '302 Found', [('Location', fields['target'][0])], b''
+    if 'link' in fields and 'source' in fields:
+        page, headers = link_page(fields['link'][0], fields['source'][0])
+        return '200 OK', list(headers), page
+    return '200 OK', list(FORM_HEADERS), FORM_PAGE
 
 
 def application(env, start_response):
     'Handle request.'
-    kwargs = urllib.parse.parse_qs(env['QUERY_STRING'])
-    if 'target' in kwargs:
-        target = kwargs['target'][0]
-        util.countly.send_countly_event('redirect', 1, **kwargs)
-        start_response('302 Found', [('Location', target)])
-        return b''
-    start_response('200 OK', [('Content-Type', 'text/html')])
-    if not {'link', 'source'} - set(kwargs.keys()):
-        query_string = urllib.parse.urlencode({'target': kwargs['link'][0], 'source': kwargs['source'][0]})
-        return "{}<a href='/linker?{}'>https://c.paket.global/linker?{}</a>{}".format(
-            HTML_HEAD, query_string, query_string, HTML_TAIL).encode()
-    return "{}{}{}".format(HTML_HEAD, HTML_FORM, HTML_TAIL).encode()
+    with util.logger.bind(request_id=env.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex):
+        status, headers, body = respond(env['QUERY_STRING'])
+        start_response(status, headers)
+        return body
+
+
+async def asgi_application(scope, _receive, send):
+    'Handle request of an asyncio server, as an ASGI application.'
+    if scope['type'] != 'http':
+        return
+    request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1') or uuid.uuid4().hex
+    with util.logger.bind(request_id=request_id):
+        # Redirect events are dropped rather than wait for the dispatcher lock, which would block the event loop.
+        status, headers, body = respond(scope['query_string'].decode('latin-1'), 0)
+    await send({
+        'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
 
 # Sample uwsgi command:
 # uwsgi --wsgi-file linker.py --socket 127.0.0.1:9090
+# Sample ASGI command:
+# uvicorn util.redirector:asgi_application --port 9090
 # Sample nginx config:
 # location ^~ /linker/ {
 #     include uwsgi_params;